@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 Merged Attendance + Active Learning (ALS) Demo
-Torch-only (no ONNXRuntime) • Stable tracking • Per-ID ALS
+Torch by default (optional ONNX Runtime / OpenVINO CPU backends) • Stable tracking • Per-ID ALS
 - Person detector: YOLOv8 (Ultralytics, GPU/FP16)
 - Behavior detector: YOLOv8 multi-class (GPU/FP16) + per-class thresholds
 - Tracking: ByteTrack (via supervision) => no flicker
@@ -21,9 +21,9 @@ Tested with:
   facenet-pytorch >= 2.5.3 • scikit-learn >=1.4
 """
 
-import os, cv2, csv, time, json, argparse, warnings, glob, math, datetime as dt
+import os, sys, cv2, csv, time, json, argparse, warnings, glob, math, queue, tempfile, threading, datetime as dt
 from collections import defaultdict, deque
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import Dict, List, Tuple, Optional, Iterable
 warnings.filterwarnings("ignore", message=".*weights_only=False.*")
 from pathlib import Path
@@ -32,6 +32,8 @@ import torch
 from ultralytics import YOLO
 import supervision as sv
 from sklearn.metrics.pairwise import cosine_similarity
+from event_sink import EVENT_FLUSH_ROWS, EventSink, TeeEventSink, open_event_sink, concat_tables, read_table
+from result_store import RESULT_STORE_NAME, ResultStore
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -89,6 +91,7 @@ MIN_MATCHING_THRESHOLD = 0.80
 LOST_TRACK_BUFFER = 40
 FPS_FALLBACK = 25
 GRACE_SECONDS_DEFAULT = 30            # attendance off-tracking grace
+SHARD_TRACK_ID_OFFSET = 1_000_000     # shard k numbers its tracks from k * offset
 
 # =============================== UTILS ====================================== #
 
@@ -97,6 +100,10 @@ def ensure_dir(p: str): os.makedirs(p, exist_ok=True)
 def now_iso():
     return dt.datetime.now().replace(microsecond=0).isoformat()
 
+def session_epoch(session_start: str = "") -> float:
+    """Wall time (epoch seconds) of media second 0: the ISO session start, else now."""
+    return dt.datetime.fromisoformat(session_start).timestamp() if session_start else time.time()
+
 def sec_to_hms(s: float) -> str:
     s = int(max(0, s)); h = s // 3600; m = (s % 3600) // 60; s2 = s % 60
     return f"{h:02d}:{m:02d}:{s2:02d}"
@@ -145,6 +152,12 @@ def bbox_iou_xyxy(a: np.ndarray, b: np.ndarray) -> float:
     areaB = max(0, b[2]-b[0]) * max(0, b[3]-b[1])
     return inter / max(1e-6, (areaA + areaB - inter))
 
+def scale_detections(d: sv.Detections, sx: float, sy: float) -> sv.Detections:
+    """Map detections from a resized frame back to full-frame coordinates."""
+    if len(d) == 0 or (sx == 1.0 and sy == 1.0): return d
+    d.xyxy = d.xyxy * np.array([sx, sy, sx, sy], dtype=d.xyxy.dtype)
+    return d
+
 def crop_bbox(img: np.ndarray, box_xyxy) -> Optional[np.ndarray]:
     h, w = img.shape[:2]
     x1, y1, x2, y2 = [int(v) for v in box_xyxy]
@@ -169,6 +182,508 @@ def expand_box(box: np.ndarray, scale: float, W: int, H: int) -> np.ndarray:
     ny2 = min(H-1, cy + h/2.0)
     return np.array([nx1, ny1, nx2, ny2], dtype=float)
 
+def head_region(box: np.ndarray, W: int, H: int, frac: float = 0.5, pad: float = 0.1) -> np.ndarray:
+    """Upper `frac` of a person box (head + shoulders), widened by `pad` per side, clamped."""
+    x1, y1, x2, y2 = box.astype(float)
+    w, h = x2 - x1, y2 - y1
+    return np.array([max(0.0, x1 - pad * w), max(0.0, y1 - pad * h * frac),
+                     min(W - 1.0, x2 + pad * w), min(H - 1.0, y1 + frac * h)], dtype=float)
+
+# =============================== ASSOCIATION ================================ #
+# Pairwise box matrices computed once per frame (same arithmetic as iou / ioa / contains).
+# From `grid_min` target boxes on, only pairs sharing a BoxGrid cell are evaluated: every
+# pair with a positive overlap shares a cell, so results are identical to the dense path.
+
+GRID_MIN_BOXES = 150   # measured dense/grid crossover (bench-association, 6 boxes per person)
+
+class BoxGrid:
+    """Uniform grid over target boxes (cell = median box side), queried for candidate pairs."""
+    def __init__(self, boxes, cell: float = 0.0):
+        b = _as_boxes(boxes)
+        side = float(np.median(np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]))) if len(b) else 1.0
+        self.cell = float(cell) if cell > 0 else max(1.0, side)
+        self.boxes = b
+        keys, owner = self._cells(b)
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.owner = keys[order], owner[order]
+
+    def _cells(self, b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(cell key, box index) for every cell each box touches."""
+        c = self._cell_xy(b)
+        nx = np.maximum(1, c[:, 2] - c[:, 0] + 1); ny = np.maximum(1, c[:, 3] - c[:, 1] + 1)
+        cnt = nx * ny
+        owner = np.repeat(np.arange(len(b)), cnt)
+        k = np.arange(int(cnt.sum())) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        return self._key(c[owner, 0] + k % nx[owner], c[owner, 1] + k // nx[owner]), owner
+
+    def _cell_xy(self, v: np.ndarray) -> np.ndarray:
+        return np.floor(v.astype(np.float64) / self.cell).astype(np.int64)
+
+    @staticmethod
+    def _key(cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+        return ((cx + (1 << 20)) << 21) | (cy + (1 << 20))
+
+    def pairs(self, boxes) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (query index, target index) for every overlapping pair (plus some near misses), each pair
+        once: it is kept only in the cell holding the top-left corner of the intersection.
+        Query indices come out ascending.
+        """
+        q = _as_boxes(boxes)
+        keys, qowner = self._cells(q)
+        lo = np.searchsorted(self.keys, keys, "left"); cnt = np.searchsorted(self.keys, keys, "right") - lo
+        qi = np.repeat(qowner, cnt)
+        tj = self.owner[np.repeat(lo, cnt) + np.arange(int(cnt.sum())) - np.repeat(np.cumsum(cnt) - cnt, cnt)]
+        corner = self._cell_xy(np.maximum(q[qi, :2], self.boxes[tj, :2]))
+        own = self._key(corner[:, 0], corner[:, 1]) == np.repeat(keys, cnt)
+        return qi[own], tj[own]
+
+def _pair_inter(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Intersection areas of aligned box rows a[k], b[k]."""
+    iw = np.maximum(0.0, np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]))
+    ih = np.maximum(0.0, np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]))
+    return iw * ih
+
+def _pair_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    inter = _pair_inter(a, b)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]); area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return np.where(inter > 0, inter / (area_a + area_b - inter + 1e-6), 0.0)
+
+def _as_boxes(x) -> np.ndarray:
+    x = np.asarray(x)
+    return x.reshape(-1, 4) if x.size else np.zeros((0, 4), dtype=np.float32)
+
+def box_areas(b: np.ndarray) -> np.ndarray:
+    return np.maximum(0.0, b[:, 2] - b[:, 0]) * np.maximum(0.0, b[:, 3] - b[:, 1])
+
+def intersection_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """N x M intersection areas of boxes a (N x 4) and b (M x 4)."""
+    iw = np.maximum(0.0, np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]))
+    ih = np.maximum(0.0, np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]))
+    return iw * ih
+
+def iou_matrix(a, b, grid_min: int = 0) -> np.ndarray:
+    a, b = _as_boxes(a), _as_boxes(b)
+    if grid_min and len(b) >= grid_min and len(a):
+        i, j = BoxGrid(b).pairs(a)
+        out = np.zeros((len(a), len(b)), dtype=np.result_type(a, b, np.float32))
+        out[i, j] = _pair_iou(a[i], b[j])
+        return out
+    inter = intersection_matrix(a, b)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return np.where(inter > 0, inter / (area_a[:, None] + area_b[None, :] - inter + 1e-6), 0.0)
+
+def ioa_matrix(a, b) -> np.ndarray:
+    """[i, j] = share of box b[j] inside box a[i]."""
+    a, b = _as_boxes(a), _as_boxes(b)
+    area_b = np.maximum(1e-6, (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]))
+    return intersection_matrix(a, b) / area_b[None, :]
+
+def contains_matrix(a, b) -> np.ndarray:
+    a, b = _as_boxes(a), _as_boxes(b)
+    return ((a[:, None, 0] <= b[None, :, 0]) & (a[:, None, 1] <= b[None, :, 1])
+            & (a[:, None, 2] >= b[None, :, 2]) & (a[:, None, 3] >= b[None, :, 3]))
+
+def gate_boxes(persons, boxes, min_rel: np.ndarray, ioa_min: float, iou_min: float,
+               grid_min: int = 0) -> np.ndarray:
+    """
+    Keep mask over `boxes`: some person contains / covers (IoA) / overlaps (IoU) the box and
+    the box is at least `min_rel` (per box) of that person's area.
+    """
+    persons, boxes = _as_boxes(persons), _as_boxes(boxes)
+    if not len(persons) or not len(boxes): return np.zeros(len(boxes), dtype=bool)
+    if grid_min and len(persons) >= grid_min and ioa_min > 0 and iou_min > 0:
+        bi, pj = BoxGrid(persons).pairs(boxes)
+        p, b = persons[pj], boxes[bi]
+        inter = _pair_inter(p, b)
+        area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        geo = ((p[:, 0] <= b[:, 0]) & (p[:, 1] <= b[:, 1]) & (p[:, 2] >= b[:, 2]) & (p[:, 3] >= b[:, 3])
+               | (inter / np.maximum(1e-6, area_b) >= ioa_min) | (_pair_iou(p, b) >= iou_min))
+        rel = box_areas(b) / (box_areas(p) + 1e-6)
+        keep = np.zeros(len(boxes), dtype=bool)
+        keep[bi[geo & (rel >= np.asarray(min_rel)[bi])]] = True
+        return keep
+    geo = (contains_matrix(persons, boxes) | (ioa_matrix(persons, boxes) >= ioa_min)
+           | (iou_matrix(persons, boxes) >= iou_min))
+    rel = box_areas(boxes)[None, :] / (box_areas(persons)[:, None] + 1e-6)
+    return (geo & (rel >= np.asarray(min_rel)[None, :])).any(axis=0)
+
+def best_overlap(boxes, targets, grid_min: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Per box: index of the target with the highest IoU (-1 if none overlaps) and that IoU."""
+    boxes, targets = _as_boxes(boxes), _as_boxes(targets)
+    if grid_min and len(targets) >= grid_min and len(boxes):
+        qi, tj = BoxGrid(targets).pairs(boxes)
+        v = _pair_iou(boxes[qi], targets[tj])
+        j = np.full(len(boxes), -1, dtype=np.int64); best = np.zeros(len(boxes))
+        if not len(qi): return j, best
+        starts = np.flatnonzero(np.r_[True, qi[1:] != qi[:-1]])
+        gmax = np.maximum.reduceat(v, starts)
+        # per box: highest IoU, lowest target index on ties (like argmax over a dense row)
+        top = np.minimum.reduceat(np.where(v == np.repeat(gmax, np.diff(np.r_[starts, len(qi)])), tj, len(targets)),
+                                  starts)
+        ok = gmax > 0
+        j[qi[starts][ok]] = top[ok]; best[qi[starts]] = gmax
+        return j, best
+    ious = iou_matrix(boxes, targets)
+    if not ious.size: return np.full(len(ious), -1, dtype=np.int64), np.zeros(len(ious))
+    j = ious.argmax(axis=1)
+    best = ious[np.arange(len(ious)), j]
+    return np.where(best > 0, j, -1), best
+
+def hungarian_pairs(score: np.ndarray, min_score: float = 0.0) -> List[Tuple[int, int]]:
+    """One-to-one rows <-> columns maximizing the total score; pairs at or below `min_score` dropped."""
+    if not score.size: return []
+    from scipy.optimize import linear_sum_assignment
+    rows, cols = linear_sum_assignment(-score)
+    return [(int(r), int(c)) for r, c in zip(rows, cols) if score[r, c] > min_score]
+
+# =============================== INFERENCE BACKENDS ========================= #
+
+INFER_BACKENDS = ("torch", "onnx", "openvino")
+
+def file_digest(path: str, n: int = 12) -> str:
+    import hashlib
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()[:n]
+
+def module_digest(module: torch.nn.Module, n: int = 12) -> str:
+    import hashlib
+    h = hashlib.sha1()
+    for k, v in module.state_dict().items():
+        h.update(k.encode()); h.update(v.detach().cpu().numpy().tobytes())
+    return h.hexdigest()[:n]
+
+def export_yolo(model_path: str, backend: str, imgsz: int, cache_dir: str) -> str:
+    """
+    Weights to load for `backend`: the .pt itself for torch, else an ONNX file / OpenVINO IR
+    folder exported once into cache_dir (key: weights hash + imgsz). Falls back to the .pt
+    when the export toolchain is missing.
+    """
+    if backend == "torch": return model_path
+    import shutil
+    try:
+        weights = model_path if os.path.isfile(model_path) else YOLO(model_path).ckpt_path  # hub name -> download
+        ensure_dir(cache_dir)
+        key = f"{Path(model_path).stem}_{file_digest(weights)}_{int(imgsz)}"
+        target = os.path.join(cache_dir, key + (".onnx" if backend == "onnx" else "_openvino_model"))
+        if os.path.exists(target): return target
+        out = YOLO(weights).export(format=backend, imgsz=int(imgsz), dynamic=True, half=False, verbose=False)
+        shutil.move(str(out), target)
+        print(f"[Backend] Exported {model_path} -> {target}")
+        return target
+    except Exception as e:
+        print(f"[Backend] {backend} export of {model_path} failed ({e}); using torch")
+        return model_path
+
+class CompiledModule(torch.nn.Module):
+    """
+    Runs a torch module through ONNX Runtime / OpenVINO on CPU. The module is exported once
+    to <cache_dir>/<name>_<weights hash>_<input HxW>.onnx; OpenVINO also keeps its compiled
+    blobs in cache_dir. Eager torch when backend is "torch" or the runtime is unavailable.
+    Drop-in for the wrapped module (same outputs, torch tensors on the input device).
+    """
+    def __init__(self, module: torch.nn.Module, name: str, example_shape: Tuple[int, ...],
+                 backend: str, cache_dir: str, dynamic_hw: bool = False):
+        super().__init__()
+        self.eager = module.eval()
+        self.backend = "torch"; self._run = None
+        if backend == "torch": return
+        try:
+            self._run = self._build(name, example_shape, backend, cache_dir, dynamic_hw)
+            self.backend = backend
+            print(f"[Backend] {name}: {backend}")
+        except Exception as e:
+            print(f"[Backend] {name}: {backend} unavailable ({e}); using torch")
+
+    def _build(self, name, example_shape, backend, cache_dir, dynamic_hw):
+        import inspect
+        ensure_dir(cache_dir)
+        hw = "x".join(str(v) for v in example_shape[2:])
+        path = os.path.join(cache_dir, f"{name}_{module_digest(self.eager)}_{hw}.onnx")
+        if not os.path.exists(path):
+            dummy = torch.zeros(example_shape, device=next(self.eager.parameters()).device)
+            with torch.no_grad(): probe = self.eager(dummy)
+            probe = probe if isinstance(probe, tuple) else (probe,)
+            axes = lambda t: {0: "n", **({2: "h", 3: "w"} if dynamic_hw and t.dim() == 4 else {})}
+            outs = [f"out{i}" for i in range(len(probe))]
+            kw = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+            torch.onnx.export(self.eager, dummy, path, input_names=["input"], output_names=outs,
+                              dynamic_axes={"input": axes(dummy), **{o: axes(t) for o, t in zip(outs, probe)}},
+                              opset_version=17, **kw)
+        if backend == "onnx":
+            import onnxruntime as ort
+            sess = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+            return lambda x: sess.run(None, {"input": x})
+        import openvino as ov
+        core = ov.Core()
+        core.set_property({"CACHE_DIR": cache_dir})
+        compiled = core.compile_model(path, "CPU")
+        def run(x):
+            res = compiled(x)
+            return [res[o] for o in compiled.outputs]
+        return run
+
+    def forward(self, x: torch.Tensor):
+        if self._run is None or x.shape[0] == 0: return self.eager(x)
+        outs = [torch.from_numpy(np.ascontiguousarray(o)).to(x.device)
+                for o in self._run(x.detach().float().cpu().numpy())]
+        return outs[0] if len(outs) == 1 else tuple(outs)
+
+# =============================== FRAME SOURCES ============================== #
+
+class FrameSource:
+    """
+    Common interface of the pipeline's frame sources (selected by `source_backend`):
+      - fps / width / height describe the full-resolution stream
+      - iterating yields (frame_idx, frame_bgr, det_frame) for processed frames only;
+        det_frame is a downscaled copy for the detectors, or None to use frame_bgr
+      - det_scale is the (sx, sy) factor mapping det_frame boxes back to frame_bgr
+      - [start_frame, end_frame) restricts decoding to one time range (shards)
+    Frames are produced by _frames() on a background thread into a bounded queue
+    so decode overlaps with inference. prefetch=0 reads inline on the caller's thread.
+    """
+    _EOS = object()
+
+    def __init__(self, stride: int = 1, prefetch: int = 4,
+                 start_frame: int = 0, end_frame: Optional[int] = None):
+        self.stride = max(1, int(stride))
+        self.prefetch = max(0, int(prefetch))
+        self.start_frame = max(0, int(start_frame))
+        self.end_frame = end_frame
+        self.fps: float = FPS_FALLBACK
+        self.width = 0; self.height = 0
+        self.det_scale: Tuple[float, float] = (1.0, 1.0)
+        self.dynamic_stride = True   # _frames() re-reads self.stride for every frame
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def _frames(self):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        try:
+            for item in self._frames():
+                if not self._put(item): break
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._put(self._EOS)
+
+    def __iter__(self):
+        if self.prefetch == 0:
+            yield from self._frames()
+            return
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._thread = threading.Thread(target=self._worker, name="frame-decode", daemon=True)
+        self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is self._EOS: break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def hint_stride(self, stride: int):
+        """
+        Decode-side skipping for the adaptive stride. Only applied when reading
+        inline, where it takes effect exactly at the next frame; a prefetching
+        worker would apply it at a timing-dependent frame.
+        """
+        if self.dynamic_stride and self.prefetch == 0:
+            self.stride = max(1, int(stride))
+
+    def release(self):
+        self._stop.set()
+        self._close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class CaptureFrameSource(FrameSource):
+    """
+    cv2.VideoCapture backend. Stride-skipped frames are only grab()'d
+    (demuxed, never retrieved/converted); processed frames are read at full size.
+    """
+    def __init__(self, source: str, stride: int = 1, prefetch: int = 4,
+                 start_frame: int = 0, end_frame: Optional[int] = None):
+        super().__init__(stride, prefetch, start_frame, end_frame)
+        self.source = source
+        self.cap = cv2.VideoCapture(0 if source.isdigit() else source)
+        if not self.cap.isOpened():
+            raise RuntimeError(f"Cannot open source: {source}")
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 2)
+        if self.start_frame > 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+        real_fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = real_fps if real_fps and real_fps > 1 else FPS_FALLBACK
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def _frames(self):
+        idx, last = self.start_frame - 1, None
+        while not self._stop.is_set():
+            idx += 1
+            if self.end_frame is not None and idx >= self.end_frame: return
+            if last is not None and (idx - last) < self.stride:
+                if not self.cap.grab(): return
+                continue
+            ok, frame = self.cap.read()
+            if not ok: return
+            last = idx
+            yield idx, frame, None
+
+    def release(self):
+        super().release()
+        self.cap.release()
+
+class FFmpegFrameSource(FrameSource):
+    """
+    ffmpeg subprocess backend. Stride decimation (fps filter) and the detector
+    downscale (scale filter, long side = det_size) run inside the decoder.
+    Each output frame carries the full-resolution image (face crops, violation
+    clips, annotated video) stacked above the downscaled detector image, so one
+    rawvideo pipe serves both paths without a second decode.
+    """
+    def __init__(self, source: str, stride: int = 1, prefetch: int = 4,
+                 det_size: int = 640, ffmpeg_bin: str = "ffmpeg",
+                 start_frame: int = 0, end_frame: Optional[int] = None):
+        super().__init__(stride, prefetch, start_frame, end_frame)
+        import shutil
+        self.source = source
+        self.ffmpeg_bin = shutil.which(ffmpeg_bin) or ""
+        if not self.ffmpeg_bin:
+            raise RuntimeError(f"ffmpeg binary not found: {ffmpeg_bin}")
+        probe = cv2.VideoCapture(source)
+        if not probe.isOpened():
+            raise RuntimeError(f"Cannot open source: {source}")
+        real_fps = probe.get(cv2.CAP_PROP_FPS)
+        self.fps = real_fps if real_fps and real_fps > 1 else FPS_FALLBACK
+        self.width = int(probe.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        probe.release()
+
+        r = min(1.0, float(det_size) / max(1, self.width, self.height))
+        self.det_w = max(2, int(round(self.width * r / 2.0)) * 2) if r < 1.0 else self.width
+        self.det_h = max(2, int(round(self.height * r / 2.0)) * 2) if r < 1.0 else self.height
+        self.scaled = (self.det_w, self.det_h) != (self.width, self.height)
+        self.det_scale = (self.width / float(self.det_w), self.height / float(self.det_h))
+        self.dynamic_stride = False   # decimation is fixed in the filter graph
+        self.proc = None
+
+    def _command(self) -> List[str]:
+        out_fps = f"{self.fps / self.stride:.6f}"
+        if self.scaled:
+            graph = (f"[0:v]fps={out_fps},split=2[full][s];"
+                     f"[s]scale={self.det_w}:{self.det_h}:flags=area,pad={self.width}:{self.det_h}[det];"
+                     f"[full][det]vstack[out]")
+        else:
+            graph = f"[0:v]fps={out_fps}[out]"
+        cmd = [self.ffmpeg_bin, "-hide_banner", "-loglevel", "error", "-nostdin"]
+        if self.start_frame > 0:
+            cmd += ["-ss", f"{self.start_frame / self.fps:.6f}"]
+        cmd += ["-i", self.source, "-an", "-sn", "-dn",
+                "-filter_complex", graph, "-map", "[out]"]
+        if self.end_frame is not None:
+            n_out = max(0, -(-(self.end_frame - self.start_frame) // self.stride))
+            cmd += ["-frames:v", str(n_out)]
+        return cmd + ["-pix_fmt", "bgr24", "-f", "rawvideo", "pipe:1"]
+
+    def _read_exact(self, n: int) -> Optional[bytearray]:
+        buf = bytearray(n); view = memoryview(buf); got = 0
+        while got < n:
+            k = self.proc.stdout.readinto(view[got:])
+            if not k: return None
+            got += k
+        return buf
+
+    def _frames(self):
+        import subprocess
+        # stderr goes to a spool file rather than a pipe so a chatty ffmpeg can
+        # never block on a full stderr pipe while we only drain stdout
+        with tempfile.TemporaryFile() as err:
+            self.proc = subprocess.Popen(self._command(), stdout=subprocess.PIPE,
+                                         stderr=err, bufsize=0)
+            W, H = self.width, self.height
+            rows = H + (self.det_h if self.scaled else 0)
+            k = -1
+            while not self._stop.is_set():
+                buf = self._read_exact(W * rows * 3)
+                if buf is None: break
+                k += 1
+                img = np.frombuffer(buf, dtype=np.uint8).reshape(rows, W, 3)
+                det = np.ascontiguousarray(img[H:, :self.det_w]) if self.scaled else None
+                yield self.start_frame + k * self.stride, img[:H], det
+            rc = self.proc.wait()
+            # a kill from release() sets _stop first; any other nonzero exit is a
+            # decode failure, even after frames were delivered
+            if rc != 0 and not self._stop.is_set():
+                err.seek(0)
+                tail = err.read()[-2000:].decode("utf-8", "replace").strip()
+                raise RuntimeError(f"ffmpeg exited with code {rc} after {k + 1} frames "
+                                   f"for source: {self.source}\n{tail}")
+
+    def _close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+
+    def release(self):
+        super().release()
+        if self.proc is not None:
+            self.proc.wait()
+            if self.proc.stdout: self.proc.stdout.close()
+
+def open_frame_source(source: str, backend: str, stride: int, prefetch: int,
+                      det_size: int, ffmpeg_bin: str = "ffmpeg",
+                      start_frame: int = 0, end_frame: Optional[int] = None) -> FrameSource:
+    if backend == "ffmpeg":
+        if source.isdigit():
+            print("[Source] ffmpeg backend cannot open a webcam index — using opencv")
+        else:
+            return FFmpegFrameSource(source, stride, prefetch, det_size, ffmpeg_bin,
+                                     start_frame, end_frame)
+    return CaptureFrameSource(source, stride, prefetch, start_frame, end_frame)
+
+class MotionGate:
+    """
+    Cheap scene-change score for the adaptive stride: share of pixels whose
+    blurred, downscaled grey level moved by more than `pixel_delta` since the
+    reference (the last fully analysed frame).
+    """
+    def __init__(self, width: int = 160, pixel_delta: int = 12):
+        self.width = int(width); self.pixel_delta = int(pixel_delta)
+        self.ref: Optional[np.ndarray] = None
+        self._last: Optional[np.ndarray] = None
+
+    def score(self, frame_bgr: np.ndarray) -> float:
+        h, w = frame_bgr.shape[:2]
+        small = cv2.resize(frame_bgr, (self.width, max(1, int(h * self.width / max(1, w)))),
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        self._last = small
+        if self.ref is None or self.ref.shape != small.shape: return 1.0
+        diff = cv2.absdiff(small, self.ref)
+        return float(np.count_nonzero(diff > self.pixel_delta)) / diff.size
+
+    def set_reference(self):
+        self.ref = self._last
+
 # =============================== FACE ENGINE (TORCH) ======================== #
 
 class FaceEngineTorch:
@@ -178,23 +693,125 @@ class FaceEngineTorch:
       - Embedder: InceptionResnetV1 (GPU)
     Auto-downloads weights on first use (Torch Hub cache).
     """
-    def __init__(self, device: str = "cuda"):
+    def __init__(self, device: str = "cuda", backend: str = "torch", cache_dir: str = "model_cache"):
         self.device = "cuda" if (device == "cuda" and torch.cuda.is_available()) else "cpu"
         from facenet_pytorch import MTCNN, InceptionResnetV1
 
         self.mtcnn = MTCNN(image_size=160, margin=10, keep_all=True, post_process=True, device=self.device)
         self.embedder = InceptionResnetV1(pretrained='vggface2').eval().to(self.device)
-        print(f"[FaceEngineTorch] MTCNN + InceptionResnetV1 on {self.device}")
+        # identifies the embeddings this engine produces (gallery cache validity)
+        self.model_key = f"{module_digest(self.mtcnn, 8)}{module_digest(self.embedder, 8)}-{backend}"
+        if backend != "torch":
+            # P-Net runs on every pyramid scale (dynamic HxW); R/O-Net on fixed 24/48 crops
+            m = self.mtcnn
+            m.pnet = CompiledModule(m.pnet, "mtcnn_pnet", (1, 3, 64, 64), backend, cache_dir, dynamic_hw=True)
+            m.rnet = CompiledModule(m.rnet, "mtcnn_rnet", (1, 3, 24, 24), backend, cache_dir)
+            m.onet = CompiledModule(m.onet, "mtcnn_onet", (1, 3, 48, 48), backend, cache_dir)
+            self.embedder = CompiledModule(self.embedder, "facenet_vggface2", (1, 3, 160, 160), backend, cache_dir)
+        print(f"[FaceEngineTorch] MTCNN + InceptionResnetV1 on {self.device} ({getattr(self.embedder, 'backend', 'torch')})")
 
     def detect_and_embed(self, frame_bgr: np.ndarray) -> List[Dict]:
+        faces_crops, valid_idx = self.detect_crops(frame_bgr)
+        out = []
+        if not faces_crops: return out
+
+        embs = self.embed_crops(faces_crops)
+
+        for (x1,y1,x2,y2,blur), e in zip(valid_idx, embs):
+            out.append({
+                "bbox": [int(x1), int(y1), int(x2), int(y2)],
+                "emb": e.astype(np.float32),
+                "size": min(x2-x1, y2-y1),
+                "blur": float(blur),
+            })
+        return out
+
+    @staticmethod
+    def crops_to_tensor(faces_crops: List[np.ndarray]) -> torch.Tensor:
+        """160x160 RGB crops -> normalized N x 3 x 160 x 160 float tensor (CPU)."""
+        tens = torch.tensor(np.stack(faces_crops)).permute(0,3,1,2).float() / 255.0
+        return (tens - 0.5) / 0.5
+
+    def embed_crops(self, faces_crops: List[np.ndarray], batch_size: int = 64) -> np.ndarray:
+        """160x160 RGB crops -> L2-normalized N x 512 embeddings, `batch_size` crops per forward."""
+        if not faces_crops: return np.zeros((0, 512), dtype=np.float32)
+        embs = []
+        with torch.no_grad():
+            for i in range(0, len(faces_crops), batch_size):
+                tens = self.crops_to_tensor(faces_crops[i:i+batch_size]).to(self.device)
+                embs.append(self.embedder(tens).cpu().numpy())
+        embs = np.concatenate(embs, axis=0)
+        # L2 normalize
+        embs = embs / np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-9, None)
+        return embs.astype(np.float32)
+
+    def detect_crops(self, frame_bgr: np.ndarray) -> Tuple[List[np.ndarray], List[Tuple]]:
+        """MTCNN + quality gate -> (160x160 RGB crops, (x1,y1,x2,y2,blur) per crop)."""
         # BGR -> RGB
         img = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
         boxes, probs = self.mtcnn.detect(img)
+        return self._gate_faces(img, boxes, probs)
+
+    def detect_crops_batch(self, frames_bgr: List[np.ndarray], max_side: int = 0,
+                           max_pixels: int = 8_000_000) -> List[Tuple[List[np.ndarray], List[Tuple]]]:
+        """
+        detect_crops for many images: MTCNN over batches of equal-size images (at most
+        `max_pixels` per pass: the pyramid of large photos is memory hungry). With `max_side`,
+        detection runs on a downscaled copy and crops are still taken at full resolution.
+        """
+        imgs = [cv2.cvtColor(f, cv2.COLOR_BGR2RGB) for f in frames_bgr]
+        scales, dets = [], []
+        for img in imgs:
+            h, w = img.shape[:2]
+            sc = min(1.0, max_side / max(h, w)) if max_side else 1.0
+            scales.append(sc)
+            dets.append(cv2.resize(img, (round(w * sc), round(h * sc)), interpolation=cv2.INTER_AREA)
+                        if sc < 1.0 else img)
+        groups: Dict[Tuple[int, ...], List[int]] = defaultdict(list)
+        for i, d in enumerate(dets): groups[d.shape].append(i)
+        out: List = [None] * len(imgs)
+        for shape, idxs in groups.items():
+            per_pass = max(1, int(max_pixels // (shape[0] * shape[1])))
+            for k in range(0, len(idxs), per_pass):
+                part = idxs[k:k+per_pass]
+                batch_boxes, batch_probs = self.mtcnn.detect([dets[i] for i in part])
+                for i, boxes, probs in zip(part, batch_boxes, batch_probs):
+                    if boxes is not None and scales[i] < 1.0: boxes = boxes / scales[i]
+                    out[i] = self._gate_faces(imgs[i], boxes, probs)
+        return out
+
+    def detect_crops_regions(self, frame_bgr: np.ndarray, regions: List[np.ndarray],
+                             side: int = 224) -> List[Tuple[List[np.ndarray], List[Tuple]]]:
+        """
+        detect_crops restricted to frame regions (e.g. head areas of tracks): every region is
+        shrunk to fit `side` and zero-padded so all of them go through MTCNN in one batch; face
+        boxes come back in frame coordinates, crops are cut from the full-res region.
+        """
+        rgbs, dets, scales, offs = [], [], [], []
+        for r in regions:
+            x1, y1, x2, y2 = [int(v) for v in r]
+            rgb = cv2.cvtColor(frame_bgr[y1:y2+1, x1:x2+1], cv2.COLOR_BGR2RGB)
+            h, w = rgb.shape[:2]
+            sc = min(1.0, side / max(1, h, w))
+            small = cv2.resize(rgb, (max(1, round(w * sc)), max(1, round(h * sc))),
+                               interpolation=cv2.INTER_AREA) if sc < 1.0 else rgb
+            canvas = np.zeros((side, side, 3), dtype=np.uint8)
+            canvas[:small.shape[0], :small.shape[1]] = small
+            rgbs.append(rgb); dets.append(canvas); scales.append(sc); offs.append((x1, y1))
+        if not dets: return []
+        batch_boxes, batch_probs = self.mtcnn.detect(dets)
         out = []
-        if boxes is None: return out
+        for rgb, sc, (ox, oy), boxes, probs in zip(rgbs, scales, offs, batch_boxes, batch_probs):
+            crops, valid = self._gate_faces(rgb, None if boxes is None else boxes / sc, probs)
+            out.append((crops, [(x1+ox, y1+oy, x2+ox, y2+oy, b) for x1, y1, x2, y2, b in valid]))
+        return out
 
+    @staticmethod
+    def _gate_faces(img: np.ndarray, boxes, probs) -> Tuple[List[np.ndarray], List[Tuple]]:
         faces_crops = []
         valid_idx = []
+        if boxes is None: return faces_crops, valid_idx
+
         H, W = img.shape[:2]
         for i, (box, p) in enumerate(zip(boxes, probs)):
             if p is None or p < 0.90:  # stricter face confidence
@@ -210,92 +827,628 @@ class FaceEngineTorch:
                 continue
             faces_crops.append(cv2.resize(crop, (160,160)))
             valid_idx.append((x1,y1,x2,y2,blur))
+        return faces_crops, valid_idx
 
-        if not faces_crops: return out
-
-        tens = torch.tensor(np.stack(faces_crops)).permute(0,3,1,2).float() / 255.0
-        tens = (tens - 0.5) / 0.5
-        tens = tens.to(self.device)
-
-        with torch.no_grad():
-            embs = self.embedder(tens).cpu().numpy()
-
-        # L2 normalize
-        embs = embs / np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-9, None)
-
-        for (x1,y1,x2,y2,blur), e in zip(valid_idx, embs):
-            out.append({
-                "bbox": [int(x1), int(y1), int(x2), int(y2)],
-                "emb": e.astype(np.float32),
-                "size": min(x2-x1, y2-y1),
-                "blur": float(blur),
-            })
-        return out
+class FaceEmbedQueue:
+    """
+    Face crops collected across frames / tracks and embedded `batch_size` at a time (CPU
+    InceptionResnetV1 is far more efficient on 16-32 crops than on the 1-3 of a single frame).
+    A batch is also flushed once its oldest crop is `max_latency_frames` old, so live sources
+    get their IDs in bounded time. Flushing happens on the caller's thread: results stay
+    reproducible and follow frame order.
+    """
+    def __init__(self, face: "FaceEngineTorch", batch_size: int = 1, max_latency_frames: int = 12):
+        self.face = face
+        self.batch_size = max(1, int(batch_size))
+        self.max_latency_frames = max(0, int(max_latency_frames))
+        self.items: List[Tuple[int, int, np.ndarray, float]] = []   # (frame_idx, tid, crop, sim_thr)
+        self.batches = 0; self.embedded = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def put(self, frame_idx: int, tid: int, crop: np.ndarray, sim_thr: float):
+        self.items.append((frame_idx, tid, crop, sim_thr))
+
+    def due(self, frame_idx: int) -> bool:
+        return (len(self.items) >= self.batch_size
+                or (bool(self.items) and frame_idx - self.items[0][0] >= self.max_latency_frames))
+
+    def flush(self) -> Tuple[List[Tuple[int, int, float]], np.ndarray]:
+        """Embed everything queued -> ([(frame_idx, tid, sim_thr)], N x 512 embeddings)."""
+        items, self.items = self.items, []
+        if not items: return [], np.zeros((0, 512), dtype=np.float32)
+        embs = self.face.embed_crops([it[2] for it in items])
+        self.batches += 1; self.embedded += len(items)
+        return [(f, tid, thr) for f, tid, _, thr in items], embs
 
 # =============================== APPEARANCE (ReID-lite) ===================== #
 
+APPEARANCE_ARCHS = ("resnet50", "mobilenet_v3_large", "mobilenet_v3_small")
+
 class AppearanceEncoder:
-    def __init__(self, device: str):
+    """
+    Whole-body appearance vectors (ImageNet backbone, pooled features) for 128x256 person crops.
+    mobilenet_v3_* are ~10x cheaper than resnet50 on CPU. Preprocessing is cv2 resize + tensor ops.
+    """
+    SIZE = (128, 256)   # (w, h)
+
+    def __init__(self, device: str, backend: str = "torch", cache_dir: str = "model_cache",
+                 arch: str = "resnet50"):
         self.enabled = True
-        from torchvision import models, transforms
+        from torchvision import models
         self.device = device
-        self.transforms = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Resize((256, 128)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485,0.456,0.406], std=[0.229,0.224,0.225]),
-        ])
-        backbone = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
-        backbone.fc = torch.nn.Identity(); backbone.eval()
+        if arch == "resnet50":
+            backbone = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
+            backbone.fc = torch.nn.Identity()
+        elif arch in ("mobilenet_v3_large", "mobilenet_v3_small"):
+            weights = (models.MobileNet_V3_Large_Weights if arch.endswith("large")
+                       else models.MobileNet_V3_Small_Weights).IMAGENET1K_V1
+            backbone = getattr(models, arch)(weights=weights)
+            backbone.classifier = torch.nn.Identity()
+        else:
+            raise ValueError(f"unknown appearance arch: {arch}")
+        backbone.eval()
         if device.startswith('cuda'): backbone.to(device)
-        self.backbone = backbone
-        print("[Appearance] ResNet50 encoder loaded")
+        self.arch = arch
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) * 255.0
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) * 255.0
+        self.model_key = f"{arch}-{module_digest(backbone)}-{backend}"
+        w, h = self.SIZE
+        self.backbone = CompiledModule(backbone, f"{arch}_reid", (1, 3, h, w), backend, cache_dir)
+        print(f"[Appearance] {arch} encoder loaded")
+
+    def preprocess(self, bgrs: List[np.ndarray]) -> torch.Tensor:
+        """BGR crops -> normalized N x 3 x 256 x 128 RGB tensor (CPU)."""
+        x = torch.from_numpy(np.stack([cv2.resize(b, self.SIZE, interpolation=cv2.INTER_AREA) for b in bgrs]))
+        x = x.permute(0, 3, 1, 2).flip(1).float()   # NHWC BGR -> NCHW RGB
+        return (x - self.mean) / self.std
 
     def embed(self, bgr: np.ndarray) -> Optional[np.ndarray]:
         if bgr is None: return None
-        import torchvision
-        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-        tens = self.transforms(rgb).unsqueeze(0)
-        if self.device.startswith('cuda'): tens = tens.to(self.device)
+        return self.embed_batch([bgr])[0]
+
+    def embed_batch(self, bgrs: List[np.ndarray], batch_size: int = 32) -> List[Optional[np.ndarray]]:
+        """Appearance vectors for many crops, `batch_size` per forward pass (None for missing crops)."""
+        out: List[Optional[np.ndarray]] = [None] * len(bgrs)
+        valid = [i for i, b in enumerate(bgrs) if b is not None]
+        for s in range(0, len(valid), batch_size):
+            idx = valid[s:s+batch_size]
+            tens = self.preprocess([bgrs[i] for i in idx])
+            if self.device.startswith('cuda'): tens = tens.to(self.device)
+            with torch.no_grad():
+                feat = self.backbone(tens)
+            v = feat.detach().cpu().numpy().reshape(len(idx), -1)
+            v = v / np.clip(np.linalg.norm(v, axis=1, keepdims=True), 1e-9, None)
+            for i, row in zip(idx, v): out[i] = row.astype(np.float32)
+        return out
+
+# =============================== CPU PRECISION ============================== #
+
+CPU_PRECISIONS = ("fp32", "bf16", "int8")
+
+class BF16Autocast(torch.nn.Module):
+    """bf16 autocast on CPU (AMX / AVX512-BF16 hosts); fp32 in, fp32 out."""
+    def __init__(self, module: torch.nn.Module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            return self.module(x).float()
+
+def quantize_int8(module: torch.nn.Module, calib: torch.Tensor) -> torch.nn.Module:
+    """
+    Static post-training int8 (FX graph mode, x86 qconfig) calibrated on `calib`.
+    Falls back to dynamic int8 (Linear layers only) when the model does not trace.
+    """
+    import copy
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    m = copy.deepcopy(module).eval().cpu()
+    try:
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        prepared = prepare_fx(m, get_default_qconfig_mapping("x86"), example_inputs=(calib[:1],))
         with torch.no_grad():
-            feat = self.backbone(tens)
-        v = feat.detach().cpu().numpy().reshape(-1)
-        v = v / max(1e-9, np.linalg.norm(v))
-        return v.astype(np.float32)
+            for i in range(0, len(calib), 16): prepared(calib[i:i+16])
+        return convert_fx(prepared)
+    except Exception as e:
+        print(f"[Precision] static int8 failed ({e}); using dynamic int8 (Linear only)")
+        return quantize_dynamic(m, {torch.nn.Linear}, dtype=torch.qint8)
+
+def calibration_paths(students_dir: str, max_images: int = 96) -> List[str]:
+    """Up to `max_images` gallery photos (students/<ID>/*.jpg), spread evenly over the sorted list."""
+    paths = sorted(glob.glob(os.path.join(students_dir, "*", "*")))
+    step = max(1, len(paths) // max(1, max_images))
+    return paths[::step][:max_images]
+
+def gallery_calibration(face: FaceEngineTorch, appear: Optional[AppearanceEncoder],
+                        paths: List[str]) -> Tuple[torch.Tensor, List[str], Optional[torch.Tensor]]:
+    """Calibration inputs from gallery photos: face crops (+ owner IDs) and appearance tensors."""
+    face_crops, face_sids, app_tens = [], [], []
+    for p in paths:
+        img = cv2.imread(p)
+        if img is None: continue
+        crops, idx = face.detect_crops(img)
+        if crops:
+            best = max(range(len(crops)), key=lambda i: (min(idx[i][2]-idx[i][0], idx[i][3]-idx[i][1]), idx[i][4]))
+            face_crops.append(crops[best]); face_sids.append(os.path.basename(os.path.dirname(p)))
+        if appear is not None:
+            app_tens.append(img)
+    faces = FaceEngineTorch.crops_to_tensor(face_crops) if face_crops else torch.empty(0, 3, 160, 160)
+    return faces, face_sids, (appear.preprocess(app_tens) if app_tens else None)
+
+def holdout_split(n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Every third sample held out of calibration for the drift check (none below 2 samples)."""
+    k = np.arange(n)
+    held = k[k % 3 == 2] if n > 2 else k[1:]
+    return np.setdiff1d(k, held), held
+
+def _l2n(x: np.ndarray) -> np.ndarray:
+    return x / np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-9, None)
+
+def embedding_drift(ref: torch.nn.Module, test: torch.nn.Module, x: torch.Tensor,
+                    sids: Optional[List[str]] = None, sim_thr: float = 0.0,
+                    tmpl_x: Optional[torch.Tensor] = None, tmpl_sids: Optional[List[str]] = None) -> Dict:
+    """
+    Cosine(fp32, reduced) per held-out sample `x`. With `sids`, also counts the face_match
+    decisions on `x` (argmax ID over per-student mean templates of `tmpl_x`, >= sim_thr; each
+    model matches against its own templates) that differ.
+    """
+    with torch.no_grad():
+        a = _l2n(ref(x).float().numpy()); b = _l2n(test(x).float().numpy())
+    cos = (a * b).sum(axis=1)
+    out = {"samples": int(len(x)), "cos_mean": float(cos.mean()), "cos_min": float(cos.min())}
+    if sids and tmpl_sids:
+        keys = sorted(set(tmpl_sids))
+        def decide(model: torch.nn.Module, e: np.ndarray) -> List[Optional[str]]:
+            with torch.no_grad(): t = _l2n(model(tmpl_x).float().numpy())
+            tmpl = _l2n(np.stack([t[[i for i, s in enumerate(tmpl_sids) if s == k]].mean(axis=0) for k in keys]))
+            sims = e @ tmpl.T
+            return [keys[j] if sims[i, j] >= sim_thr else None for i, j in enumerate(sims.argmax(axis=1))]
+        out["decisions_changed"] = int(sum(d0 != d1 for d0, d1 in zip(decide(ref, a), decide(test, b))))
+    return out
+
+def _precision_cache(cache_dir: str, key: str, ref: torch.nn.Module, precision: str
+                     ) -> Tuple[Optional[Dict], Optional[torch.nn.Module]]:
+    """Cached drift report (+ reduced model when applied) for `key`, (None, None) on a miss."""
+    try:
+        with open(os.path.join(cache_dir, key + ".json"), "r", encoding="utf-8") as f:
+            r = json.load(f)
+        if not r["applied"]: return r, None
+        if precision == "bf16": return r, BF16Autocast(ref)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)   # torch.jit deprecation notice
+            return r, torch.jit.load(os.path.join(cache_dir, key + ".pt"), map_location="cpu")
+    except (OSError, ValueError, KeyError, RuntimeError):
+        return None, None
+
+def _save_precision_cache(cache_dir: str, key: str, r: Dict, reduced: torch.nn.Module,
+                          example: torch.Tensor, precision: str):
+    """Report (and traced int8 model) written under per-process temp names, then swapped in."""
+    ensure_dir(cache_dir)
+    def put(name: str, write):
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f: write(f)
+            os.replace(tmp, os.path.join(cache_dir, name))
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+    try:
+        if r["applied"] and precision == "int8":
+            with warnings.catch_warnings(), torch.no_grad():
+                warnings.simplefilter("ignore", FutureWarning)
+                traced = torch.jit.trace(reduced, example, check_trace=False)
+                put(key + ".pt", lambda f: torch.jit.save(traced, f))
+        put(key + ".json", lambda f: f.write(json.dumps(r).encode("utf-8")))
+    except Exception as e:
+        print(f"[Precision] not cached ({e})")
+
+def apply_cpu_precision(face: FaceEngineTorch, appear: Optional[AppearanceEncoder], precision: str,
+                        students_dir: str, sim_thr: float, min_cos: float = 0.98, cache_dir: str = "") -> Dict:
+    """
+    Swap the CPU face / appearance embedders for bf16-autocast or int8 versions calibrated on
+    gallery images; every third image is held out and only used for the drift check. A model
+    whose drift vs fp32 on the held-out images drops below `min_cos` (or that changes a face_match
+    decision on them) stays fp32. With `cache_dir`, the decision and the int8 model are cached
+    under the fp32 weights hash (as the ONNX exports) plus the calibration images' mtimes and
+    sizes, so later starts and shard workers skip calibration. Returns the drift report.
+    """
+    report: Dict[str, Dict] = {}
+    if precision == "fp32" or face.device != "cpu": return report
+    paths = calibration_paths(students_dir)
+    import hashlib
+    h = hashlib.sha1(f"{precision}|{min_cos}|{sim_thr}".encode())
+    for p in paths:
+        st = os.stat(p)
+        h.update(f"{os.path.relpath(p, students_dir)}|{st.st_mtime_ns}|{st.st_size}".encode())
+    stamp = h.hexdigest()[:12]
+    data = None   # calibration inputs, only loaded on a cache miss
+    targets = [("facenet", face, "embedder")] + ([("appearance", appear, "backbone")] if appear is not None else [])
+    for name, owner, attr in targets:
+        model = getattr(owner, attr)
+        wrapped = isinstance(model, CompiledModule)
+        if wrapped and model.backend != "torch":
+            print(f"[Precision] {name}: {model.backend} runtime, {precision} skipped"); continue
+        ref = model.eager if wrapped else model
+        key = f"precision_{name}_{module_digest(ref)}_{precision}_{stamp}"
+        r, reduced = _precision_cache(cache_dir, key, ref, precision) if cache_dir else (None, None)
+        if r is not None and (reduced is not None or not r["applied"]):
+            print(f"[Precision] {name} {precision}: cached decision ({'applied' if r['applied'] else 'fp32'})")
+        else:
+            if data is None: data = gallery_calibration(face, appear, paths)
+            faces, sids, apps = data
+            x, x_sids = (faces, sids) if name == "facenet" else (apps, None)
+            if x is None or len(x) < 2:
+                print(f"[Precision] {name}: fewer than 2 calibration images in {students_dir}, stays fp32"); continue
+            cal, held = holdout_split(len(x))
+            reduced = BF16Autocast(ref) if precision == "bf16" else quantize_int8(ref, x[cal])
+            r = embedding_drift(ref, reduced, x[held], [x_sids[i] for i in held] if x_sids else None, sim_thr,
+                                x[cal], [x_sids[i] for i in cal] if x_sids else None)
+            r["applied"] = r["cos_min"] >= min_cos and not r.get("decisions_changed", 0)
+            print(f"[Precision] {name} {precision}: cos mean {r['cos_mean']:.4f} min {r['cos_min']:.4f} "
+                  f"on {r['samples']} held-out samples" + (f", match decisions changed {r['decisions_changed']}"
+                                                           if "decisions_changed" in r else "")
+                  + ("" if r["applied"] else " -> drift too large, keeping fp32"))
+            if cache_dir: _save_precision_cache(cache_dir, key, r, reduced, x[:1], precision)
+        report[name] = r
+        if not r["applied"]: continue
+        if wrapped: model.eager = reduced
+        else: setattr(owner, attr, reduced)
+        owner.model_key += f"-{precision}"
+    return report
 
 # =============================== GALLERY ==================================== #
 
+class GalleryCache:
+    """
+    Per-image gallery embeddings on disk, valid for one model key:
+      index.json      rel path -> mtime_ns, size, face row, face weight, appearance row
+      face.npy        N x 512 face embeddings      (memory-mapped on load)
+      appearance.npy  M x D appearance embeddings  (memory-mapped on load)
+    Rows are -1 for images without a face / appearance vector. Only images seen by the
+    last load are kept, so deleted images drop out on the next save; a load scoped to some
+    students keeps the entries of all others untouched. Several processes (shard / pool
+    workers) may load the same gallery: one writer at a time holds `lock`, writes per-process
+    temp files and swaps them in; an index whose row counts don't match the matrices is ignored.
+    """
+    VERSION = 2
+    LOCK_STALE_SEC = 300.0   # lock left by a crashed writer
+
+    def __init__(self, cache_dir: str, root: str, model_key: str):
+        self.dir, self.root, self.model_key = cache_dir, root, model_key
+        self.entries: Dict[str, Dict] = {}
+        self.face: Optional[np.ndarray] = None
+        self.app: Optional[np.ndarray] = None
+        self.seen: Dict[str, Tuple[Optional[np.ndarray], float, Optional[np.ndarray], Tuple[int, int]]] = {}
+        self.hits = self.misses = 0
+        try:
+            with open(os.path.join(cache_dir, "index.json"), "r", encoding="utf-8") as f:
+                idx = json.load(f)
+            if idx.get("version") == self.VERSION and idx.get("model_key") == model_key:
+                self.entries = idx["entries"]
+                if os.path.exists(os.path.join(cache_dir, "face.npy")):
+                    self.face = np.load(os.path.join(cache_dir, "face.npy"), mmap_mode="r")
+                if os.path.exists(os.path.join(cache_dir, "appearance.npy")):
+                    self.app = np.load(os.path.join(cache_dir, "appearance.npy"), mmap_mode="r")
+                rows = (len(self.face) if self.face is not None else 0, len(self.app) if self.app is not None else 0)
+                if rows != tuple(idx["rows"]):   # matrices from another save than the index
+                    print(f"[Gallery] cache {cache_dir} inconsistent, rebuilding")
+                    self.entries, self.face, self.app = {}, None, None
+            else:
+                print(f"[Gallery] cache {cache_dir} built for other models, rebuilding")
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def _key(self, path: str) -> Tuple[str, Tuple[int, int]]:
+        st = os.stat(path)
+        return os.path.relpath(path, self.root).replace(os.sep, "/"), (st.st_mtime_ns, st.st_size)
+
+    def get(self, path: str) -> Optional[Tuple[Optional[np.ndarray], float, Optional[np.ndarray]]]:
+        rel, stamp = self._key(path)
+        e = self.entries.get(rel)
+        if e is None or (e["mtime_ns"], e["size"]) != stamp:
+            self.misses += 1
+            return None
+        face, app = self._vectors(e)
+        self.seen[rel] = (face, e["weight"], app, stamp); self.hits += 1
+        return face, e["weight"], app
+
+    def _vectors(self, e: Dict) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        # copies, so no row handed out keeps the memory maps (and the files, on Windows) open
+        face = np.array(self.face[e["face"]]) if e["face"] >= 0 and self.face is not None else None
+        app = np.array(self.app[e["app"]]) if e["app"] >= 0 and self.app is not None else None
+        return face, app
+
+    def put(self, path: str, face: Optional[np.ndarray], weight: float, app: Optional[np.ndarray]):
+        rel, stamp = self._key(path)
+        self.seen[rel] = (face, weight, app, stamp)
+
+    def save(self, scope: Optional[Iterable[str]] = None):
+        """
+        Rewrite the cache from the images seen by this load (skipped when nothing changed).
+        `scope`: the student folders that load scanned; entries of other folders are carried over.
+        """
+        if scope is not None:
+            scope = set(scope)
+            for rel, e in self.entries.items():
+                if rel.split("/")[0] not in scope and rel not in self.seen:
+                    face, app = self._vectors(e)
+                    self.seen[rel] = (face, e["weight"], app, (e["mtime_ns"], e["size"]))
+        if not self.misses and set(self.seen) == set(self.entries): return
+        ensure_dir(self.dir)
+        if not self._lock():
+            print(f"[Gallery] cache {self.dir} is being written by another process, not saving")
+            return
+        try:
+            self._write()
+        finally:
+            os.remove(os.path.join(self.dir, "lock"))
+
+    def _lock(self) -> bool:
+        path = os.path.join(self.dir, "lock")
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < self.LOCK_STALE_SEC: return False
+                    os.remove(path)
+                except OSError:
+                    pass
+        return False
+
+    def _replace(self, name: str, write):
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f: write(f)
+            os.replace(tmp, os.path.join(self.dir, name))
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+
+    def _write(self):
+        entries, faces, apps = {}, [], []
+        for rel in sorted(self.seen):
+            face, weight, app, (mtime_ns, size) = self.seen[rel]
+            entries[rel] = {"mtime_ns": mtime_ns, "size": size, "weight": float(weight),
+                            "face": len(faces) if face is not None else -1,
+                            "app": len(apps) if app is not None else -1}
+            if face is not None: faces.append(np.asarray(face, dtype=np.float32))
+            if app is not None: apps.append(np.asarray(app, dtype=np.float32))
+        mats = [("face.npy", np.stack(faces) if faces else None),
+                ("appearance.npy", np.stack(apps) if apps else None)]
+        rows = [len(faces), len(apps)]
+        # rows were copied out of the maps (_vectors): drop the maps before replacing the files
+        self.face = self.app = None; self.seen.clear(); faces.clear(); apps.clear()
+        for name, mat in mats:
+            if mat is not None:
+                self._replace(name, lambda f, mat=mat: np.save(f, mat))
+            elif os.path.exists(os.path.join(self.dir, name)):
+                os.remove(os.path.join(self.dir, name))
+        index = {"version": self.VERSION, "model_key": self.model_key, "rows": rows, "entries": entries}
+        self._replace("index.json", lambda f: f.write(json.dumps(index).encode("utf-8")))
+
+class GalleryIndex:
+    """
+    Face templates as one contiguous L2-normalized matrix (float32, or float16 to halve memory),
+    matched with one batched dot product for all faces of a frame. From `ann_min` identities on,
+    an approximate index returns the top-k candidates instead: faiss HNSW or hnswlib when
+    installed, else a numpy IVF (spherical k-means lists, `nprobe` probed, exact re-ranking).
+    search(exact_below=thr) re-checks with the exact matrix every query whose approximate best
+    is below its match threshold, so a missed list costs one exact search, not a wrong "unknown".
+    """
+    def __init__(self, keys: List[str], mat: np.ndarray, fp16: bool = False,
+                 ann_min: int = 20000, nprobe: int = 16):
+        self.keys = list(keys)
+        m = np.ascontiguousarray(mat, dtype=np.float32)
+        m = m.reshape(len(self.keys), m.shape[-1] if m.ndim > 1 else -1)
+        m = m / np.clip(np.linalg.norm(m, axis=1, keepdims=True), 1e-9, None)
+        self.mat = m.astype(np.float16) if fp16 else m
+        self.kind = "exact"
+        self._ann = None
+        if ann_min > 0 and len(self.keys) >= ann_min:
+            self._build_ann(m, nprobe)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    # ---- build ----
+    def _build_ann(self, m: np.ndarray, nprobe: int):
+        try:
+            import faiss
+            index = faiss.IndexHNSWFlat(m.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = 64
+            index.add(m)
+            self._ann, self.kind = index, "faiss-hnsw"
+            return
+        except ImportError:
+            pass
+        try:
+            import hnswlib
+            index = hnswlib.Index(space="ip", dim=m.shape[1])
+            index.init_index(max_elements=len(m), ef_construction=200, M=32)
+            index.add_items(m)
+            index.set_ef(64)
+            self._ann, self.kind = index, "hnswlib"
+            return
+        except ImportError:
+            pass
+        self._ann, self.kind = self._build_ivf(m, nprobe), "ivf"
+
+    @staticmethod
+    def _build_ivf(m: np.ndarray, nprobe: int, iters: int = 10):
+        n = len(m)
+        nlist = min(n, max(1, int(round(4 * math.sqrt(n)))))
+        rng = np.random.default_rng(0)
+        train = m[rng.choice(n, min(n, 64 * nlist), replace=False)]
+        cent = train[rng.choice(len(train), nlist, replace=False)].copy()
+        for _ in range(iters):   # spherical k-means on a sample
+            assign = np.argmax(train @ cent.T, axis=1)
+            sums = np.zeros_like(cent); np.add.at(sums, assign, train)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            sums[empty] = cent[empty]
+            cent = sums / np.clip(np.linalg.norm(sums, axis=1, keepdims=True), 1e-9, None)
+        assign = np.concatenate([np.argmax(m[i:i+65536] @ cent.T, axis=1) for i in range(0, n, 65536)])
+        order = np.argsort(assign, kind="stable")
+        offsets = np.searchsorted(assign[order], np.arange(nlist + 1))
+        return cent.astype(np.float32), order, offsets, min(nprobe, nlist)
+
+    # ---- search ----
+    def _dot(self, q: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        mat = self.mat if rows is None else self.mat[rows]
+        if mat.dtype == np.float32: return q @ mat.T
+        # numpy has no fp16 BLAS: widen in chunks
+        return np.concatenate([q @ mat[i:i+16384].astype(np.float32).T
+                               for i in range(0, len(mat), 16384)], axis=1)
+
+    @staticmethod
+    def _topk(sims: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, sims.shape[1])
+        idx = np.argpartition(-sims, k - 1, axis=1)[:, :k] if k < sims.shape[1] else np.tile(np.arange(k), (len(sims), 1))
+        top = np.take_along_axis(sims, idx, axis=1)
+        o = np.argsort(-top, axis=1)
+        return np.take_along_axis(idx, o, axis=1), np.take_along_axis(top, o, axis=1)
+
+    def search(self, q: np.ndarray, k: int = 1, exact_below=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        q: M x D -> (M x k template indices, M x k cosine sims), best first; -1 / -inf padding.
+        exact_below: threshold (scalar or per query); approximate results below it are redone exactly.
+        """
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.mat.shape[1])
+        q = q / np.clip(np.linalg.norm(q, axis=1, keepdims=True), 1e-9, None)
+        I = np.full((len(q), k), -1, dtype=np.int64); S = np.full((len(q), k), -np.inf, dtype=np.float32)
+        if not len(self.keys) or not len(q): return I, S
+        if self.kind == "exact":
+            idx, top = self._topk(self._dot(q), k)
+            I[:, :idx.shape[1]] = idx; S[:, :idx.shape[1]] = top
+        elif self.kind == "faiss-hnsw":
+            D, J = self._ann.search(q, k)
+            I[:], S[:] = J, np.where(J >= 0, D, -np.inf)
+        elif self.kind == "hnswlib":
+            J, D = self._ann.knn_query(q, k=min(k, len(self.keys)))
+            I[:, :J.shape[1]] = J; S[:, :J.shape[1]] = 1.0 - D
+        else:
+            cent, order, offsets, nprobe = self._ann
+            probes = np.argpartition(-(q @ cent.T), nprobe - 1, axis=1)[:, :nprobe]
+            for r in range(len(q)):
+                cand = np.concatenate([order[offsets[c]:offsets[c+1]] for c in probes[r]])
+                if not len(cand): continue
+                idx, top = self._topk(self._dot(q[r:r+1], cand), k)
+                I[r, :idx.shape[1]] = cand[idx[0]]; S[r, :idx.shape[1]] = top[0]
+        if exact_below is not None and self.kind != "exact":
+            redo = np.flatnonzero(S[:, 0] < np.broadcast_to(np.asarray(exact_below, dtype=np.float32), (len(q),)))
+            if len(redo):
+                idx, top = self._topk(self._dot(q[redo]), k)
+                I[redo, :idx.shape[1]] = idx; S[redo, :idx.shape[1]] = top
+        return I, S
+
 class StudentGallery:
     """
     students/<ID>/*.jpg
     Uses FaceEngineTorch embeddings to build ID templates.
+    With `cache_dir`, per-image embeddings are cached (GalleryCache) and only new or
+    changed images are embedded again. `allowed` restricts loading and matching to those
+    student IDs (e.g. the students enrolled in the session's unit).
+    Appearance matches are only accepted above `appear_floor`, the 99th percentile of the best
+    other-student similarity of the gallery photos (see calibrate_appearance).
     """
-    def __init__(self, face_engine: FaceEngineTorch, students_dir: str, appearance: Optional['AppearanceEncoder']=None):
+    def __init__(self, face_engine: FaceEngineTorch, students_dir: str, appearance: Optional['AppearanceEncoder']=None,
+                 cache_dir: Optional[str] = None, batch_size: int = 32, decode_workers: int = 4,
+                 detect_side: int = 0, rebuild: bool = False,
+                 fp16: bool = False, ann_min: int = 20000, ann_nprobe: int = 16,
+                 allowed: Optional[Iterable[str]] = None):
         self.face_engine = face_engine
         self.students_dir = students_dir
         self.appearance = appearance
+        self.cache_dir = cache_dir
+        self.batch_size = max(1, int(batch_size))
+        self.decode_workers = max(1, int(decode_workers))
+        self.detect_side = max(0, int(detect_side))   # enrolment face detection on <= this side (0 = full res)
+        self.rebuild = rebuild   # ignore cached vectors (full re-enrolment)
+        self.index_opts = dict(fp16=fp16, ann_min=ann_min, nprobe=ann_nprobe)
+        self.allowed = set(allowed) if allowed else None
+        self.index = GalleryIndex([], np.zeros((0, 512), dtype=np.float32))
+        self.appear_index = GalleryIndex([], np.zeros((0, 1), dtype=np.float32))
         self.face_embs: Dict[str, np.ndarray] = {}
         self.appear_embs: Dict[str, np.ndarray] = {}
+        self.appear_floor = 0.0
+        self.appear_calibration: Dict[str, float] = {}
         self.load()
 
+    def _embed_paths(self, paths: List[str]) -> Dict[str, Tuple[Optional[np.ndarray], float, Optional[np.ndarray]]]:
+        """
+        Bulk enrolment: images decoded on a thread pool (next chunk while this one runs),
+        MTCNN on same-size batches, then the best face crop per image and the appearance
+        inputs embedded in large batches. -> path: (face emb | None, blur weight, appearance | None)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        out: Dict[str, Tuple[Optional[np.ndarray], float, Optional[np.ndarray]]] = {}
+        if not paths: return out
+        t0 = time.time()
+        fe = self.face_engine
+        chunks = [paths[i:i+self.batch_size] for i in range(0, len(paths), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as pool:
+            pending = [pool.submit(cv2.imread, p) for p in chunks[0]]
+            for ci, chunk in enumerate(chunks):
+                imgs = [f.result() for f in pending]
+                if ci + 1 < len(chunks):
+                    pending = [pool.submit(cv2.imread, p) for p in chunks[ci + 1]]
+                ok = [(p, img) for p, img in zip(chunk, imgs) if img is not None]
+                best = []   # (path, crop, weight): largest, then sharpest face per image
+                for (p, _), (crops, idx) in zip(ok, fe.detect_crops_batch([img for _, img in ok], self.detect_side)):
+                    if not crops: continue
+                    j = max(range(len(crops)), key=lambda k: (min(idx[k][2]-idx[k][0], idx[k][3]-idx[k][1]), idx[k][4]))
+                    best.append((p, crops[j], max(1.0, idx[j][4])))
+                faces = {p: (e, w) for (p, _, w), e in
+                         zip(best, fe.embed_crops([c for _, c, _ in best], self.batch_size))}
+                apps = (self.appearance.embed_batch([img for _, img in ok], self.batch_size)
+                        if self.appearance else [None] * len(ok))
+                for (p, _), app in zip(ok, apps):
+                    emb, weight = faces.get(p, (None, 0.0))
+                    out[p] = (emb, weight, app)
+        sec = time.time() - t0
+        print(f"[Gallery] embedded {len(out)} images in {sec:.1f}s ({len(out) / max(sec, 1e-9):.1f} img/s)")
+        return out
+
     def load(self):
         self.face_embs.clear(); self.appear_embs.clear()
+        t0 = time.time()
+        cache = None
+        if self.cache_dir:
+            key = (self.face_engine.model_key + (f"|{self.appearance.model_key}" if self.appearance else "|noapp")
+                   + (f"|det{self.detect_side}" if self.detect_side else ""))
+            cache = GalleryCache(self.cache_dir, self.students_dir, key)
+            if self.rebuild: cache.entries = {}
         subdirs = [d for d in glob.glob(os.path.join(self.students_dir, '*')) if os.path.isdir(d)]
         if not subdirs:
             print(f"[Gallery] No student folders in {self.students_dir}")
-        for d in sorted(subdirs):
-            sid = os.path.basename(d).strip()
+        if self.allowed is not None:
+            subdirs = [d for d in subdirs if os.path.basename(d).strip() in self.allowed]
+            missing = self.allowed - {os.path.basename(d).strip() for d in subdirs}
+            print(f"[Gallery] scoped to {len(self.allowed)} students"
+                  + (f" ({len(missing)} without a gallery folder)" if missing else ""))
+        per_sid = [(os.path.basename(d).strip(), sorted(glob.glob(os.path.join(d, '*')))) for d in sorted(subdirs)]
+        recs = {}
+        for _, paths in per_sid:
+            for p in paths:
+                rec = cache.get(p) if cache is not None else None
+                if rec is not None: recs[p] = rec
+        fresh = self._embed_paths([p for _, paths in per_sid for p in paths if p not in recs])
+        for p, rec in fresh.items():
+            if cache is not None: cache.put(p, *rec)
+        recs.update(fresh)
+        app_by_sid: Dict[str, List[np.ndarray]] = {}
+        for sid, paths in per_sid:
             face_vecs, face_weights, app_vecs = [], [], []
-            for p in glob.glob(os.path.join(d, '*')):
-                img = cv2.imread(p)
-                if img is None: continue
-                faces = self.face_engine.detect_and_embed(img)
-                if faces:
-                    f = max(faces, key=lambda x: (x["size"], x["blur"]))
-                    face_vecs.append(f["emb"]); face_weights.append(max(1.0, f["blur"]))
-                if self.appearance:
-                    app = self.appearance.embed(img)
-                    if app is not None: app_vecs.append(app)
+            for p in paths:
+                if p not in recs: continue   # unreadable image
+                face, weight, app = recs[p]
+                if face is not None:
+                    face_vecs.append(face); face_weights.append(weight)
+                if app is not None and self.appearance:
+                    app_vecs.append(app)
             if face_vecs:
                 w = np.array(face_weights) / max(1e-9, sum(face_weights))
                 mean_face = np.average(np.stack(face_vecs, axis=0), axis=0, weights=w)
@@ -305,40 +1458,114 @@ class StudentGallery:
                 mean_app = np.mean(np.stack(app_vecs, axis=0), axis=0)
                 mean_app = mean_app / max(1e-9, np.linalg.norm(mean_app))
                 self.appear_embs[sid] = mean_app.astype(np.float32)
+                app_by_sid[sid] = app_vecs
             if face_vecs or app_vecs:
                 print(f"[Gallery] {sid}: faces={len(face_vecs)} appearance={len(app_vecs)}")
+        if cache is not None:
+            cache.save(scope=[os.path.basename(d) for d in subdirs] if self.allowed is not None else None)
+            print(f"[Gallery] cache {self.cache_dir}: {cache.hits} cached, {cache.misses} embedded "
+                  f"({time.time() - t0:.1f}s)")
         if not self.face_embs:
             print("[Gallery] WARNING: empty face gallery — using Tracker IDs as provisional IDs")
+        self.calibrate_appearance(app_by_sid)
+        self._build_index()
 
-    def face_match(self, emb: np.ndarray, sim_thr: float) -> Optional[Tuple[str, float]]:
-        if not self.face_embs: return None
+    def calibrate_appearance(self, app_by_sid: Dict[str, List[np.ndarray]]):
+        """
+        Same-student vs other-student appearance similarity of the gallery photos: each photo
+        against its own student's template without it (leave-one-out) and against the best
+        other template. ImageNet features after ReLU are mostly non-negative, so unrelated people
+        often score above 0.6; appear_floor = 99th percentile of the other-student scores.
+        """
+        self.appear_floor, self.appear_calibration = 0.0, {}
+        if len(app_by_sid) < 2: return
+        sids = sorted(app_by_sid)
+        vecs = [_l2n(np.stack(app_by_sid[sid]).astype(np.float32)) for sid in sids]
+        sums = np.stack([v.sum(axis=0) for v in vecs])
+        tmpl = _l2n(sums)
+        same, other = [], []
+        for k, v in enumerate(vecs):
+            sims = v @ tmpl.T
+            sims[:, k] = -np.inf
+            other.extend(sims.max(axis=1).tolist())
+            if len(v) > 1:   # leave-one-out template of the own student
+                same.extend((v * _l2n(sums[k] - v)).sum(axis=1).tolist())
+        other_a = np.array(other)
+        self.appear_floor = float(np.quantile(other_a, 0.99))
+        self.appear_calibration = {"other_p50": float(np.median(other_a)), "other_p99": self.appear_floor,
+                                   "other_max": float(other_a.max()), "photos": len(other)}
+        msg = f"other-student median {np.median(other_a):.3f} p99 {self.appear_floor:.3f}"
+        if same:
+            same_a = np.array(same)
+            self.appear_calibration.update(same_p05=float(np.quantile(same_a, 0.05)), same_p50=float(np.median(same_a)))
+            msg = f"same-student median {np.median(same_a):.3f} p5 {np.quantile(same_a, 0.05):.3f}, " + msg
+        print(f"[Gallery] appearance similarity on {len(other)} photos: {msg} -> matches need >= {self.appear_floor:.3f}")
+
+    def subset(self, allowed: Iterable[str]) -> "StudentGallery":
+        """Gallery restricted to `allowed` IDs, sharing this one's templates (no image is re-read)."""
+        import copy
+        g = copy.copy(self)
+        g.allowed = set(allowed)
+        g.face_embs = {k: v for k, v in self.face_embs.items() if k in g.allowed}
+        g.appear_embs = {k: v for k, v in self.appear_embs.items() if k in g.allowed}
+        g._build_index()
+        print(f"[Gallery] scoped to {len(g.allowed)} students: {len(g.face_embs)} face / "
+              f"{len(g.appear_embs)} appearance templates")
+        return g
+
+    def _build_index(self):
         keys = list(self.face_embs.keys())
-        mats = np.stack([self.face_embs[k] for k in keys], axis=0)
-        sims = cosine_similarity(emb.reshape(1,-1), mats).flatten()
-        bi = int(np.argmax(sims))
-        if float(sims[bi]) >= sim_thr:
-            return keys[bi], float(sims[bi])
-        return None
+        self.index = GalleryIndex(keys, np.stack([self.face_embs[k] for k in keys]) if keys
+                                  else np.zeros((0, 512), dtype=np.float32), **self.index_opts)
+        if self.index.kind != "exact":
+            print(f"[Gallery] {len(keys)} identities: {self.index.kind} index")
+        akeys = list(self.appear_embs.keys())
+        self.appear_index = GalleryIndex(akeys, np.stack([self.appear_embs[k] for k in akeys]) if akeys
+                                         else np.zeros((0, 1), dtype=np.float32), ann_min=0)
+
+    def face_match(self, emb: np.ndarray, sim_thr: float) -> Optional[Tuple[str, float]]:
+        return self.face_match_batch(emb.reshape(1, -1), [sim_thr])[0]
+
+    def face_match_batch(self, embs: np.ndarray, sim_thrs: List[float]) -> List[Optional[Tuple[str, float]]]:
+        """Best identity per face (one matrix product for all faces of a frame), None below its threshold."""
+        if not len(self.index) or not len(embs): return [None] * len(embs)
+        I, S = self.index.search(embs, k=1, exact_below=sim_thrs)
+        return [(self.index.keys[i], float(sim)) if i >= 0 and sim >= thr else None
+                for i, sim, thr in zip(I[:, 0], S[:, 0], sim_thrs)]
+
+    def appear_match(self, emb: np.ndarray, sim_thr: float) -> Optional[Tuple[str, float]]:
+        """Best identity by whole-body appearance (fallback when no face is usable), >= max(sim_thr, appear_floor)."""
+        if not len(self.appear_index): return None
+        I, S = self.appear_index.search(emb.reshape(1, -1), k=1)
+        i, sim = int(I[0, 0]), float(S[0, 0])
+        return (self.appear_index.keys[i], sim) if i >= 0 and sim >= max(sim_thr, self.appear_floor) else None
+
+    def face_topk(self, emb: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        """k most similar identities (no threshold), best first."""
+        I, S = self.index.search(emb.reshape(1, -1), k)
+        return [(self.index.keys[i], float(sim)) for i, sim in zip(I[0], S[0]) if i >= 0]
 
 # =============================== ATTENDANCE BOOK ============================ #
 
 class AttendanceBook:
-    def __init__(self, grace_seconds: int, events_path: str):
+    """
+    Enter/exit intervals per student. Times are media seconds with `epoch` set to the
+    wall time that media second 0 maps to (class time), or wall-clock seconds with epoch 0.
+    """
+    EVENT_COLUMNS = {"student_id": "str", "enter_iso": "str", "exit_iso": "str", "duration_sec": "float"}
+
+    def __init__(self, grace_seconds: int, events: EventSink, epoch: float = 0.0):
         self.grace = grace_seconds
+        self.epoch = float(epoch)
         self.live: Dict[str, Dict] = {}
         self.intervals: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
-        self.events_path = events_path
-        ensure_dir(os.path.dirname(events_path))
-        if not os.path.exists(events_path):
-            with open(events_path, 'w', newline='', encoding='utf-8') as f:
-                csv.writer(f).writerow(["student_id", "enter_iso", "exit_iso", "duration_sec"])
+        self.events = events   # attendance_events table (close() after close_all())
 
     def _flush(self, sid: str, start: float, end: float):
         self.intervals[sid].append((start, end))
-        with open(self.events_path, 'a', newline='', encoding='utf-8') as f:
-            enter_iso = dt.datetime.fromtimestamp(start).isoformat(timespec='seconds')
-            exit_iso  = dt.datetime.fromtimestamp(end).isoformat(timespec='seconds')
-            csv.writer(f).writerow([sid, enter_iso, exit_iso, round(max(0, end-start), 2)])
+        enter_iso = dt.datetime.fromtimestamp(self.epoch + start).isoformat(timespec='seconds')
+        exit_iso  = dt.datetime.fromtimestamp(self.epoch + end).isoformat(timespec='seconds')
+        self.events.write([sid, enter_iso, exit_iso, round(max(0.0, end-start), 2)])
 
     def mark_seen(self, sid: str, t: float):
         if sid not in self.live: self.live[sid] = {"start": t, "last": t}
@@ -354,7 +1581,6 @@ class AttendanceBook:
             del self.live[sid]
 
     def close_all(self):
-        t = time.time()
         for sid, rec in list(self.live.items()):
             self._flush(sid, rec['start'], rec['last'])
             del self.live[sid]
@@ -371,16 +1597,28 @@ class AttendanceBook:
 # =============================== BEHAVIOR MODELS ============================ #
 
 class PersonDetector:
-    def __init__(self, model_path: str, conf: float, device: str, half: bool, imgsz: int, tta: bool):
-        self.model = YOLO(model_path); self.conf = conf
+    def __init__(self, model_path: str, conf: float, device: str, half: bool, imgsz: int, tta: bool,
+                 backend: str = "torch", cache_dir: str = "model_cache"):
+        weights = export_yolo(model_path, backend, imgsz, cache_dir)
+        self.model = YOLO(weights, task="detect"); self.conf = conf
+        self.backend = backend if weights != model_path else "torch"
         self.device = device; self.half = half and (device == "cuda")
         self.imgsz = int(imgsz); self.augment = bool(tta)
         self.box_annotator = sv.BoxAnnotator()
 
     def step(self, frame: np.ndarray) -> sv.Detections:
-        r = self.model.predict(frame, conf=self.conf, device=self.device,
-                               classes=[0], half=self.half, imgsz=self.imgsz,
-                               verbose=False, augment=self.augment)[0]
+        return self.step_batch([frame])[0]
+
+    def step_batch(self, frames: List[np.ndarray]) -> List[sv.Detections]:
+        """One predict call (one batched forward pass) for several frames."""
+        if not frames: return []
+        rs = self.model.predict(frames, conf=self.conf, device=self.device,
+                                classes=[0], half=self.half, imgsz=self.imgsz, batch=len(frames),
+                                verbose=False, augment=self.augment)
+        return [self._to_detections(r) for r in rs]
+
+    @staticmethod
+    def _to_detections(r) -> sv.Detections:
         if r.boxes is None or len(r.boxes) == 0:
             return sv.Detections.empty()
         return sv.Detections(
@@ -391,13 +1629,18 @@ class PersonDetector:
 
 class BehaviorDetector:
     def __init__(self, model_path: str, conf_floor: float, device: str, half: bool, imgsz: int,
-                 per_class_conf: Dict[str, float], tta: bool):
-        self.model = YOLO(model_path)
+                 per_class_conf: Dict[str, float], tta: bool,
+                 backend: str = "torch", cache_dir: str = "model_cache"):
+        weights = export_yolo(model_path, backend, imgsz, cache_dir)
+        self.model = YOLO(weights, task="detect")
+        self.backend = backend if weights != model_path else "torch"
         self.device = device; self.half = half and (device == "cuda")
         self.imgsz = int(imgsz); self.augment = bool(tta)
         self.idx2name = (self.model.names if isinstance(self.model.names, dict)
                          else {i: n for i, n in enumerate(self.model.names)})
         self.per_class_conf = per_class_conf or {}; self.conf_floor = conf_floor
+        # inference cost: seconds / predict calls / images (frames or crops)
+        self.infer_secs = 0.0; self.infer_calls = 0; self.infer_items = 0
 
     def _th_for_idx(self, cls_idx: int) -> float:
         label = self.idx2name.get(cls_idx)
@@ -406,8 +1649,42 @@ class BehaviorDetector:
         return float(self.conf_floor)
 
     def step(self, frame: np.ndarray) -> sv.Detections:
-        r = self.model.predict(frame, conf=0.05, device=self.device, half=self.half,
-                               imgsz=self.imgsz, verbose=False, augment=self.augment)[0]
+        return self.step_batch([frame])[0]
+
+    def step_batch(self, frames: List[np.ndarray]) -> List[sv.Detections]:
+        """One predict call (one batched forward pass) for several frames."""
+        return [self._to_detections(r) for r in self._predict(frames, self.imgsz)]
+
+    def step_crops(self, frame: np.ndarray, boxes: Dict[int, np.ndarray], imgsz: int,
+                   expand: float) -> Tuple[List[int], sv.Detections]:
+        """
+        Crop mode: expanded person crops (full-res pixels) in one predict call at a small imgsz.
+        Returns the owning track per detection and the detections in frame coords.
+        """
+        H, W = frame.shape[:2]
+        tids, crops, origins = [], [], []
+        for tid, b in boxes.items():
+            x1, y1, x2, y2 = expand_box(b, expand, W, H).astype(int)
+            if x2 - x1 < 8 or y2 - y1 < 8: continue
+            tids.append(tid); crops.append(frame[y1:y2, x1:x2]); origins.append((x1, y1))
+        owners, parts = [], []
+        for tid, (ox, oy), r in zip(tids, origins, self._predict(crops, imgsz)):
+            d = self._to_detections(r)
+            if len(d) == 0: continue
+            d.xyxy = d.xyxy + np.array([ox, oy, ox, oy], dtype=d.xyxy.dtype)
+            owners.extend([tid] * len(d)); parts.append(d)
+        return owners, (sv.Detections.merge(parts) if parts else sv.Detections.empty())
+
+    def _predict(self, images: List[np.ndarray], imgsz: int) -> list:
+        if not images: return []
+        t0 = time.perf_counter()
+        rs = self.model.predict(images, conf=0.05, device=self.device, half=self.half,
+                                imgsz=imgsz, batch=len(images), verbose=False, augment=self.augment)
+        self.infer_secs += time.perf_counter() - t0
+        self.infer_calls += 1; self.infer_items += len(images)
+        return rs
+
+    def _to_detections(self, r) -> sv.Detections:
         if r.boxes is None or len(r.boxes) == 0:
             return sv.Detections.empty()
         xyxy = r.boxes.xyxy.cpu().numpy()
@@ -423,81 +1700,288 @@ class BehaviorDetector:
 class TrackLabelSmoother:
     """
     Per-track temporal smoothing with EMA + hysteresis.
-    Keeps an EMA per (track_id, label). Outputs stable labels per track.
+    EMA and stable state live in (slots x BEHAVIOR_CLASSES) arrays; a track gets a slot when first
+    seen, every live track decays towards 0 when it shows no label (also while briefly lost), and a
+    slot is freed after `forget_after` updates without its track. Outputs stable labels per track.
     """
-    def __init__(self, window:int=7, th_on:float=0.60, th_off:float=0.45):
+    def __init__(self, window:int=7, th_on:float=0.60, th_off:float=0.45,
+                 forget_after: int = LOST_TRACK_BUFFER, capacity: int = 64):
         self.alpha = 2.0 / (max(1, window) + 1.0)
         self.th_on = float(th_on); self.th_off = float(th_off)
-        self.ema: Dict[Tuple[int, str], float] = defaultdict(float)
-        self.state: Dict[Tuple[int, str], bool] = defaultdict(bool)
-
-    def update(self, track_labels_conf: Dict[int, List[Tuple[str, float]]]) -> Dict[int, List[str]]:
-        # choose max conf per label per track for this frame
-        per_track_best: Dict[int, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
-        for tid, lst in track_labels_conf.items():
-            for lbl, conf in lst:
-                if conf > per_track_best[tid][lbl]:
-                    per_track_best[tid][lbl] = conf
+        self.forget_after = max(1, int(forget_after))
+        self.col = {lbl: k for k, lbl in enumerate(BEHAVIOR_CLASSES)}
+        self.ema = np.zeros((0, len(BEHAVIOR_CLASSES)), dtype=np.float32)
+        self.state = np.zeros((0, len(BEHAVIOR_CLASSES)), dtype=bool)
+        self.owner = np.zeros(0, dtype=np.int64)       # track id per slot, -1 = free
+        self.last_seen = np.zeros(0, dtype=np.int64)
+        self.slot: Dict[int, int] = {}
+        self.free: List[int] = []
+        self.step = 0
+        self._grow(max(1, int(capacity)))
+
+    def _grow(self, n: int):
+        old = len(self.owner)
+        self.ema = np.vstack([self.ema, np.zeros((n, self.ema.shape[1]), dtype=np.float32)])
+        self.state = np.vstack([self.state, np.zeros((n, self.state.shape[1]), dtype=bool)])
+        self.owner = np.concatenate([self.owner, np.full(n, -1, dtype=np.int64)])
+        self.last_seen = np.concatenate([self.last_seen, np.zeros(n, dtype=np.int64)])
+        self.free.extend(range(old + n - 1, old - 1, -1))
+
+    def _slot_of(self, tid: int) -> int:
+        s = self.slot.get(tid)
+        if s is None:
+            if not self.free: self._grow(len(self.owner))
+            s = self.free.pop()
+            self.ema[s] = 0.0; self.state[s] = False; self.owner[s] = tid
+            self.slot[tid] = s
+        self.last_seen[s] = self.step
+        return s
+
+    def update(self, track_labels_conf: Dict[int, List[Tuple[str, float]]],
+               tids: Iterable[int] = ()) -> Dict[int, List[str]]:
+        """`tids`: all tracks in the frame; those without labels decay too and keep their stable labels."""
+        self.step += 1
+        gone = np.flatnonzero((self.owner >= 0) & (self.step - self.last_seen > self.forget_after))
+        for s in gone.tolist():
+            del self.slot[int(self.owner[s])]; self.owner[s] = -1; self.free.append(s)
+
+        # max conf per label per track for this frame (labels outside BEHAVIOR_CLASSES are ignored)
+        order = list(track_labels_conf) + [t for t in tids if t not in track_labels_conf]
+        rows = np.array([self._slot_of(tid) for tid in order], dtype=np.int64)
+        conf = np.zeros_like(self.ema)
+        for s, tid in zip(rows.tolist(), order):
+            for lbl, c in track_labels_conf.get(tid, ()):
+                k = self.col.get(lbl)
+                if k is not None and c > conf[s, k]: conf[s, k] = c
+
+        live = self.owner >= 0
+        self.ema[live] += np.float32(self.alpha) * (conf[live] - self.ema[live])
+        self.state[live] = np.where(self.state[live], self.ema[live] >= self.th_off, self.ema[live] >= self.th_on)
 
         stable_out: Dict[int, List[str]] = defaultdict(list)
-        for tid, d in per_track_best.items():
-            for lbl in BEHAVIOR_CLASSES:
-                c = d.get(lbl, 0.0)
-                key = (tid, lbl)
-                prev = self.ema.get(key, 0.0)
-                ema = prev + self.alpha * (c - prev)
-                self.ema[key] = ema
-                st = self.state.get(key, False)
-                if not st and ema >= self.th_on:
-                    st = True
-                elif st and ema < self.th_off:
-                    st = False
-                self.state[key] = st
-                if st: stable_out[tid].append(lbl)
+        for s, tid in zip(rows.tolist(), order):
+            if self.state[s].any(): stable_out[tid] = [BEHAVIOR_CLASSES[k] for k in np.flatnonzero(self.state[s])]
         return stable_out
 
+class StableLabelIntervals:
+    """
+    Run-length encoding of stable labels: one row per (track, label) on-interval, written when
+    the label turns off, the track leaves the frame or its student ID changes. `end_frame` is
+    the last processed frame the label was on; seconds are media time (frame / fps).
+    """
+    COLUMNS = {"track_id": "int", "student_id": "str", "label": "str", "start_frame": "int", "end_frame": "int",
+               "start_sec": "float", "end_sec": "float"}
+
+    def __init__(self, sink: EventSink, fps: float = FPS_FALLBACK):
+        self.sink = sink
+        self.fps = fps
+        self.open: Dict[Tuple[int, str], List] = {}   # (tid, label) -> [student_id, start_frame, end_frame]
+
+    def update(self, frame_idx: int, stable_per_track: Dict[int, List[str]], track_to_sid: Dict[int, str]):
+        on = {(tid, lbl): track_to_sid.get(tid, f"Track#{tid}") for tid, kept in stable_per_track.items() for lbl in kept}
+        for key in [k for k, iv in self.open.items() if on.get(k) != iv[0]]:
+            self._write(key, self.open.pop(key))
+        for key, sid in on.items():
+            iv = self.open.get(key)
+            if iv is None: self.open[key] = [sid, frame_idx, frame_idx]
+            else: iv[2] = frame_idx
+
+    def _write(self, key: Tuple[int, str], iv: List):
+        fps = max(1.0, self.fps)
+        self.sink.write([key[0], iv[0], key[1], iv[1], iv[2], round(iv[1] / fps, 3), round(iv[2] / fps, 3)])
+
+    def close_all(self):
+        for key in sorted(self.open, key=lambda k: (self.open[k][1], k)):
+            self._write(key, self.open[key])
+        self.open.clear()
+        self.sink.close()
+
+# =============================== TRACK IDENTITY ============================= #
+
+class TrackIdentityMemory:
+    """
+    Persistent student ID per track: gallery matches add similarity-weighted votes, the leading
+    ID is kept between face frames, and a track locks once its leader has `lock_votes` votes and
+    `lock_share` of the total. Locked tracks skip face recognition until `reverify_frames` have
+    passed; a re-verification that disagrees adds votes for the other ID and can unlock the track.
+    Tracks without a face match keep up to `appear_samples` appearance vectors (one per
+    `appear_gap_frames`) for the gallery appearance fallback, whose votes count `appear_weight`.
+    A track known by appearance only keeps its provisional Track#<id> until `appear_min_matches`
+    appearance queries agreed on its leader (or it locks).
+    State of a track is dropped after `forget_after` analyzed frames without it.
+    """
+    def __init__(self, lock_votes: float = 2.0, lock_share: float = 0.7,
+                 reverify_frames: int = 250, forget_after: int = LOST_TRACK_BUFFER,
+                 appear_samples: int = 3, appear_gap_frames: int = 25, appear_weight: float = 0.5,
+                 appear_min_matches: int = 2):
+        self.lock_votes = float(lock_votes); self.lock_share = float(lock_share)
+        self.reverify_frames = max(1, int(reverify_frames))
+        self.forget_after = max(1, int(forget_after))
+        self.votes: Dict[int, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.sim: Dict[int, float] = {}           # last matched similarity of the current ID
+        self.locked: Dict[int, int] = {}          # tid -> frame of the last (re)verification
+        self.last_seen: Dict[int, int] = {}
+        self.step = 0
+        self.appear_samples = max(1, int(appear_samples)); self.appear_gap_frames = max(1, int(appear_gap_frames))
+        self.appear: Dict[int, List[np.ndarray]] = {}     # cached appearance vectors per track
+        self.appear_at: Dict[int, int] = {}
+        self.appear_weight = float(appear_weight)
+        self.appear_min_matches = max(1, int(appear_min_matches))
+        self.appear_hits: Dict[int, Dict[str, int]] = {}   # appearance matches per track and ID
+        self.faced: set = set()                            # tracks with at least one face match
+
+    def observe_tracks(self, tids: Iterable[int]):
+        """Once per analyzed frame: mark visible tracks, forget long-gone ones."""
+        self.step += 1
+        for tid in tids: self.last_seen[tid] = self.step
+        for tid in [t for t, st in self.last_seen.items() if self.step - st > self.forget_after]:
+            for d in (self.votes, self.sim, self.locked, self.last_seen, self.appear, self.appear_at,
+                      self.appear_hits):
+                d.pop(tid, None)
+            self.faced.discard(tid)
+
+    def needs_face(self, tid: int, frame_idx: int) -> bool:
+        return tid not in self.locked or frame_idx - self.locked[tid] >= self.reverify_frames
+
+    def _leader(self, tid: int) -> Optional[str]:
+        votes = self.votes.get(tid)
+        return max(sorted(votes), key=lambda k: votes[k]) if votes else None
+
+    def identity(self, tid: int) -> Tuple[str, float]:
+        best = self._leader(tid)
+        if best is None or (tid not in self.faced and tid not in self.locked
+                            and self.appear_hits.get(tid, {}).get(best, 0) < self.appear_min_matches):
+            return f"Track#{tid}", 0.0
+        return best, self.sim.get(tid, 0.0)
+
+    def appearance_due(self, tid: int, frame_idx: int) -> bool:
+        return (len(self.appear.get(tid, ())) < self.appear_samples
+                and frame_idx - self.appear_at.get(tid, -10**9) >= self.appear_gap_frames)
+
+    def add_appearance(self, tid: int, vec: np.ndarray, frame_idx: int) -> np.ndarray:
+        """Cache one appearance vector of `tid` -> normalized mean of its cached vectors."""
+        self.appear.setdefault(tid, []).append(vec); self.appear_at[tid] = frame_idx
+        m = np.mean(self.appear[tid], axis=0)
+        return m / max(1e-9, float(np.linalg.norm(m)))
+
+    def add_match(self, tid: int, match: Optional[Tuple[str, float]], frame_idx: int, appearance: bool = False):
+        """Result of one face (or appearance) query for `tid` (None: below threshold)."""
+        if tid not in self.last_seen: return                   # forgotten while its face was queued
+        if tid in self.locked: self.locked[tid] = frame_idx   # re-verification attempted
+        if match is None: return
+        sid, sim = match
+        if not appearance: self.faced.add(tid)
+        else:
+            hits = self.appear_hits.setdefault(tid, {}); hits[sid] = hits.get(sid, 0) + 1
+        votes = self.votes[tid]
+        votes[sid] += sim * (self.appear_weight if appearance else 1.0)
+        best = self._leader(tid)
+        if best == sid: self.sim[tid] = sim
+        share = votes[best] / max(1e-9, sum(votes.values()))
+        if votes[best] >= self.lock_votes and share >= self.lock_share:
+            self.locked.setdefault(tid, frame_idx)
+        else:
+            self.locked.pop(tid, None)
+
 # =============================== ALS AGGREGATOR ============================= #
 
 class ALSAggregator:
     """
     Maintains per-student, per-class durations (seconds) and computes:
     ALS_student = Σ_k w_k * p_k, where p_k = duration_k / total_duration_with_any_label
+    Seconds live in a (students x labels) array next to running totals and weighted sums, so
+    score() / global_score() are O(1) reads; snapshot() copies the arrays for other consumers.
     """
-    def __init__(self, weights: Dict[str, float]):
+    def __init__(self, weights: Dict[str, float], capacity: int = 64):
         self.weights = weights
-        self.per_student_secs: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
-        self.global_secs: Dict[str, float] = defaultdict(float)
-
-    def add_frame_labels(self, fps: float, stride: int, labels_per_student: Dict[str, List[str]]):
-        dt = (stride / max(1.0, fps))
+        self.labels: List[str] = list(dict.fromkeys(list(BEHAVIOR_CLASSES) + list(weights)))
+        self.col = {lbl: k for k, lbl in enumerate(self.labels)}
+        self.w = np.array([weights.get(l, 0.0) for l in self.labels], dtype=np.float64)
+        self.students: List[str] = []
+        self.row: Dict[str, int] = {}
+        self.secs = np.zeros((max(1, int(capacity)), len(self.labels)), dtype=np.float64)
+        self.total = np.zeros(len(self.secs)); self.wsum = np.zeros(len(self.secs))
+        self.global_secs = np.zeros(len(self.labels))
+        self.global_total = 0.0; self.global_wsum = 0.0
+
+    def _row_of(self, sid: str) -> int:
+        r = self.row.get(sid)
+        if r is None:
+            r = self.row[sid] = len(self.students); self.students.append(sid)
+            if r == len(self.secs):
+                self.secs = np.vstack([self.secs, np.zeros_like(self.secs)])
+                self.total = np.concatenate([self.total, np.zeros(r)]); self.wsum = np.concatenate([self.wsum, np.zeros(r)])
+        return r
+
+    def _col_of(self, lbl: str) -> int:
+        k = self.col.get(lbl)
+        if k is None:   # label outside the known classes: new zero-weight column
+            k = self.col[lbl] = len(self.labels); self.labels.append(lbl)
+            self.w = np.append(self.w, self.weights.get(lbl, 0.0))
+            self.secs = np.hstack([self.secs, np.zeros((len(self.secs), 1))])
+            self.global_secs = np.append(self.global_secs, 0.0)
+        return k
+
+    def add_seconds(self, sid: str, lbl: str, v: float):
+        r, k = self._row_of(sid), self._col_of(lbl)
+        self.secs[r, k] += v; self.total[r] += v; self.wsum[r] += self.w[k] * v
+        self.global_secs[k] += v; self.global_total += v; self.global_wsum += self.w[k] * v
+
+    def add_frame_labels(self, dt: float, labels_per_student: Dict[str, List[str]]):
+        """dt = media seconds since the previous processed frame (stride may vary)."""
         for sid, labels in labels_per_student.items():
             if not labels: continue
             share = dt / len(labels)
             for lbl in labels:
-                self.per_student_secs[sid][lbl] += share
-                self.global_secs[lbl] += share
+                self.add_seconds(sid, lbl, share)
 
-    def _score_from_secs(self, secs: Dict[str, float]) -> Tuple[float, Dict[str, float]]:
-        total = sum(secs.values())
-        if total <= 0: return 0.0, {}
-        props = {k: v/total for k, v in secs.items()}
-        raw = sum(self.weights.get(k, 0.0)*p for k, p in props.items())
+    @staticmethod
+    def _score(total: float, wsum: float) -> float:
+        if total <= 0: return 0.0
         # Normalize ~(-3..+3) -> 0..100
-        score = max(0.0, min(100.0, (raw + 3.0)/6.0*100.0))
-        return round(score, 2), props
+        return round(max(0.0, min(100.0, (wsum / total + 3.0) / 6.0 * 100.0)), 2)
+
+    def score(self, sid: str) -> Optional[float]:
+        """Current ALS of one student (None = no labelled time yet)."""
+        r = self.row.get(sid)
+        return None if r is None else self._score(self.total[r], self.wsum[r])
+
+    def global_score(self) -> float:
+        return self._score(self.global_total, self.global_wsum)
+
+    def _score_from_secs(self, secs: np.ndarray, total: float, wsum: float) -> Tuple[float, Dict[str, float]]:
+        if total <= 0: return 0.0, {}
+        return self._score(total, wsum), {self.labels[k]: float(secs[k] / total) for k in np.flatnonzero(secs)}
 
     def get_global(self) -> Tuple[float, Dict[str, float]]:
-        return self._score_from_secs(self.global_secs)
+        return self._score_from_secs(self.global_secs, self.global_total, self.global_wsum)
 
     def get_per_student(self) -> Dict[str, Dict]:
         out = {}
-        for sid, secs in self.per_student_secs.items():
-            score, props = self._score_from_secs(secs)
-            out[sid] = {"ALS": score, "proportions": props, "seconds": secs}
+        for sid, r in self.row.items():
+            score, props = self._score_from_secs(self.secs[r], self.total[r], self.wsum[r])
+            out[sid] = {"ALS": score, "proportions": props, "seconds": self.seconds_of(sid)}
         return out
 
+    def seconds_of(self, sid: str) -> Dict[str, float]:
+        r = self.row[sid]
+        return {self.labels[k]: float(self.secs[r, k]) for k in np.flatnonzero(self.secs[r])}
+
+    def snapshot(self) -> Dict:
+        """Copy of the current state: students, labels, seconds matrix, per-student and global ALS."""
+        n = len(self.students)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            raw = np.where(self.total[:n] > 0, self.wsum[:n] / self.total[:n], -3.0)
+        return {"students": list(self.students), "labels": list(self.labels),
+                "seconds": self.secs[:n].copy(), "ALS": np.round(np.clip((raw + 3.0) / 6.0 * 100.0, 0.0, 100.0), 2),
+                "global_ALS": self.global_score()}
+
 # =============================== MERGED PIPELINE ============================ #
 
+BEH_RAW_COLUMNS = {"frame": "int", "track_id": "int", "student_id": "str", "label": "str", "confidence": "float",
+                   "x1": "int", "y1": "int", "x2": "int", "y2": "int"}
+BEH_STABLE_COLUMNS = {"frame": "int", "track_id": "int", "student_id": "str", "stable_label": "str"}
+
 @dataclass
 class PipelineConfig:
     # Behavior
@@ -508,7 +1992,20 @@ class PipelineConfig:
     device: str = "auto"   # auto|cpu|cuda
     half: bool = True
     imgsz: int = 640
+    cpu_precision: str = "fp32"       # fp32|bf16|int8 for the CPU face / appearance embedders
+    precision_min_cos: float = 0.98   # min cosine vs fp32 on the gallery, else the embedder stays fp32
+    infer_backend: str = "torch"      # torch|onnx|openvino (CPU runtimes, eager torch fallback)
+    model_cache_dir: str = "model_cache"  # exported ONNX / OpenVINO artifacts (weights hash + size)
     frame_stride: int = 2
+    detect_batch: int = 1             # processed frames per batched YOLO call (offline throughput)
+    adaptive_stride: bool = False     # motion-gated stride between frame_stride and max_frame_stride
+    max_frame_stride: int = 8
+    motion_low: float = 0.003         # changed-pixel ratio below which inference is skipped
+    motion_high: float = 0.02         # ratio above which stride snaps back to frame_stride
+    motion_max_skip_sec: float = 2.0  # full inference at least this often
+    prefetch_frames: int = 4   # decoded frames queued ahead of inference (0 = inline read)
+    source_backend: str = "opencv"   # opencv|ffmpeg (decoder-side fps decimation + downscale)
+    ffmpeg_bin: str = "ffmpeg"
     show_window: bool = True
     output_dir: str = "outputs"
     smooth_window: int = 7
@@ -517,18 +2014,58 @@ class PipelineConfig:
     ioa_min: float = 0.60
     iou_min: float = 0.05
     rel_min_default: float = REL_MIN_DEFAULT
+    grid_min_boxes: int = GRID_MIN_BOXES   # box association via a uniform grid from this many people (0 = never)
     tta: bool = False
     per_class_conf: Dict[str, float] = field(default_factory=dict)
+    behavior_mode: str = "frame"  # frame|crop (behavior model on tracked person crops)
+    crop_imgsz: int = 256         # crop mode: inference size per person crop
+    crop_expand: float = 1.3      # crop mode: person box zoom (desk/hands context)
 
     # Attendance / Face ID
     students_dir: str = "students"
+    allowed_students: List[str] = field(default_factory=list)   # enrolled IDs only (empty = whole gallery)
+    gallery_cache: bool = True        # per-image embedding cache, only new/changed images re-embedded
+    gallery_cache_dir: str = ""       # default: <students_dir>/.gallery_cache
+    gallery_batch: int = 32           # enrolment: images per MTCNN / embedder batch
+    gallery_workers: int = 4          # enrolment: image decode threads
+    gallery_detect_side: int = 0      # enrolment: MTCNN on photos downscaled to this side (0 = full res)
+    gallery_fp16: bool = False        # face template matrix in float16 (half the memory)
+    ann_min_ids: int = 20000          # gallery size from which face_match uses an ANN index (0 = never)
+    ann_nprobe: int = 16              # numpy IVF fallback: inverted lists probed per query
     sim_threshold: float = SIM_THRESHOLD_DEFAULT
     min_face_px: int = MIN_FACE_PX
     min_face_var: float = MIN_FACE_VAR
     face_every_n: int = FACE_EVERY_N
+    face_detect: str = "frame"        # frame|track (MTCNN on batched head regions of tracks needing ID)
+    face_region_side: int = 224       # track mode: head regions shrunk to fit this square
+    face_head_frac: float = 0.5       # track mode: upper fraction of the person box searched
+    face_embed_batch: int = 1         # face crops embedded together across frames (1 = per frame)
+    face_embed_latency_sec: float = 0.5   # ...but a queued face waits at most this long (media time)
+    id_lock_votes: float = 2.0        # similarity-weighted votes before a track's ID locks
+    id_lock_share: float = 0.7        # ...and the leader's share of all its votes
+    id_reverify_sec: float = 10.0     # locked tracks skip face ID for this long (media time)
     appearance: bool = True
+    appearance_arch: str = "resnet50"     # resnet50|mobilenet_v3_large|mobilenet_v3_small
+    appear_sim_threshold: float = 0.80    # appearance fallback for tracks with no usable face
+    appear_vote_weight: float = 0.5       # appearance votes count less than face votes
+    appear_samples: int = 3               # appearance vectors encoded (and cached) per track
+    appear_gap_sec: float = 1.0           # ...at least this far apart
+    appear_min_matches: int = 2           # agreeing appearance matches before an appearance-only ID counts
     grace: int = GRACE_SECONDS_DEFAULT
+    event_format: str = "csv"        # csv|parquet|npz for behaviors_raw / behaviors_stable / attendance_events
+    event_flush_rows: int = EVENT_FLUSH_ROWS   # rows buffered per table between file appends
+    stable_frames: bool = True       # per-frame behaviors_stable table (behavior_intervals is always written)
+    result_store: bool = True        # results.sqlite per run: indexed tables the API queries
+    attendance_clock: str = "video"  # video (media time, independent of processing speed)|wall (live cameras)
+    session_start: str = ""          # ISO time of media second 0 for event stamps (default: run start)
     save_video: str = ""  # outputs/merged_annot.mp4
+    run_dir: str = ""     # explicit run folder (default: <output_dir>/<stem>_<timestamp>)
+
+    # Time-sharded processing of one long video
+    shards: int = 1               # >1 splits the video into N time ranges run in a process pool
+    shard_workers: int = 0        # 0 = min(shards, cpu count)
+    shard_warmup_sec: float = 5.0 # tracker/smoother warm-up decoded before each shard's range
+    track_id_offset: int = 0      # added to ByteTrack IDs (unique IDs across shards)
 
     # 🔴 Violation / low-active video config
     violation_labels: List[str] = field(default_factory=lambda: ["sleep", "phone", "Using_phone", "bend", "bow_head"])
@@ -536,35 +2073,174 @@ class PipelineConfig:
     violation_zoom_scale: float = 1.4    # zoom vào học sinh vi phạm
     violation_frame_size: Tuple[int, int] = (480, 480)  # size video crop (w,h)
 
-class MergedPipeline:
-    def __init__(self, cfg: PipelineConfig):
-        self.cfg = cfg
-
-        # Create unique subfolder per run
+@dataclass
+class FrameResult:
+    """Per-frame association output shared by logging, ALS, violations, attendance and overlay."""
+    tracks: sv.Detections
+    track_boxes: Dict[int, np.ndarray]
+    gated: List[Tuple[str, float, np.ndarray]]
+    track_to_sid: Dict[int, str]
+    track_to_sim: Dict[int, float]
+    stable_per_track: Dict[int, List[str]]
+    gated_tids: Optional[List[int]] = None   # owning track per gated box (-1: none)
+
+def make_run_dir(cfg: PipelineConfig) -> str:
+    """Unique subfolder per run: <output_dir>/<save_video stem|model stem>_<timestamp>."""
+    if cfg.run_dir:
+        run_dir = cfg.run_dir
+    else:
         base_name = Path(cfg.save_video).stem if cfg.save_video else Path(cfg.behavior_model_path).stem
         timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-        run_name = f"{base_name}_{timestamp}"
-        self.run_dir = os.path.join(cfg.output_dir, run_name)
-        ensure_dir(self.run_dir)
-        print(f"[Session] Run directory: {self.run_dir}")
+        run_dir = os.path.join(cfg.output_dir, f"{base_name}_{timestamp}")
+    ensure_dir(run_dir)
+    return run_dir
+
+def write_violations_csv(path: str, records: List[Dict]):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["student_id","label","start_frame","end_frame",
+                    "start_sec","end_sec","video_file"])
+        for rec in records:
+            w.writerow([
+                rec["student_id"],
+                rec["label"],
+                rec["start_frame"],
+                rec["end_frame"],
+                rec["start_sec"],
+                rec["end_sec"],
+                rec["video_file"]
+            ])
+
+def write_als_jsons(run_dir: str, als: ALSAggregator):
+    g_score, g_props = als.get_global()
+    with open(os.path.join(run_dir, "als_global.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "ALS": g_score, "global_proportions": g_props,
+            "weights": BEHAVIOR_WEIGHTS, "note": "ALS = sum_k w_k * p_k (stable labels, time-weighted)"
+        }, f, indent=2)
+
+    per = als.get_per_student()
+    with open(os.path.join(run_dir, "als_per_student.json"), "w", encoding="utf-8") as f:
+        json.dump(per, f, indent=2)
+
+def track_rows(track_frames: Dict[int, int], track_sid_votes: Dict[int, Dict[str, int]]) -> List[list]:
+    """One row per track: majority student ID over the frames it was identified in."""
+    rows = []
+    for tid in sorted(track_frames):
+        votes = track_sid_votes.get(tid) or {}
+        sid = max(sorted(votes), key=lambda k: votes[k]) if votes else f"Track#{tid}"
+        rows.append([tid, sid, track_frames[tid], sum(votes.values())])
+    return rows
+
+def write_tracks_csv(path: str, track_frames: Dict[int, int], track_sid_votes: Dict[int, Dict[str, int]]):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["track_id", "student_id", "frames_seen", "frames_identified"])
+        w.writerows(track_rows(track_frames, track_sid_votes))
+
+def write_result_store(store: ResultStore, book: AttendanceBook, als: ALSAggregator, violations: List[Dict],
+                       track_frames: Dict[int, int], track_sid_votes: Dict[int, Dict[str, int]], **meta):
+    """End-of-run tables of the session store (behavior intervals are streamed during the run)."""
+    iso = lambda t: dt.datetime.fromtimestamp(book.epoch + t).isoformat(timespec='seconds')
+    store.insert("attendance", ["student_id", "enter_sec", "exit_sec", "enter_iso", "exit_iso", "duration_sec"],
+                 [(sid, a, b, iso(a), iso(b), round(max(0.0, b - a), 2))
+                  for sid, segs in book.intervals.items() for a, b in segs])
+    per = als.get_per_student()
+    store.insert("als", ["student_id", "als", "labelled_sec"],
+                 [(sid, d["ALS"], sum(d["seconds"].values())) for sid, d in per.items()])
+    store.insert("als_seconds", ["student_id", "label", "seconds", "proportion"],
+                 [(sid, lbl, v, d["proportions"].get(lbl, 0.0)) for sid, d in per.items() for lbl, v in d["seconds"].items()])
+    store.insert("tracks", ["track_id", "student_id", "frames_seen", "frames_identified"],
+                 track_rows(track_frames, track_sid_votes))
+    store.insert("identities", ["track_id", "student_id", "votes"],
+                 [(tid, sid, n) for tid in sorted(track_sid_votes) for sid, n in sorted(track_sid_votes[tid].items())])
+    cols = ["student_id", "label", "start_frame", "end_frame", "start_sec", "end_sec", "video_file"]
+    store.insert("violations", cols, [[r[c] for c in cols] for r in violations])
+    store.set_meta(global_als=als.get_global()[0], epoch=book.epoch, grace=book.grace, **meta)
 
-        # device / precision
-        self.device = pick_device(cfg.device)
-        self.fp16 = (self.device == "cuda") and bool(cfg.half)
-        print(f"[INFO] Device: {self.device} | FP16: {self.fp16} | imgsz: {cfg.imgsz} | stride: {cfg.frame_stride}")
+@dataclass
+class PipelineModels:
+    """Detectors, face / appearance engines and gallery: loaded once, reusable across runs."""
+    device: str
+    fp16: bool
+    per_class_conf: Dict[str, float]
+    person: PersonDetector
+    behavior: BehaviorDetector
+    face: FaceEngineTorch
+    appear: Optional[AppearanceEncoder]
+    gallery: StudentGallery
+    precision_report: Dict[str, Dict]
+
+def load_identity_models(cfg: PipelineConfig, device: str
+                         ) -> Tuple[FaceEngineTorch, Optional[AppearanceEncoder], StudentGallery, Dict]:
+    """Face / appearance embedders (at cfg.cpu_precision) and the student gallery."""
+    bk, cache = cfg.infer_backend, cfg.model_cache_dir
+    face = FaceEngineTorch(device=device, backend=bk, cache_dir=cache)
+    appear = (AppearanceEncoder(device=("cuda:0" if device=="cuda" else "cpu"), backend=bk, cache_dir=cache,
+                                arch=cfg.appearance_arch)
+              if cfg.appearance else None)
+    # reduced CPU precision is applied before the gallery so templates and queries match
+    report = apply_cpu_precision(face, appear, cfg.cpu_precision, cfg.students_dir,
+                                 cfg.sim_threshold, cfg.precision_min_cos, cache)
+    cache_dir = (cfg.gallery_cache_dir or os.path.join(cfg.students_dir, ".gallery_cache")) if cfg.gallery_cache else None
+    gallery = StudentGallery(face, cfg.students_dir, appearance=appear, cache_dir=cache_dir,
+                             batch_size=cfg.gallery_batch, decode_workers=cfg.gallery_workers,
+                             detect_side=cfg.gallery_detect_side, fp16=cfg.gallery_fp16,
+                             ann_min=cfg.ann_min_ids, ann_nprobe=cfg.ann_nprobe,
+                             allowed=cfg.allowed_students or None)
+    return face, appear, gallery, report
+
+def load_models(cfg: PipelineConfig) -> PipelineModels:
+    # device / precision
+    device = pick_device(cfg.device)
+    fp16 = (device == "cuda") and bool(cfg.half)
+    print(f"[INFO] Device: {device} | FP16: {fp16} | imgsz: {cfg.imgsz} | stride: {cfg.frame_stride}")
+
+    torch.backends.cudnn.benchmark = True
+
+    # thresholds
+    per = DEFAULT_THRESHOLDS.copy()
+    per.update(cfg.per_class_conf or {})
+
+    # models
+    bk, cache = cfg.infer_backend, cfg.model_cache_dir
+    person = PersonDetector(cfg.person_model_path, cfg.conf_person, device, fp16, cfg.imgsz, cfg.tta, bk, cache)
+    behavior = BehaviorDetector(cfg.behavior_model_path, cfg.conf_behavior_floor,
+                                device, fp16, cfg.imgsz, per, cfg.tta, bk, cache)
+
+    face, appear, gallery, report = load_identity_models(cfg, device)
+
+    # warmup
+    if device == "cuda":
+        dummy = np.zeros((cfg.imgsz, cfg.imgsz, 3), dtype=np.uint8)
+        for _ in range(2):
+            _ = person.model.predict(dummy, device="cuda", half=fp16, imgsz=cfg.imgsz, verbose=False)
+            _ = behavior.model.predict(dummy, device="cuda", half=fp16, imgsz=cfg.imgsz, verbose=False)
+        torch.cuda.synchronize()
+    return PipelineModels(device, fp16, per, person, behavior, face, appear, gallery, report)
 
-        torch.backends.cudnn.benchmark = True
+class MergedPipeline:
+    def __init__(self, cfg: PipelineConfig, models: Optional[PipelineModels] = None):
+        """`models` from load_models(cfg) are reused as-is (model server); else loaded here."""
+        self.cfg = cfg
 
-        # thresholds
-        per = DEFAULT_THRESHOLDS.copy()
-        per.update(cfg.per_class_conf or {})
-        self.per_class_conf = per
+        # Create unique subfolder per run
+        self.run_dir = make_run_dir(cfg)
+        print(f"[Session] Run directory: {self.run_dir}")
 
-        # models
-        self.person = PersonDetector(cfg.person_model_path, cfg.conf_person,
-                                     self.device, self.fp16, cfg.imgsz, cfg.tta)
-        self.behavior = BehaviorDetector(cfg.behavior_model_path, cfg.conf_behavior_floor,
-                                         self.device, self.fp16, cfg.imgsz, self.per_class_conf, cfg.tta)
+        m = models if models is not None else load_models(cfg)
+        self.models = m
+        self.device, self.fp16, self.per_class_conf = m.device, m.fp16, m.per_class_conf
+        self.person, self.behavior = m.person, m.behavior
+        self.face, self.appear, self.gallery = m.face, m.appear, m.gallery
+        if cfg.allowed_students and self.gallery.allowed != set(cfg.allowed_students):
+            # shared models (model server): scope the already loaded gallery to this session
+            self.gallery = self.gallery.subset(cfg.allowed_students)
+        self.behavior.infer_secs = 0.0; self.behavior.infer_calls = 0; self.behavior.infer_items = 0
+        self.precision_report = m.precision_report
+        if self.precision_report:
+            with open(os.path.join(self.run_dir, "precision_check.json"), "w", encoding="utf-8") as f:
+                json.dump({"precision": cfg.cpu_precision, "models": self.precision_report}, f, indent=2)
 
         # tracker
         self.tracker = sv.ByteTrack(
@@ -574,15 +2250,11 @@ class MergedPipeline:
             frame_rate=FPS_FALLBACK
         )
 
-        # face & appearance (Torch-based)
-        self.face = FaceEngineTorch(device=self.device)
-        self.appear = AppearanceEncoder(device=("cuda:0" if self.device=="cuda" else "cpu")) if cfg.appearance else None
-        self.gallery = StudentGallery(self.face, cfg.students_dir, appearance=self.appear)
-
         # attendance & ALS
         self.book = AttendanceBook(
             grace_seconds=cfg.grace,
-            events_path=os.path.join(self.run_dir, "attendance_events.csv")
+            events=self._event_sink("attendance_events", AttendanceBook.EVENT_COLUMNS),
+            epoch=(session_epoch(cfg.session_start) if cfg.attendance_clock == "video" else 0.0)
         )
 
         self.als = ALSAggregator(BEHAVIOR_WEIGHTS)
@@ -601,18 +2273,35 @@ class MergedPipeline:
         # video writer (full annotated video)
         self.writer = None
 
-        # CSV paths
-        self.beh_csv_path        = os.path.join(self.run_dir, "behaviors_raw.csv")
-        self.beh_stable_csv_path = os.path.join(self.run_dir, "behaviors_stable.csv")
+        # buffered per-frame tables + CSV paths
+        self.beh_raw = self._event_sink("behaviors_raw", BEH_RAW_COLUMNS)
+        self.beh_stable = self._event_sink("behaviors_stable", BEH_STABLE_COLUMNS) if cfg.stable_frames else None
+        self.store = ResultStore(os.path.join(self.run_dir, RESULT_STORE_NAME)) if cfg.result_store else None
+        intervals = self._event_sink("behavior_intervals", StableLabelIntervals.COLUMNS)
+        if self.store is not None:
+            intervals = TeeEventSink(intervals, self.store.sink("behavior_intervals", StableLabelIntervals.COLUMNS,
+                                                                cfg.event_flush_rows))
+        self.beh_intervals = StableLabelIntervals(intervals)
         self.summary_csv_path    = os.path.join(self.run_dir, "attendance_summary.csv")
-
-        # init CSVs
-        self._init_csvs()
+        self.tracks_csv_path     = os.path.join(self.run_dir, "tracks.csv")
 
         # state
         self.frame_idx = -1
         self.last_tick = time.time()
         self.fps_for_dt = FPS_FALLBACK
+        self.last_face_frame = -10**9
+        self.identity = TrackIdentityMemory(cfg.id_lock_votes, cfg.id_lock_share,
+                                            appear_samples=cfg.appear_samples, appear_weight=cfg.appear_vote_weight,
+                                            appear_min_matches=cfg.appear_min_matches)
+        self.appear_encoded = 0
+        self.face_queue = FaceEmbedQueue(self.face, cfg.face_embed_batch)
+        self.face_queries = 0        # face frames: track-frames due for face ID / all track-frames
+        self.face_track_frames = 0
+        self.motion = MotionGate()
+        self.frames_skipped = 0
+        # track -> frames seen / student-ID votes (tracks.csv, shard merge)
+        self.track_frames: Dict[int, int] = defaultdict(int)
+        self.track_sid_votes: Dict[int, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
 
         # 🔴 Violation state
         self.violation_dir = os.path.join(self.run_dir, "violations")
@@ -624,22 +2313,14 @@ class MergedPipeline:
         # list of violation segments for CSV logging
         self.violation_records: List[Dict] = []
 
-        # warmup
-        if self.device == "cuda":
-            dummy = np.zeros((cfg.imgsz, cfg.imgsz, 3), dtype=np.uint8)
-            for _ in range(2):
-                _ = self.person.model.predict(dummy, device="cuda", half=self.fp16, imgsz=cfg.imgsz, verbose=False)
-                _ = self.behavior.model.predict(dummy, device="cuda", half=self.fp16, imgsz=cfg.imgsz, verbose=False)
-            torch.cuda.synchronize()
-
-    def _init_csvs(self):
-        ensure_dir(self.run_dir)
-        if not os.path.exists(self.beh_csv_path):
-            with open(self.beh_csv_path, "w", newline="", encoding="utf-8") as f:
-                csv.writer(f).writerow(["frame","track_id","student_id","label","confidence","x1","y1","x2","y2"])
-        if not os.path.exists(self.beh_stable_csv_path):
-            with open(self.beh_stable_csv_path, "w", newline="", encoding="utf-8") as f:
-                csv.writer(f).writerow(["frame","track_id","student_id","stable_label"])
+    def _event_sink(self, name: str, columns: Dict[str, str]) -> EventSink:
+        return open_event_sink(os.path.join(self.run_dir, name), columns,
+                               self.cfg.event_format, self.cfg.event_flush_rows)
+
+    def _now(self) -> float:
+        if self.cfg.attendance_clock == "video":
+            return self.frame_idx / max(1.0, self.fps_for_dt)
+        return time.time()
 
     def _adaptive_sim_threshold(self, face_wh_min: int, blur_val: float) -> float:
         base = self.cfg.sim_threshold   # 0.65
@@ -747,195 +2428,344 @@ class MergedPipeline:
 
     # ======================================================================== #
 
-    def run(self, source: str):
-        cap = cv2.VideoCapture(0 if source.isdigit() else source)
-        if not cap.isOpened():
-            raise RuntimeError(f"Cannot open source: {source}")
-        cap.set(cv2.CAP_PROP_BUFFERSIZE, 2)
-
-        real_fps = cap.get(cv2.CAP_PROP_FPS)
-        self.fps_for_dt = real_fps if real_fps and real_fps > 1 else FPS_FALLBACK
-        W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    def _flush_faces(self):
+        """Embed the queued face crops, match them at once, vote in frame order."""
+        queries, embs = self.face_queue.flush()
+        if not queries: return
+        matches = self.gallery.face_match_batch(embs, [q[2] for q in queries])
+        for (frame_idx, tid, _), match in zip(queries, matches):
+            self.identity.add_match(tid, match, frame_idx)
+
+    def _appearance_fallback(self, frame: np.ndarray, tracks: sv.Detections, cands: List[Tuple[int, int]]):
+        """Tracks never matched by face: a few cached whole-body vectors per track vs the gallery."""
+        todo = [(i, tid) for i, tid in cands if self.identity.appearance_due(tid, self.frame_idx)]
+        if not todo: return
+        vecs = self.appear.embed_batch([crop_bbox(frame, tracks.xyxy[i]) for i, _ in todo])
+        self.appear_encoded += sum(v is not None for v in vecs)
+        for (_, tid), v in zip(todo, vecs):
+            if v is None: continue
+            mean = self.identity.add_appearance(tid, v, self.frame_idx)
+            match = self.gallery.appear_match(mean, self.cfg.appear_sim_threshold)
+            if match is not None:
+                self.identity.add_match(tid, match, self.frame_idx, appearance=True)
+
+    def _analyze(self, frame: np.ndarray, persons: sv.Detections,
+                 beh: Optional[sv.Detections]) -> FrameResult:
+        """
+        Steps 1-6 after detection: tracking, gating, behavior->track, face ID, smoothing.
+        `beh` is None in crop mode: behaviors are detected here on the tracked person crops.
+        """
+        # 1) Tracking (ByteTrack)
+        tracks = self.tracker.update_with_detections(persons)
+        if self.cfg.track_id_offset and tracks.tracker_id is not None:
+            tracks.tracker_id = tracks.tracker_id + self.cfg.track_id_offset
+        track_boxes: Dict[int, np.ndarray] = {}
+        tr_ids = tracks.tracker_id.tolist() if hasattr(tracks.tracker_id, "tolist") else []
+        if tr_ids and tracks.xyxy is not None:
+            for i, tid in enumerate(tr_ids):
+                track_boxes[int(tid)] = tracks.xyxy[i].astype(float)
+        owners = None
+        if beh is None:
+            owners, beh = self.behavior.step_crops(frame, track_boxes, self.cfg.crop_imgsz,
+                                                   self.cfg.crop_expand)
+
+        # 2) Behavior boxes -> (label, conf, box)
+        labels_raw = []
+        if len(beh) > 0:
+            idx2name = self.behavior.idx2name
+            for cid, conf, box in zip(beh.class_id, beh.confidence, beh.xyxy):
+                cname = idx2name.get(int(cid), f"cls{int(cid)}")
+                labels_raw.append((cname, float(conf), box))
+
+        # 3) Gate behavior boxes by person IoA/IoU + relative area
+        gated = []
+        track_labels: Dict[int, List[Tuple[str, float]]] = defaultdict(list)
+        gated_tids = None
+        if owners is not None:
+            # crop mode: each box already belongs to the track it was cropped from
+            gated_tids = []
+            for (cname, conf, b), tid in zip(labels_raw, owners):
+                min_rel = MIN_REL_AREA.get(cname, self.cfg.rel_min_default)
+                if (box_area(b) / (box_area(track_boxes[tid]) + 1e-6)) >= min_rel:
+                    gated.append((cname, conf, b)); gated_tids.append(tid)
+                    track_labels[tid].append((cname, conf))
+        elif len(persons) > 0 and labels_raw:
+            keep = gate_boxes(persons.xyxy, beh.xyxy,
+                              [MIN_REL_AREA.get(c, self.cfg.rel_min_default) for c, _, _ in labels_raw],
+                              self.cfg.ioa_min, self.cfg.iou_min, self.cfg.grid_min_boxes)
+            gated = [lr for lr, k in zip(labels_raw, keep) if k]
+        else:
+            gated = labels_raw
+
+        # 4) Map behaviors to the best-overlapping track (also the owner logged in behaviors_raw.csv)
+        if owners is None:
+            tid_list = list(track_boxes)
+            j, best = best_overlap([b for _, _, b in gated],
+                                   np.stack([track_boxes[t] for t in tid_list]) if tid_list else [],
+                                   self.cfg.grid_min_boxes)
+            gated_tids = [tid_list[k] if k >= 0 else -1 for k in j]
+            for (cname, conf, _), tid, v in zip(gated, gated_tids, best):
+                if tid >= 0 and v >= 0.1:
+                    track_labels[tid].append((cname, conf))
+
+        # 5) Face ID every N processed frames, only for tracks without a locked identity
+        track_to_sid: Dict[int, str] = {}
+        track_to_sim: Dict[int, float] = {}
+        tids = [int(t) for t in tr_ids] if tracks.xyxy is not None else []
+        self.identity.observe_tracks(tids)
+        n_face = max(1, self.cfg.face_every_n)
+        min_stride = max(1, self.cfg.frame_stride)
+        if ((self.frame_idx // min_stride) % n_face == 0
+                or (self.frame_idx - self.last_face_frame) >= n_face * min_stride):
+            self.last_face_frame = self.frame_idx
+            need = [(i, tid) for i, tid in enumerate(tids) if self.identity.needs_face(tid, self.frame_idx)]
+            self.face_track_frames += len(tids); self.face_queries += len(need)
+            if self.cfg.face_detect == "track":
+                # MTCNN on the head regions of those tracks only; a face belongs to its region's track
+                H, W = frame.shape[:2]
+                regions = [head_region(tracks.xyxy[i], W, H, self.cfg.face_head_frac) for i, _ in need]
+                crops, boxes, owners = [], [], []
+                for (_, tid), (rc, rb) in zip(need, self.face.detect_crops_regions(frame, regions,
+                                                                                  self.cfg.face_region_side)):
+                    if not rb: continue
+                    j = max(range(len(rb)), key=lambda j: (rb[j][2]-rb[j][0]) * (rb[j][3]-rb[j][1]))
+                    crops.append(rc[j]); boxes.append(rb[j]); owners.append(tid)
+                best = list(enumerate(owners))
+            else:
+                # full-frame MTCNN, faces <-> tracks by optimal (Hungarian) IoU assignment
+                crops, boxes = self.face.detect_crops(frame) if need else ([], [])
+                ious = iou_matrix(tracks.xyxy[[i for i, _ in need]].astype(int) if need else [],
+                                  [b[:4] for b in boxes], self.cfg.grid_min_boxes)
+                best = [(j, need[r][1]) for r, j in hungarian_pairs(ious)]
+            # queue only the faces a track asked for; embedded with faces of later frames
+            for j, tid in best:
+                x1, y1, x2, y2, blurv = boxes[j]
+                self.face_queue.put(self.frame_idx, tid, crops[j],
+                                    self._adaptive_sim_threshold(min(x2-x1, y2-y1), blurv))
+            if self.appear is not None and len(self.gallery.appear_index):
+                faced = {tid for _, tid in best}
+                self._appearance_fallback(frame, tracks, [(i, tid) for i, tid in need
+                                                          if tid not in faced and tid not in self.identity.faced])
+        if self.face_queue.due(self.frame_idx):
+            self._flush_faces()
+        for tid in tids:   # provisional Track#<id> until the first gallery match
+            track_to_sid[tid], track_to_sim[tid] = self.identity.identity(tid)
+
+        # 6) Per-track smoothing => stable labels per track
+        stable_per_track = self.smoother.update(track_labels, tids)
+
+        return FrameResult(tracks, track_boxes, gated, track_to_sid, track_to_sim, stable_per_track,
+                           gated_tids)
+
+    def _emit(self, frame: np.ndarray, res: FrameResult, dt_sec: float) -> bool:
+        """Steps 7-9: logging, ALS, violations, attendance, overlay. False = user quit."""
+        tracks, track_boxes, gated = res.tracks, res.track_boxes, res.gated
+        track_to_sid, track_to_sim, stable_per_track = res.track_to_sid, res.track_to_sim, res.stable_per_track
+        tr_ids = tracks.tracker_id.tolist() if hasattr(tracks.tracker_id, "tolist") else []
+
+        # 7) Logging + ALS accumulation
+        for j, (cname, conf, b) in enumerate(gated):
+            x1,y1,x2,y2 = map(int, b.tolist())
+            best_tid = res.gated_tids[j]
+            sid = track_to_sid.get(best_tid, f"Track#{best_tid}")
+            self.beh_raw.write([self.frame_idx, best_tid, sid, cname, round(float(conf), 4), x1, y1, x2, y2])
+
+        per_student_stable_labels: Dict[str, List[str]] = defaultdict(list)
+        for tid, kept in stable_per_track.items():
+            if not kept: continue
+            sid = track_to_sid.get(tid, f"Track#{tid}")
+            if self.beh_stable is not None:
+                for lbl in kept:
+                    self.beh_stable.write([self.frame_idx, tid, sid, lbl])
+            per_student_stable_labels[sid].extend(kept)
+        self.beh_intervals.update(self.frame_idx, stable_per_track, track_to_sid)
+
+        self.als.add_frame_labels(dt_sec, per_student_stable_labels)
+
+        # 🔴 7b) Violation state update + recording cropped frames
+        # - Update start/end timestamp per violation
+        self._update_violation_state(stable_per_track, track_to_sid)
+        # - For current frame, ghi frame crop cho các track đang vi phạm
+        if tr_ids and tracks.xyxy is not None:
+            for i, tid in enumerate(tr_ids):
+                tid = int(tid)
+                sid = track_to_sid.get(tid, f"Track#{tid}")
+                labels = stable_per_track.get(tid, [])
+                if not labels:
+                    continue
+                track_box = tracks.xyxy[i].astype(float)
+                for label in self.cfg.violation_labels:
+                    if label in labels:
+                        self._record_violation_frame(frame, sid, label, track_box, self.fps_for_dt)
+
+        # 8) Attendance (seen only for IDs we have)
+        tnow = self._now()
+        for tid, sid in track_to_sid.items():
+            self.book.mark_seen(sid, tnow)
+            self.track_frames[tid] += 1
+            if not sid.startswith("Track#"): self.track_sid_votes[tid][sid] += 1
+        if (tnow - self.last_tick) >= 1.0:
+            self.book.tick(tnow)
+            self.last_tick = tnow
+
+        # 9) Draw overlays (tracks + labels)
+        annotated = frame.copy()
+        try:
+            annotated = self.box_annot.annotate(annotated, tracks)
+            labels = []
+            for i, tid in enumerate(tr_ids):
+                tid = int(tid); sid = track_to_sid.get(tid, f"Track#{tid}")
+                sim = track_to_sim.get(tid, 0.0)
+                # Per-ID live ALS (optional quick peek)
+                id_als = self.als.score(sid)
+                lab = f"{sid}"
+                if id_als is not None: lab += f" | ALS:{id_als:.0f}"
+                if sim > 0: lab += f" | sim:{sim:.2f}"
+                labels.append(lab)
+            annotated = self.lbl_annot.annotate(annotated, tracks, labels=labels)
+        except Exception:
+            pass
+
+        # quick HUD
+        cv2.rectangle(annotated, (0,0), (640, 86), (0,0,0), -1)
+        cv2.putText(annotated, f"Merged Pipeline | {now_iso()}",
+                    (10,22), cv2.FONT_HERSHEY_SIMPLEX, 0.6,(255,255,255),1, cv2.LINE_AA)
+        cv2.putText(annotated, f"Present: {len(self.book.live)}  Dev:{self.device}  FPS~{self.fps_for_dt:.1f}",
+                    (10,48), cv2.FONT_HERSHEY_SIMPLEX, 0.55,(255,255,255),1, cv2.LINE_AA)
+        cv2.putText(annotated, f"ALS per ID uses stable labels only (EMA+hysteresis)",
+                    (10,72), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(200,200,200),1, cv2.LINE_AA)
+
+        if self.writer is not None:
+            self.writer.write(annotated)
+        if self.cfg.show_window:
+            cv2.imshow("Merged Pipeline", annotated)
+            if cv2.waitKey(1) & 0xFF == ord('q'): return False
+        return True
+
+    def run(self, source: str, start_frame: int = 0, end_frame: Optional[int] = None,
+            account_from: Optional[int] = None):
+        """
+        Process `source` (optionally only frames [start_frame, end_frame)).
+        Frames before `account_from` only warm up tracker/smoother state.
+        """
+        account_from = start_frame if account_from is None else account_from
+        # Decode stage: skipped stride frames are grab()'d only, processed frames
+        # are prefetched on a background thread while this loop runs inference
+        stride = min_stride = max(1, self.cfg.frame_stride)
+        # adaptive stride moves in multiples of frame_stride: k * min_stride, k in [1, k_max]
+        k_stride, k_max = 1, max(1, self.cfg.max_frame_stride // min_stride)
+        frames = open_frame_source(source, self.cfg.source_backend, stride,
+                                   self.cfg.prefetch_frames, self.cfg.imgsz, self.cfg.ffmpeg_bin,
+                                   start_frame, end_frame)
+        sx, sy = frames.det_scale
+
+        self.fps_for_dt = frames.fps
+        self.beh_intervals.fps = self.fps_for_dt
+        self.identity.reverify_frames = max(1, int(round(self.cfg.id_reverify_sec * self.fps_for_dt)))
+        self.face_queue.max_latency_frames = int(round(self.cfg.face_embed_latency_sec * self.fps_for_dt))
+        self.identity.appear_gap_frames = max(1, int(round(self.cfg.appear_gap_sec * self.fps_for_dt)))
+        if self.cfg.attendance_clock == "video":
+            self.last_tick = account_from / max(1.0, self.fps_for_dt)
+        W, H = frames.width, frames.height
         stem = f"session_{int(time.time())}"
         self._open_writer(W, H, self.fps_for_dt, stem)
 
         print("[INFO] Press 'q' to quit.")
 
-        stride = max(1, self.cfg.frame_stride)
-        while True:
-            ok, frame = cap.read()
-            if not ok: break
-            self.frame_idx += 1
-
-            # Skip compute on in-between frames, keep display responsive
-            if (self.frame_idx % stride) != 0:
-                if self.cfg.show_window:
-                    cv2.imshow("Merged Pipeline", frame)
-                    if cv2.waitKey(1) & 0xFF == ord('q'): break
+        res: Optional[FrameResult] = None
+        prev_idx: Optional[int] = None
+        last_infer = -1
+        next_idx = 0
+        max_skip = max(1, int(round(self.cfg.motion_max_skip_sec * self.fps_for_dt)))
+        batch = max(1, self.cfg.detect_batch)
+        crop_mode = self.cfg.behavior_mode == "crop"
+        # (frame_idx, frame, det_in, skip) waiting for one batched detection call
+        pending: List[Tuple[int, np.ndarray, np.ndarray, bool]] = []
+
+        def flush(final: bool = False) -> bool:
+            """
+            Detect all pending inferred frames in one batch, then replay them in order.
+            `final`: end of stream, the queued face crops are matched before the last frame is emitted.
+            """
+            nonlocal res, prev_idx
+            infer = [p for p in pending if not p[3]]
+            det_ins = [p[2] for p in infer]
+            # 1) People detection  2) Behavior detection (batched; per frame in _analyze for crop mode)
+            dets = {}
+            behs = (self.behavior.step_batch(det_ins) if not crop_mode else [None] * len(infer))
+            for p, pd, bd in zip(infer, self.person.step_batch(det_ins), behs):
+                dets[p[0]] = (scale_detections(pd, sx, sy), None if bd is None else scale_detections(bd, sx, sy))
+            keep_going = True
+            for n, (frame_idx, frame, _, skip) in enumerate(pending, 1):
+                self.frame_idx = frame_idx
+                if skip:
+                    res = FrameResult(res.tracks, res.track_boxes, [], res.track_to_sid,
+                                      res.track_to_sim, res.stable_per_track)
+                    self.frames_skipped += 1
+                else:
+                    res = self._analyze(frame, *dets[frame_idx])
+                # skipped frames queue no crops but still enforce the queue's latency bound
+                if ((skip and self.face_queue.due(frame_idx))
+                        or (final and n == len(pending) and len(self.face_queue))):
+                    self._flush_faces()
+                    ids = {tid: self.identity.identity(tid) for tid in res.track_to_sid}
+                    res.track_to_sid = {tid: sid for tid, (sid, _) in ids.items()}
+                    res.track_to_sim = {tid: sim for tid, (_, sim) in ids.items()}
+
+                # actual media time since the previous processed frame (ALS accounting)
+                dt_sec = ((frame_idx - prev_idx) if prev_idx is not None else min_stride) / max(1.0, self.fps_for_dt)
+                prev_idx = frame_idx
+
+                # shard warm-up frames: state only, nothing is logged or accounted
+                if frame_idx < account_from:
+                    continue
+                if not self._emit(frame, res, dt_sec):
+                    keep_going = False; break
+            pending.clear()
+            return keep_going
+
+        for frame_idx, frame, det_frame in frames:
+            # adaptive stride: frames decoded ahead of the current stride are dropped here,
+            # so the processed frames depend only on content, never on decode timing
+            if frame_idx < next_idx:
                 continue
-
-            # 1) People detection -> tracking (ByteTrack)
-            persons = self.person.step(frame)
-            tracks = self.tracker.update_with_detections(persons)
-
-            # 2) Behavior detection
-            beh = self.behavior.step(frame)
-            labels_raw = []
-            if len(beh) > 0:
-                idx2name = self.behavior.idx2name
-                for cid, conf, box in zip(beh.class_id, beh.confidence, beh.xyxy):
-                    cname = idx2name.get(int(cid), f"cls{int(cid)}")
-                    labels_raw.append((cname, float(conf), box))
-
-            # 3) Gate behavior boxes by person IoA/IoU + relative area
-            gated = []
-            if len(persons) > 0 and labels_raw:
-                for cname, conf, b in labels_raw:
-                    keep = False
-                    min_rel = MIN_REL_AREA.get(cname, self.cfg.rel_min_default)
-                    for p in persons.xyxy:
-                        if (contains(p, b) or ioa(p, b) >= self.cfg.ioa_min or iou(p, b) >= self.cfg.iou_min):
-                            if (box_area(b) / (box_area(p) + 1e-6)) >= min_rel:
-                                keep = True; break
-                    if keep: gated.append((cname, conf, b))
-            else:
-                gated = labels_raw
-
-            # 4) Map behaviors to nearest track (IoU)
-            track_labels: Dict[int, List[Tuple[str, float]]] = defaultdict(list)
-            track_boxes: Dict[int, np.ndarray] = {}
-            tr_ids = tracks.tracker_id.tolist() if hasattr(tracks.tracker_id, "tolist") else []
-            if tr_ids and tracks.xyxy is not None:
-                for i, tid in enumerate(tr_ids):
-                    track_boxes[int(tid)] = tracks.xyxy[i].astype(float)
-                for cname, conf, b in gated:
-                    best_tid, best_iou = None, 0.0
-                    for tid, tbox in track_boxes.items():
-                        iou_v = iou(b, tbox)
-                        if iou_v > best_iou:
-                            best_iou = iou_v; best_tid = tid
-                    if best_tid is not None and best_iou >= 0.1:
-                        track_labels[best_tid].append((cname, conf))
-
-            # 5) Face ID every N processed frames
-            track_to_sid: Dict[int, str] = {}
-            track_to_sim: Dict[int, float] = {}
-            faces = []
-            if (self.frame_idx // stride) % self.cfg.face_every_n == 0:
-                faces = self.face.detect_and_embed(frame)
-
-            # assign faces to tracks by IoU
-            if tr_ids and tracks.xyxy is not None:
-                for i, tid in enumerate(tr_ids):
-                    tid = int(tid); tbox = tracks.xyxy[i].astype(int)
-                    best_face, best_iou = None, 0.0
-                    for f in faces:
-                        ov = bbox_iou_xyxy(tbox, f['bbox'])
-                        if ov > best_iou:
-                            best_iou, best_face = ov, f
-                    sid, sim = f"Track#{tid}", 0.0      # provisional ID always available
-                    if best_face is not None:
-                        fx1, fy1, fx2, fy2 = best_face["bbox"]
-                        fmin = min(fx2-fx1, fy2-fy1)
-                        blurv = best_face["blur"]
-                        thr = self._adaptive_sim_threshold(fmin, blurv)
-                        match = self.gallery.face_match(best_face["emb"], thr)
-                        if match is not None:
-                            sid, sim = match
-                    track_to_sid[tid] = sid
-                    track_to_sim[tid] = sim
-
-            # 6) Per-track smoothing => stable labels per track
-            stable_per_track = self.smoother.update(track_labels)
-
-            # 7) Logging + ALS accumulation
-            with open(self.beh_csv_path, "a", newline="", encoding="utf-8") as fraw:
-                wraw = csv.writer(fraw)
-                for cname, conf, b in gated:
-                    x1,y1,x2,y2 = map(int, b.tolist())
-                    best_tid, best = -1, 0.0
-                    for tid, tbox in track_boxes.items():
-                        s = iou(b, tbox)
-                        if s > best: best, best_tid = s, tid
-                    sid = track_to_sid.get(best_tid, f"Track#{best_tid}")
-                    wraw.writerow([self.frame_idx, best_tid, sid, cname, f"{conf:.4f}", x1, y1, x2, y2])
-
-            per_student_stable_labels: Dict[str, List[str]] = defaultdict(list)
-            with open(self.beh_stable_csv_path, "a", newline="", encoding="utf-8") as fst:
-                wst = csv.writer(fst)
-                for tid, kept in stable_per_track.items():
-                    if not kept: continue
-                    sid = track_to_sid.get(tid, f"Track#{tid}")
-                    for lbl in kept:
-                        wst.writerow([self.frame_idx, tid, sid, lbl])
-                    per_student_stable_labels[sid].extend(kept)
-
-            self.als.add_frame_labels(self.fps_for_dt, stride, per_student_stable_labels)
-
-            # 🔴 7b) Violation state update + recording cropped frames
-            # - Update start/end timestamp per violation
-            self._update_violation_state(stable_per_track, track_to_sid)
-            # - For current frame, ghi frame crop cho các track đang vi phạm
-            if tr_ids and tracks.xyxy is not None:
-                for i, tid in enumerate(tr_ids):
-                    tid = int(tid)
-                    sid = track_to_sid.get(tid, f"Track#{tid}")
-                    labels = stable_per_track.get(tid, [])
-                    if not labels:
-                        continue
-                    track_box = tracks.xyxy[i].astype(float)
-                    for label in self.cfg.violation_labels:
-                        if label in labels:
-                            self._record_violation_frame(frame, sid, label, track_box, self.fps_for_dt)
-
-            # 8) Attendance (seen only for IDs we have)
-            tnow = time.time()
-            for tid, sid in track_to_sid.items():
-                self.book.mark_seen(sid, tnow)
-            if (tnow - self.last_tick) >= 1.0:
-                self.book.tick(tnow)
-                self.last_tick = tnow
-
-            # 9) Draw overlays (tracks + labels)
-            annotated = frame.copy()
-            try:
-                annotated = self.box_annot.annotate(annotated, tracks)
-                labels = []
-                for i, tid in enumerate(tr_ids):
-                    tid = int(tid); sid = track_to_sid.get(tid, f"Track#{tid}")
-                    sim = track_to_sim.get(tid, 0.0)
-                    # Per-ID live ALS (optional quick peek)
-                    id_als = self.als.get_per_student().get(sid, {}).get("ALS", None)
-                    lab = f"{sid}"
-                    if id_als is not None: lab += f" | ALS:{id_als:.0f}"
-                    if sim > 0: lab += f" | sim:{sim:.2f}"
-                    labels.append(lab)
-                annotated = self.lbl_annot.annotate(annotated, tracks, labels=labels)
-            except Exception:
-                pass
-
-            # quick HUD
-            cv2.rectangle(annotated, (0,0), (640, 86), (0,0,0), -1)
-            cv2.putText(annotated, f"Merged Pipeline | {now_iso()}",
-                        (10,22), cv2.FONT_HERSHEY_SIMPLEX, 0.6,(255,255,255),1, cv2.LINE_AA)
-            cv2.putText(annotated, f"Present: {len(self.book.live)}  Dev:{self.device}  FPS~{self.fps_for_dt:.1f}",
-                        (10,48), cv2.FONT_HERSHEY_SIMPLEX, 0.55,(255,255,255),1, cv2.LINE_AA)
-            cv2.putText(annotated, f"ALS per ID uses stable labels only (EMA+hysteresis)",
-                        (10,72), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(200,200,200),1, cv2.LINE_AA)
-
-            if self.writer is not None:
-                self.writer.write(annotated)
-            if self.cfg.show_window:
-                cv2.imshow("Merged Pipeline", annotated)
-                if cv2.waitKey(1) & 0xFF == ord('q'): break
+            # detectors may see a decoder-downscaled frame; boxes go back to full-res coords
+            det_in = frame if det_frame is None else det_frame
+
+            # 0) Motion gate: static scene -> carry the last tracks + stable labels forward
+            skip = False
+            if self.cfg.adaptive_stride:
+                motion = self.motion.score(det_in)
+                skip = (last_infer >= 0 and motion < self.cfg.motion_low
+                        and (frame_idx - last_infer) < max_skip)
+                if skip:
+                    k_stride = min(k_max, k_stride * 2)
+                else:
+                    self.motion.set_reference()
+                    if motion >= self.cfg.motion_high: k_stride = 1
+                    elif motion >= self.cfg.motion_low: k_stride = max(1, k_stride // 2)
+                stride = k_stride * min_stride
+                next_idx = frame_idx + stride
+                frames.hint_stride(stride)
+            if not skip: last_infer = frame_idx
+
+            # a full batch is detected once the next inferred frame arrives, so the
+            # end-of-stream flush always has the last frame left to emit
+            if not skip and sum(1 for p in pending if not p[3]) >= batch and not flush():
+                break
+            pending.append((frame_idx, frame, det_in, skip))
+        else:
+            flush(final=True)
 
         # finalize
-        cap.release()
+        frames.release()
         if self.writer is not None: self.writer.release()
         cv2.destroyAllWindows()
         self.book.close_all()
         self.book.write_summary(self.summary_csv_path)
+        self.beh_intervals.close_all()
+        for sink in (self.beh_raw, self.beh_stable, self.book.events):
+            if sink is not None: sink.close()
 
         # Đóng tất cả violation writers
         for w in self.violation_writers.values():
@@ -943,39 +2773,423 @@ class MergedPipeline:
 
         # Ghi CSV các lần vi phạm (kèm timestamp)
         viol_csv = os.path.join(self.run_dir, "violations.csv")
-        with open(viol_csv, "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["student_id","label","start_frame","end_frame",
-                        "start_sec","end_sec","video_file"])
-            for rec in self.violation_records:
-                w.writerow([
-                    rec["student_id"],
-                    rec["label"],
-                    rec["start_frame"],
-                    rec["end_frame"],
-                    rec["start_sec"],
-                    rec["end_sec"],
-                    rec["video_file"]
-                ])
+        write_violations_csv(viol_csv, self.violation_records)
         print(f"[DONE] Violations CSV: {viol_csv}")
 
-        # write ALS JSONs
-        g_score, g_props = self.als.get_global()
-        with open(os.path.join(self.run_dir, "als_global.json"), "w", encoding="utf-8") as f:
-            json.dump({
-                "ALS": g_score, "global_proportions": g_props,
-                "weights": BEHAVIOR_WEIGHTS, "note": "ALS = sum_k w_k * p_k (stable labels, time-weighted)"
-            }, f, indent=2)
-
-        per = self.als.get_per_student()
-        with open(os.path.join(self.run_dir, "als_per_student.json"), "w", encoding="utf-8") as f:
-            json.dump(per, f, indent=2)
-
-        print("[DONE] Attendance events:", self.book.events_path)
+        # write ALS JSONs + track -> student map
+        write_als_jsons(self.run_dir, self.als)
+        write_tracks_csv(self.tracks_csv_path, self.track_frames, self.track_sid_votes)
+        if self.store is not None:
+            write_result_store(self.store, self.book, self.als, self.violation_records, self.track_frames,
+                               self.track_sid_votes, fps=self.fps_for_dt, session_start=self.cfg.session_start)
+            self.store.close()
+            print("[DONE] Result store:", self.store.path)
+
+        if self.cfg.adaptive_stride:
+            print(f"[Motion] {self.frames_skipped} low-motion frames reused the previous analysis")
+        if self.face_track_frames:
+            print(f"[Identity] face ID ran for {self.face_queries}/{self.face_track_frames} track-frames "
+                  f"({len(self.identity.locked)} tracks locked at the end)")
+        if self.appear_encoded:
+            print(f"[Identity] appearance fallback: {self.appear_encoded} track crops encoded "
+                  f"({self.cfg.appearance_arch})")
+        q = self.face_queue
+        if q.batches:
+            print(f"[Identity] {q.embedded} faces embedded in {q.batches} batches "
+                  f"({q.embedded / q.batches:.1f} faces/batch)")
+        b = self.behavior
+        if b.infer_items:
+            unit = "crop" if self.cfg.behavior_mode == "crop" else "frame"
+            print(f"[Behavior] {self.cfg.behavior_mode} mode: {b.infer_items} {unit}s in {b.infer_calls} calls, "
+                  f"{1000.0 * b.infer_secs / b.infer_items:.1f} ms/{unit}, "
+                  f"{1000.0 * b.infer_secs / max(1, b.infer_calls):.1f} ms/call")
+        print("[DONE] Attendance events:", self.book.events.path)
         print("[DONE] Attendance summary:", self.summary_csv_path)
         print("[DONE] ALS global / per-student JSON written.")
         print("[DONE] Violation videos saved in:", self.violation_dir)
 
+    def export_state(self) -> Dict:
+        """Picklable results of a finished run (merged across time shards)."""
+        open_violations = []
+        for (sid, label), st in self.violation_states.items():
+            if st["active"]:
+                open_violations.append({"student_id": sid, "label": label,
+                                        "start_frame": st["start_frame"], "end_frame": self.frame_idx})
+        return {
+            "run_dir": self.run_dir,
+            "last_frame": self.frame_idx,
+            "intervals": {sid: list(segs) for sid, segs in self.book.intervals.items()},
+            "als_student_secs": {sid: self.als.seconds_of(sid) for sid in self.als.students},
+            "violations": list(self.violation_records),
+            "open_violations": open_violations,
+            "track_frames": dict(self.track_frames),
+            "track_sid_votes": {tid: dict(v) for tid, v in self.track_sid_votes.items()},
+        }
+
+# =============================== TIME SHARDS ================================ #
+
+def plan_shards(total_frames: int, n: int, stride: int, warmup_frames: int) -> List[Tuple[int, int, int]]:
+    """
+    Split [0, total_frames) into n stride-aligned ranges -> (decode_start, account_from, end).
+    Aligned starts keep exactly the frames a single sequential run would process.
+    """
+    per = -(-total_frames // (n * stride)) * stride
+    plan = []
+    for k in range(n):
+        start, end = k * per, min(total_frames, (k + 1) * per)
+        if start >= end: break
+        plan.append((max(0, start - warmup_frames), start, end))
+    return plan
+
+def concat_videos(paths: List[str], out_path: str, fps: float, ffmpeg_bin: str = "ffmpeg"):
+    """Join clips in order: ffmpeg stream copy if available, else re-encode with OpenCV."""
+    import shutil, subprocess, tempfile
+    paths = [p for p in paths if os.path.exists(p)]
+    if not paths: return
+    if len(paths) == 1:
+        shutil.copyfile(paths[0], out_path); return
+    exe = shutil.which(ffmpeg_bin)
+    if exe:
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as lst:
+            for p in paths:
+                lst.write("file '" + os.path.abspath(p).replace("'", "'\\''") + "'\n")
+        try:
+            rc = subprocess.run([exe, "-hide_banner", "-loglevel", "error", "-y", "-f", "concat",
+                                 "-safe", "0", "-i", lst.name, "-c", "copy", out_path]).returncode
+        finally:
+            os.remove(lst.name)
+        if rc == 0: return
+    writer = None
+    for p in paths:
+        cap = cv2.VideoCapture(p)
+        while True:
+            ok, frame = cap.read()
+            if not ok: break
+            if writer is None:
+                h, w = frame.shape[:2]
+                writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"avc1"), fps, (w, h))
+            writer.write(frame)
+        cap.release()
+    if writer is not None: writer.release()
+
+def _run_shard(job: Dict) -> Dict:
+    torch.set_num_threads(job["threads"])
+    cv2.setNumThreads(1)
+    pipe = MergedPipeline(job["cfg"])
+    pipe.run(job["source"], job["decode_start"], job["end"], job["account_from"])
+    return pipe.export_state()
+
+def merge_shards(cfg: PipelineConfig, run_dir: str, states: List[Dict], fps: float):
+    """
+    Deterministically merge per-shard results (in shard order) into one session:
+      - behaviors_* / behavior_intervals tables and tracks.csv concatenated (track IDs are unique
+        per shard; intervals still on at a shard end are split there)
+      - attendance intervals per student ID joined when the gap is within `grace`
+      - ALS seconds summed per student ID and label
+      - violation segments open at a shard end joined with the next shard's segment
+    """
+    stride = max(1, cfg.frame_stride)
+
+    for name, fmt, columns in (("behaviors_raw", cfg.event_format, BEH_RAW_COLUMNS),
+                               ("behaviors_stable", cfg.event_format, BEH_STABLE_COLUMNS),
+                               ("behavior_intervals", cfg.event_format, StableLabelIntervals.COLUMNS),
+                               ("tracks", "csv", None)):
+        concat_tables([os.path.join(st["run_dir"], name) for st in states], os.path.join(run_dir, name),
+                      fmt, cfg.event_flush_rows, columns)
+
+    # attendance
+    per_sid: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+    for st in states:
+        for sid, segs in st["intervals"].items():
+            per_sid[sid].extend(tuple(sg) for sg in segs)
+    joined = []
+    for sid, segs in per_sid.items():
+        segs.sort()
+        cur = list(segs[0])
+        for a, b in segs[1:]:
+            if a - cur[1] <= cfg.grace:
+                cur[1] = max(cur[1], b)
+            else:
+                joined.append((cur[0], sid, cur[1])); cur = [a, b]
+        joined.append((cur[0], sid, cur[1]))
+    book = AttendanceBook(cfg.grace, open_event_sink(os.path.join(run_dir, "attendance_events"),
+                                                     AttendanceBook.EVENT_COLUMNS, cfg.event_format,
+                                                     cfg.event_flush_rows),
+                          epoch=session_epoch(cfg.session_start))
+    for start, sid, end in sorted(joined):
+        book._flush(sid, start, end)
+    book.events.close()
+    book.write_summary(os.path.join(run_dir, "attendance_summary.csv"))
+
+    # ALS
+    als = ALSAggregator(BEHAVIOR_WEIGHTS)
+    for st in states:
+        for sid, secs in st["als_student_secs"].items():
+            for lbl, v in secs.items():
+                als.add_seconds(sid, lbl, v)
+    write_als_jsons(run_dir, als)
+
+    # violations
+    segs = []
+    for k, st in enumerate(states):
+        segs += [dict(r, shard=k, open=False) for r in st["violations"]]
+        segs += [dict(r, shard=k, open=True) for r in st["open_violations"]]
+    segs.sort(key=lambda r: (r["student_id"], r["label"], r["start_frame"]))
+    merged: List[Dict] = []
+    for r in segs:
+        prev = merged[-1] if merged else None
+        if (prev is not None and prev["open"] and r["shard"] == prev["shard"] + 1
+                and (prev["student_id"], prev["label"]) == (r["student_id"], r["label"])
+                and r["start_frame"] - prev["end_frame"] <= stride):
+            prev.update(end_frame=r["end_frame"], shard=r["shard"], open=r["open"])
+        else:
+            merged.append(dict(r))
+    records = []
+    for r in sorted(merged, key=lambda r: (r["end_frame"], r["student_id"], r["label"])):
+        if r["open"]: continue   # still active when the video ended (same as a sequential run)
+        if r["end_frame"] - r["start_frame"] < cfg.violation_min_frames: continue
+        records.append({
+            "student_id": r["student_id"], "label": r["label"],
+            "start_frame": r["start_frame"], "end_frame": r["end_frame"],
+            "start_sec": round(r["start_frame"] / max(1.0, fps), 2),
+            "end_sec": round(r["end_frame"] / max(1.0, fps), 2),
+            "video_file": f"{r['student_id']}_{r['label']}.mp4",
+        })
+    write_violations_csv(os.path.join(run_dir, "violations.csv"), records)
+
+    if cfg.result_store:
+        store = ResultStore(os.path.join(run_dir, RESULT_STORE_NAME))
+        intervals = read_table(os.path.join(run_dir, "behavior_intervals"), StableLabelIntervals.COLUMNS)
+        store.insert("behavior_intervals", StableLabelIntervals.COLUMNS, zip(*intervals.values()))
+        track_frames, track_sid_votes = {}, {}
+        for st in states:
+            track_frames.update(st["track_frames"]); track_sid_votes.update(st["track_sid_votes"])
+        write_result_store(store, book, als, records, track_frames, track_sid_votes,
+                           fps=fps, session_start=cfg.session_start, shards=len(states))
+        store.close()
+
+    viol_dir = os.path.join(run_dir, "violations"); ensure_dir(viol_dir)
+    clips: Dict[str, List[str]] = defaultdict(list)
+    for st in states:
+        sdir = os.path.join(st["run_dir"], "violations")
+        for name in sorted(os.listdir(sdir)) if os.path.isdir(sdir) else []:
+            clips[name].append(os.path.join(sdir, name))
+    for name, paths in clips.items():
+        concat_videos(paths, os.path.join(viol_dir, name), fps, cfg.ffmpeg_bin)
+
+    if cfg.save_video:
+        base = Path(cfg.save_video).stem or "annotated"
+        concat_videos([os.path.join(st["run_dir"], f"{base}.mp4") for st in states],
+                      os.path.join(run_dir, f"{base}.mp4"), fps, cfg.ffmpeg_bin)
+
+def run_sharded(cfg: PipelineConfig, source: str) -> Optional[str]:
+    """
+    Split one video into `cfg.shards` time ranges, run MergedPipeline on each in a
+    process pool and merge the results into a single run folder. Returns None when
+    the source has no known length (webcam/stream) so the caller runs sequentially.
+    """
+    import shutil, multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+
+    if source.isdigit():
+        print("[Shards] Live source — sharding disabled"); return None
+    cap = cv2.VideoCapture(source)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+    real_fps = cap.get(cv2.CAP_PROP_FPS) if cap.isOpened() else 0
+    cap.release()
+    if total <= 0:
+        print("[Shards] Unknown frame count — sharding disabled"); return None
+    fps = real_fps if real_fps and real_fps > 1 else FPS_FALLBACK
+
+    stride = max(1, cfg.frame_stride)
+    warmup = int(math.ceil(cfg.shard_warmup_sec * fps / stride)) * stride
+    plan = plan_shards(total, max(1, cfg.shards), stride, warmup)
+    cpus = os.cpu_count() or 1
+    workers = cfg.shard_workers or min(len(plan), cpus)
+    threads = max(1, cpus // workers)
+
+    run_dir = make_run_dir(cfg)
+    print(f"[Shards] {len(plan)} shards x {total} frames | workers={workers} threads/worker={threads} -> {run_dir}")
+    jobs = []
+    for k, (decode_start, account_from, end) in enumerate(plan):
+        scfg = replace(cfg, run_dir=os.path.join(run_dir, "shards", f"shard_{k:02d}"),
+                       show_window=False, attendance_clock="video", violation_min_frames=0,
+                       track_id_offset=k * SHARD_TRACK_ID_OFFSET, shards=1, result_store=False)
+        jobs.append({"cfg": scfg, "source": source, "decode_start": decode_start,
+                     "account_from": account_from, "end": end, "threads": threads})
+
+    t0 = time.time()
+    if cfg.gallery_cache or cfg.cpu_precision != "fp32":
+        # fill the gallery / precision caches once here, so the shard workers only read them
+        load_identity_models(cfg, pick_device(cfg.device))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as ex:
+        states = list(ex.map(_run_shard, jobs))
+    merge_shards(cfg, run_dir, states, fps)
+    shutil.rmtree(os.path.join(run_dir, "shards"), ignore_errors=True)
+    print(f"[Shards] Merged {len(states)} shards in {time.time() - t0:.1f}s -> {run_dir}")
+    return run_dir
+
+# =============================== BACKEND BENCHMARK ========================== #
+
+def benchmark_backends(cfg: PipelineConfig, source: str, backends: List[str], iters: int = 20) -> Dict:
+    """
+    Throughput of every model per inference backend on the first frame of `source`.
+    Prints one line per (model, backend) and writes <output_dir>/backend_bench.json.
+    """
+    cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    ok, frame = cap.read(); cap.release()
+    if not ok:
+        frame = np.random.default_rng(0).integers(0, 255, (720, 1280, 3), dtype=np.uint8)
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    crop = frame[: frame.shape[0] // 2, : frame.shape[1] // 4]
+    device = pick_device(cfg.device)
+    face_batch = torch.zeros((8, 3, 160, 160), device=("cuda" if device == "cuda" else "cpu"))
+
+    def timeit(fn, n_items: int) -> Dict:
+        fn()   # first call builds / compiles the runtime graph
+        t0 = time.perf_counter()
+        for _ in range(iters): fn()
+        sec = (time.perf_counter() - t0) / iters
+        return {"ms_per_call": 1000.0 * sec, "items_per_sec": n_items / max(sec, 1e-9)}
+
+    results: Dict[str, Dict] = {}
+    for bk in backends:
+        cache = cfg.model_cache_dir
+        person = PersonDetector(cfg.person_model_path, cfg.conf_person, device, False, cfg.imgsz, False, bk, cache)
+        behavior = BehaviorDetector(cfg.behavior_model_path, cfg.conf_behavior_floor, device, False,
+                                    cfg.imgsz, cfg.per_class_conf, False, bk, cache)
+        face = FaceEngineTorch(device=device, backend=bk, cache_dir=cache)
+        appear = AppearanceEncoder(device=("cuda:0" if device == "cuda" else "cpu"), backend=bk, cache_dir=cache,
+                                   arch=cfg.appearance_arch)
+        with torch.no_grad():
+            rows = {
+                "person": (person.backend, timeit(lambda: person.step(frame), 1)),
+                "behavior": (behavior.backend, timeit(lambda: behavior.step(frame), 1)),
+                "mtcnn": (getattr(face.mtcnn.pnet, "backend", "torch"), timeit(lambda: face.mtcnn.detect(rgb), 1)),
+                "facenet_x8": (getattr(face.embedder, "backend", "torch"), timeit(lambda: face.embedder(face_batch), 8)),
+                "appearance": (appear.backbone.backend, timeit(lambda: appear.embed(crop), 1)),
+            }
+        results[bk] = {}
+        for name, (ran_on, r) in rows.items():
+            results[bk][name] = dict(r, ran_on=ran_on)
+            print(f"[Bench] {name:<11} {bk:<9}({ran_on:<8}) {r['ms_per_call']:8.1f} ms/call "
+                  f"{r['items_per_sec']:8.1f} img/s")
+    ensure_dir(cfg.output_dir)
+    out = os.path.join(cfg.output_dir, "backend_bench.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({"device": device, "imgsz": cfg.imgsz, "iters": iters, "results": results}, f, indent=2)
+    print(f"[DONE] Backend benchmark: {out}")
+    return results
+
+def benchmark_association(sizes: List[int], iters: int = 20, out_path: str = "",
+                          boxes_per_person: int = 2, loops_max: int = 300) -> Dict:
+    """
+    Per-frame association cost for N people spread over a 1920x1080 hall (N tracks, boxes_per_person
+    * N behavior boxes, N/2 faces): scalar loops (gating, behavior->track, face->track; up to
+    `loops_max` people) vs dense pairwise matrices vs grid-indexed pairs, Hungarian for faces.
+    """
+    rng = np.random.default_rng(0)
+    results: Dict[str, Dict] = {}
+    for n in sizes:
+        side = 1080.0 / max(4.0, math.sqrt(n) * 1.2)   # people shrink as the hall fills up
+        xy = rng.uniform(0, [1920 - side, 1080 - 2 * side], (n, 2)).astype(np.float32)
+        wh = (rng.uniform(0.7, 1.3, (n, 2)) * side).astype(np.float32)
+        persons = np.hstack([xy, xy + wh * [1, 2]]).astype(np.float32)
+        tracks = persons + rng.normal(0, 4, persons.shape).astype(np.float32)
+        nb = boxes_per_person * n
+        src = persons[rng.integers(0, n, nb)]
+        bwh = (src[:, 2:] - src[:, :2]) * rng.uniform(0.3, 0.9, (nb, 1)).astype(np.float32)
+        beh = np.hstack([src[:, :2] + 5, src[:, :2] + 5 + bwh]).astype(np.float32)
+        faces = (tracks[: n // 2] * [1, 1, 1, 0.5] + [10, 10, -10, 0]).astype(int)
+        tboxes = {i: t.astype(float) for i, t in enumerate(tracks)}
+        min_rel = [REL_MIN_DEFAULT] * len(beh)
+
+        def loops():
+            kept = [b for b, mr in zip(beh, min_rel)
+                    if any((contains(p, b) or ioa(p, b) >= 0.6 or iou(p, b) >= 0.05)
+                           and box_area(b) / (box_area(p) + 1e-6) >= mr for p in persons)]
+            for b in kept:
+                max(tboxes, key=lambda t: iou(b, tboxes[t]))
+            for t in tracks.astype(int):
+                max(range(len(faces)), key=lambda j: bbox_iou_xyxy(t, faces[j]), default=None)
+            return len(kept)
+
+        def vectorized(grid_min: int = 0):
+            keep = gate_boxes(persons, beh, min_rel, 0.6, 0.05, grid_min)
+            best_overlap(beh[keep], tracks, grid_min)
+            hungarian_pairs(iou_matrix(tracks.astype(int), faces, grid_min))
+            return int(keep.sum())
+
+        row = {}
+        runs = [("dense", vectorized), ("grid", lambda: vectorized(1))]
+        if n <= loops_max: runs.insert(0, ("loops", loops))
+        assert len({fn() for _, fn in runs}) == 1
+        for name, fn in runs:
+            t0 = time.perf_counter()
+            for _ in range(iters): fn()
+            row[name] = {"ms_per_frame": 1000.0 * (time.perf_counter() - t0) / iters}
+        results[str(n)] = row
+        print(f"[Bench] association {n:>5} people {nb:>5} boxes: "
+              + ", ".join(f"{k} {v['ms_per_frame']:8.2f} ms" for k, v in row.items()))
+    if out_path:
+        ensure_dir(os.path.dirname(out_path) or ".")
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump({"iters": iters, "results": results}, f, indent=2)
+        print(f"[DONE] Association benchmark: {out_path}")
+    return results
+
+def benchmark_gallery(sizes: List[int], queries: int = 256, k: int = 5, dim: int = 512,
+                      ann_nprobe: int = 16, out_path: str = "") -> Dict:
+    """
+    face_match cost per gallery size on synthetic unit templates (queries: noisy copies, cos ~0.75):
+    the old per-face sklearn loop vs the batched fp32 / fp16 matrix vs the ANN index (build time,
+    recall@1 against exact search), alone and with face_match's exact check below the default
+    threshold. Prints ms/query and optionally writes JSON.
+    """
+    rng = np.random.default_rng(0)
+    results: Dict[str, Dict] = {}
+    for n in sizes:
+        mat = rng.standard_normal((n, dim), dtype=np.float32)
+        mat /= np.linalg.norm(mat, axis=1, keepdims=True)
+        truth = rng.integers(0, n, queries)
+        q = mat[truth] + rng.standard_normal((queries, dim), dtype=np.float32) * 0.045
+        keys = [f"S{i:07d}" for i in range(n)]
+        row: Dict[str, Dict] = {}
+
+        nq = min(queries, 32)   # the old path rebuilt the matrix per face; a few queries suffice
+        t0 = time.perf_counter()
+        for e in q[:nq]:
+            mats = np.stack([mat[i] for i in range(n)], axis=0)
+            int(np.argmax(cosine_similarity(e.reshape(1, -1), mats).flatten()))
+        row["sklearn_loop"] = {"ms_per_query": 1000.0 * (time.perf_counter() - t0) / nq}
+
+        exact_top1 = None
+        for name, opts, exact_below in (("matrix_fp32", dict(fp16=False, ann_min=0), None),
+                                        ("matrix_fp16", dict(fp16=True, ann_min=0), None),
+                                        ("ann", dict(fp16=False, ann_min=1, nprobe=ann_nprobe), None),
+                                        ("ann_checked", None, SIM_THRESHOLD_DEFAULT)):
+            if opts is not None:   # ann_checked: the same index as face_match uses it (exact below threshold)
+                t0 = time.perf_counter()
+                index = GalleryIndex(keys, mat, **opts)
+                build = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            I, _ = index.search(q, k, exact_below=exact_below)
+            r = {"ms_per_query": 1000.0 * (time.perf_counter() - t0) / queries,
+                 "build_sec": build, "kind": index.kind, "matrix_mb": index.mat.nbytes / 2**20}
+            if exact_top1 is None: exact_top1 = I[:, 0]
+            r["recall_at_1"] = float(np.mean(I[:, 0] == exact_top1))
+            row[name] = r
+        results[str(n)] = row
+        for name, r in row.items():
+            extra = f" build {r['build_sec']:.2f}s recall@1 {r['recall_at_1']:.3f} ({r['kind']})" if "kind" in r else ""
+            print(f"[Bench] gallery {n:>8} {name:<13} {r['ms_per_query']:9.3f} ms/query{extra}")
+    if out_path:
+        ensure_dir(os.path.dirname(out_path) or ".")
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump({"queries": queries, "k": k, "dim": dim, "results": results}, f, indent=2)
+        print(f"[DONE] Gallery benchmark: {out_path}")
+    return results
+
 # =============================== CLI ======================================== #
 
 def load_thresholds(path: str) -> Dict[str, float]:
@@ -988,6 +3202,14 @@ def load_thresholds(path: str) -> Dict[str, float]:
     except Exception:
         return {}
 
+def load_student_list(ids: str, path: str) -> List[str]:
+    """Allowed student IDs from a comma-separated list and/or a file (one ID per line, # comments)."""
+    out = [x.strip() for x in ids.split(",") if x.strip()] if ids else []
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            out += [ln.split("#")[0].strip() for ln in f if ln.split("#")[0].strip()]
+    return sorted(set(out))
+
 def build_argparser():
     p = argparse.ArgumentParser(description="Merged Attendance + Active Learning (ALS) Pipeline — Torch only")
     p.add_argument("--source", type=str, required=True, help="video path or '0' for webcam")
@@ -995,8 +3217,29 @@ def build_argparser():
     p.add_argument("--behavior", type=str, required=True, help="YOLOv8 behavior model")
     p.add_argument("--device", type=str, default="auto", choices=["auto","cpu","cuda"])
     p.add_argument("--half", action="store_true")
+    p.add_argument("--cpu_precision", type=str, default="fp32", choices=list(CPU_PRECISIONS),
+                   help="CPU face/appearance embedders: bf16 autocast or int8 calibrated on --students_dir")
+    p.add_argument("--precision_min_cos", type=float, default=0.98)
     p.add_argument("--imgsz", type=int, default=640)
+    p.add_argument("--backend", type=str, default="torch", choices=list(INFER_BACKENDS),
+                   help="inference runtime for all models (onnx/openvino: CPU, exported once and cached)")
+    p.add_argument("--model_cache", type=str, default="model_cache", help="exported model artifacts")
+    p.add_argument("--bench_backends", type=str, default="",
+                   help="comma list, e.g. torch,onnx,openvino: print per-model throughput and exit")
+    p.add_argument("--bench_iters", type=int, default=20)
     p.add_argument("--frame_stride", type=int, default=2)
+    p.add_argument("--detect_batch", type=int, default=1, help="frames per batched detector call (CPU: 4-8)")
+    p.add_argument("--adaptive_stride", action="store_true",
+                   help="motion-gated stride up to --max_frame_stride: static frames skip person/behavior "
+                        "inference; they are still decoded unless --prefetch 0 (opencv source)")
+    p.add_argument("--max_frame_stride", type=int, default=8)
+    p.add_argument("--motion_low", type=float, default=0.003)
+    p.add_argument("--motion_high", type=float, default=0.02)
+    p.add_argument("--motion_max_skip_sec", type=float, default=2.0,
+                   help="adaptive stride: full inference at least this often (seconds of video)")
+    p.add_argument("--prefetch", type=int, default=4, help="frames decoded ahead on a background thread (0 = off)")
+    p.add_argument("--source_backend", type=str, default="opencv", choices=["opencv","ffmpeg"])
+    p.add_argument("--ffmpeg_bin", type=str, default="ffmpeg")
     p.add_argument("--conf_person", type=float, default=0.35)
     p.add_argument("--conf_behavior_floor", type=float, default=0.35)
     p.add_argument("--thresholds_json", type=str, default="")
@@ -1006,25 +3249,145 @@ def build_argparser():
     p.add_argument("--ioa_min", type=float, default=0.60)
     p.add_argument("--iou_min", type=float, default=0.05)
     p.add_argument("--rel_min_default", type=float, default=REL_MIN_DEFAULT)
+    p.add_argument("--grid_min_boxes", type=int, default=GRID_MIN_BOXES,
+                   help="grid-indexed box association from this many people per frame (0 = always dense)")
     p.add_argument("--tta", action="store_true")
+    p.add_argument("--behavior_mode", type=str, default="frame", choices=["frame","crop"],
+                   help="crop: behavior model on batched tracked-person crops at --crop_imgsz")
+    p.add_argument("--crop_imgsz", type=int, default=256)
+    p.add_argument("--crop_expand", type=float, default=1.3)
     p.add_argument("--no_show", action="store_true")
     p.add_argument("--outdir", type=str, default="outputs")
 
     # attendance / face
     p.add_argument("--students_dir", type=str, default="students")
+    p.add_argument("--students", type=str, default="",
+                   help="comma-separated student IDs enrolled in this session (default: whole gallery)")
+    p.add_argument("--students_file", type=str, default="", help="enrolled student IDs, one per line")
+    p.add_argument("--gallery_detect_side", type=int, default=0,
+                   help="detect gallery faces on photos downscaled to this side (e.g. 1024; 0 = full res)")
+    p.add_argument("--no_gallery_cache", action="store_true", help="re-embed every gallery image")
+    p.add_argument("--gallery_fp16", action="store_true", help="float16 face template matrix")
+    p.add_argument("--ann_min_ids", type=int, default=20000, help="use an ANN index from this gallery size (0 = never)")
+    p.add_argument("--ann_nprobe", type=int, default=16)
+    p.add_argument("--gallery_cache_dir", type=str, default="", help="default: <students_dir>/.gallery_cache")
     p.add_argument("--sim_threshold", type=float, default=SIM_THRESHOLD_DEFAULT)
     p.add_argument("--min_face_px", type=int, default=MIN_FACE_PX)
     p.add_argument("--min_face_var", type=float, default=MIN_FACE_VAR)
     p.add_argument("--face_every_n", type=int, default=FACE_EVERY_N)
+    p.add_argument("--face_detect", type=str, default="frame", choices=["frame","track"],
+                   help="track: detect faces only in batched head regions of tracks that still need an ID")
+    p.add_argument("--face_region_side", type=int, default=224)
+    p.add_argument("--face_head_frac", type=float, default=0.5)
+    p.add_argument("--face_embed_batch", type=int, default=1,
+                   help="embed face crops from several frames together (e.g. 16-32 on CPU)")
+    p.add_argument("--face_embed_latency_sec", type=float, default=0.5,
+                   help="max media time a queued face waits for its batch")
+    p.add_argument("--id_lock_votes", type=float, default=2.0,
+                   help="similarity-weighted face votes before a track's student ID locks")
+    p.add_argument("--id_lock_share", type=float, default=0.7)
+    p.add_argument("--id_reverify_sec", type=float, default=10.0,
+                   help="locked tracks skip face recognition for this long")
     p.add_argument("--appearance", action="store_true")
+    p.add_argument("--appearance_arch", type=str, default="resnet50", choices=list(APPEARANCE_ARCHS),
+                   help="appearance backbone (mobilenet_v3_* ~10x cheaper on CPU)")
+    p.add_argument("--appear_sim_threshold", type=float, default=0.80,
+                   help="appearance fallback match threshold for tracks with no usable face "
+                        "(raised to the gallery's calibrated other-student p99 when that is higher)")
+    p.add_argument("--appear_vote_weight", type=float, default=0.5)
+    p.add_argument("--appear_samples", type=int, default=3, help="appearance encodings per track")
+    p.add_argument("--appear_gap_sec", type=float, default=1.0, help="min media time between a track's encodings")
+    p.add_argument("--appear_min_matches", type=int, default=2,
+                   help="agreeing appearance matches before an appearance-only ID counts (attendance, ALS)")
     p.add_argument("--grace", type=int, default=GRACE_SECONDS_DEFAULT)
+    p.add_argument("--attendance_clock", type=str, default="video", choices=["video","wall"],
+                   help="video: attendance on media time (same result at any processing speed); wall: live cameras")
+    p.add_argument("--session_start", type=str, default="",
+                   help="ISO class start time of the video's first frame, e.g. 2025-10-08T09:00:00")
 
     p.add_argument("--save_video", type=str, default="")  # e.g., outputs/merged_annot.mp4
+    p.add_argument("--event_format", type=str, default="csv", choices=["csv", "parquet", "npz"],
+                   help="per-frame behavior / attendance event tables (parquet needs pyarrow, else npz)")
+    p.add_argument("--event_flush_rows", type=int, default=EVENT_FLUSH_ROWS, help="rows buffered per table between writes")
+    p.add_argument("--no_result_store", action="store_true", help="skip the per-run results.sqlite")
+    p.add_argument("--no_stable_frames", action="store_true",
+                   help="skip the per-frame behaviors_stable table; stable labels stay in behavior_intervals")
+
+    # time-sharded parallel run of one video file
+    p.add_argument("--shards", type=int, default=1, help="split the video into N time ranges processed in parallel")
+    p.add_argument("--shard_workers", type=int, default=0, help="process pool size (0 = min(shards, cpus))")
+    p.add_argument("--shard_warmup_sec", type=float, default=5.0)
 
     # (nếu muốn chỉnh behaviour vi phạm từ CLI thì có thể thêm arguments mới ở đây)
     return p
 
+def build_gallery_main(argv: List[str]):
+    """`build-gallery` entry point: bulk (re)build of the gallery embedding cache, e.g. nightly."""
+    p = argparse.ArgumentParser(prog="classroom_attendance_activelearning.py build-gallery",
+                                description="Embed students/<ID>/*.jpg into the gallery cache")
+    p.add_argument("--students_dir", type=str, default="students")
+    p.add_argument("--gallery_cache_dir", type=str, default="", help="default: <students_dir>/.gallery_cache")
+    p.add_argument("--device", type=str, default="auto", choices=["auto","cpu","cuda"])
+    p.add_argument("--appearance", action="store_true")
+    p.add_argument("--appearance_arch", type=str, default="resnet50", choices=list(APPEARANCE_ARCHS))
+    # must match the pipeline runs that read the cache (part of the cache key)
+    p.add_argument("--backend", type=str, default="torch", choices=list(INFER_BACKENDS))
+    p.add_argument("--model_cache", type=str, default="model_cache")
+    p.add_argument("--cpu_precision", type=str, default="fp32", choices=list(CPU_PRECISIONS))
+    p.add_argument("--precision_min_cos", type=float, default=0.98)
+    p.add_argument("--sim_threshold", type=float, default=SIM_THRESHOLD_DEFAULT)
+    p.add_argument("--batch", type=int, default=32, help="images per detection / embedding batch")
+    p.add_argument("--workers", type=int, default=4, help="image decode threads")
+    p.add_argument("--detect_side", type=int, default=0,
+                   help="MTCNN on photos downscaled to this side, crops stay full res (0 = full res; "
+                        "must match the pipeline's --gallery_detect_side)")
+    p.add_argument("--full", action="store_true", help="re-embed every image (ignore cached vectors)")
+    args = p.parse_args(argv)
+
+    device = pick_device(args.device)
+    face = FaceEngineTorch(device=device, backend=args.backend, cache_dir=args.model_cache)
+    appear = (AppearanceEncoder(device=("cuda:0" if device == "cuda" else "cpu"), backend=args.backend,
+                                cache_dir=args.model_cache, arch=args.appearance_arch) if args.appearance else None)
+    apply_cpu_precision(face, appear, args.cpu_precision, args.students_dir, args.sim_threshold, args.precision_min_cos,
+                        args.model_cache)
+    cache_dir = args.gallery_cache_dir or os.path.join(args.students_dir, ".gallery_cache")
+    t0 = time.time()
+    g = StudentGallery(face, args.students_dir, appearance=appear, cache_dir=cache_dir,
+                       batch_size=args.batch, decode_workers=args.workers, detect_side=args.detect_side,
+                       rebuild=args.full)
+    print(f"[DONE] Gallery cache {cache_dir}: {len(g.face_embs)} face templates, "
+          f"{len(g.appear_embs)} appearance templates ({time.time() - t0:.1f}s)")
+
+def bench_gallery_main(argv: List[str]):
+    """`bench-gallery` entry point: face_match cost vs gallery size (synthetic templates)."""
+    p = argparse.ArgumentParser(prog="classroom_attendance_activelearning.py bench-gallery")
+    p.add_argument("--sizes", type=str, default="100,10000,100000", help="comma-separated identity counts")
+    p.add_argument("--queries", type=int, default=256)
+    p.add_argument("--k", type=int, default=5)
+    p.add_argument("--ann_nprobe", type=int, default=16)
+    p.add_argument("--out", type=str, default="outputs/gallery_bench.json")
+    args = p.parse_args(argv)
+    benchmark_gallery([int(x) for x in args.sizes.split(",") if x.strip()], queries=max(1, args.queries),
+                      k=max(1, args.k), ann_nprobe=max(1, args.ann_nprobe), out_path=args.out)
+
+def bench_association_main(argv: List[str]):
+    """`bench-association` entry point: per-frame box association cost vs people per frame."""
+    p = argparse.ArgumentParser(prog="classroom_attendance_activelearning.py bench-association")
+    p.add_argument("--sizes", type=str, default="10,30,100,300,1000", help="comma-separated people per frame")
+    p.add_argument("--boxes_per_person", type=int, default=2, help="behavior boxes per person (low conf floor: more)")
+    p.add_argument("--iters", type=int, default=20)
+    p.add_argument("--out", type=str, default="outputs/association_bench.json")
+    args = p.parse_args(argv)
+    benchmark_association([int(x) for x in args.sizes.split(",") if x.strip()], max(1, args.iters), args.out,
+                          max(1, args.boxes_per_person))
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-association":
+        return bench_association_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "build-gallery":
+        return build_gallery_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-gallery":
+        return bench_gallery_main(sys.argv[2:])
     args = build_argparser().parse_args()
     cfg = PipelineConfig(
         person_model_path=args.person,
@@ -1032,18 +3395,49 @@ def main():
         conf_person=args.conf_person,
         conf_behavior_floor=args.conf_behavior_floor,
         device=args.device, half=args.half, imgsz=args.imgsz,
+        cpu_precision=args.cpu_precision, precision_min_cos=args.precision_min_cos,
+        infer_backend=args.backend, model_cache_dir=args.model_cache,
         frame_stride=max(1, args.frame_stride),
+        detect_batch=max(1, args.detect_batch),
+        adaptive_stride=args.adaptive_stride, max_frame_stride=max(1, args.max_frame_stride),
+        motion_low=args.motion_low, motion_high=args.motion_high,
+        motion_max_skip_sec=max(0.0, args.motion_max_skip_sec),
+        prefetch_frames=max(0, args.prefetch),
+        source_backend=args.source_backend, ffmpeg_bin=args.ffmpeg_bin,
         show_window=(not args.no_show),
         output_dir=args.outdir, smooth_window=max(1, args.smooth_window),
         th_on=args.th_on, th_off=args.th_off,
         ioa_min=args.ioa_min, iou_min=args.iou_min, rel_min_default=args.rel_min_default,
+        grid_min_boxes=max(0, args.grid_min_boxes),
         tta=args.tta, per_class_conf=load_thresholds(args.thresholds_json),
+        behavior_mode=args.behavior_mode, crop_imgsz=args.crop_imgsz, crop_expand=args.crop_expand,
         students_dir=args.students_dir, sim_threshold=args.sim_threshold,
+        allowed_students=load_student_list(args.students, args.students_file),
+        gallery_cache=(not args.no_gallery_cache), gallery_cache_dir=args.gallery_cache_dir,
+        gallery_detect_side=max(0, args.gallery_detect_side),
+        gallery_fp16=args.gallery_fp16, ann_min_ids=max(0, args.ann_min_ids), ann_nprobe=max(1, args.ann_nprobe),
         min_face_px=args.min_face_px, min_face_var=args.min_face_var,
-        face_every_n=args.face_every_n, appearance=args.appearance,
-        grace=args.grace,
-        save_video=args.save_video
+        face_every_n=args.face_every_n, appearance=args.appearance, appearance_arch=args.appearance_arch,
+        appear_sim_threshold=args.appear_sim_threshold, appear_vote_weight=args.appear_vote_weight,
+        appear_samples=max(1, args.appear_samples), appear_gap_sec=max(0.0, args.appear_gap_sec),
+        appear_min_matches=max(1, args.appear_min_matches),
+        face_detect=args.face_detect, face_region_side=max(48, args.face_region_side),
+        face_head_frac=min(1.0, max(0.1, args.face_head_frac)),
+        face_embed_batch=max(1, args.face_embed_batch), face_embed_latency_sec=max(0.0, args.face_embed_latency_sec),
+        id_lock_votes=args.id_lock_votes, id_lock_share=args.id_lock_share, id_reverify_sec=args.id_reverify_sec,
+        grace=args.grace, attendance_clock=args.attendance_clock, session_start=args.session_start,
+        save_video=args.save_video,
+        event_format=args.event_format, event_flush_rows=max(1, args.event_flush_rows),
+        stable_frames=(not args.no_stable_frames), result_store=(not args.no_result_store),
+        shards=max(1, args.shards), shard_workers=max(0, args.shard_workers),
+        shard_warmup_sec=max(0.0, args.shard_warmup_sec)
     )
+    if args.bench_backends:
+        backends = [b.strip() for b in args.bench_backends.split(",") if b.strip() in INFER_BACKENDS]
+        benchmark_backends(cfg, args.source, backends, max(1, args.bench_iters))
+        return
+    if cfg.shards > 1 and run_sharded(cfg, args.source) is not None:
+        return
     pipe = MergedPipeline(cfg)
     pipe.run(args.source)
 
@@ -0,0 +1,271 @@
+"""
+Buffered event tables for the pipeline's per-frame logs (behaviors_raw / behaviors_stable /
+attendance_events).
+
+Rows are buffered in memory and appended every `flush_rows` rows (and on close()) to one
+open file, instead of reopening a CSV per frame. Formats:
+    csv      plain CSV, same columns as before (default, for existing consumers)
+    parquet  zstd-compressed Parquet, one row group per flush (needs pyarrow, else npz)
+    npz      chunked NumPy zip: one compressed array per column and flush, "<column>/<chunk>.npy"
+
+`columns` is a list of names, or a {name: "int" | "float" | "str"} schema: with a schema every
+chunk is written with those types (no per-chunk inference, so a float column whose first
+values happen to be whole numbers stays float).
+Readers load only the columns they ask for, whatever the format:
+    sink = open_event_sink("run/behaviors_raw", {"frame": "int", "label": "str"}, fmt="npz")
+    sink.write([12, "writing"]); sink.close()
+    read_table("run/behaviors_raw", columns=["label"])   # -> {"label": [...]}
+    read_table("run/behaviors_raw", {"frame": "int"})     # -> {"frame": [12]} from any format
+This module has no torch / cv2 imports so the API process can read results cheaply.
+"""
+
+import os
+import csv
+import zipfile
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+EVENT_FORMATS = ("csv", "parquet", "npz")
+EVENT_FLUSH_ROWS = 4096
+COLUMN_TYPES = {"int": np.int64, "float": np.float64, "str": str}
+
+
+class EventSink:
+    """Buffered rows of one table; subclasses append a chunk of rows to the open file."""
+    ext = ""
+
+    def __init__(self, stem: str, columns: Sequence[str], flush_rows: int = EVENT_FLUSH_ROWS):
+        self.path = stem + self.ext
+        self.columns = list(columns)
+        self.types: Optional[List[str]] = [columns[c] for c in self.columns] if isinstance(columns, dict) else None
+        self.flush_rows = max(1, int(flush_rows))
+        self.rows: List[Sequence] = []
+        self.written = 0
+        d = os.path.dirname(self.path)
+        if d: os.makedirs(d, exist_ok=True)
+
+    def write(self, row: Sequence):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows: self.flush()
+
+    def writerows(self, rows: Iterable[Sequence]):
+        for row in rows: self.write(row)
+
+    def flush(self):
+        if not self.rows: return
+        self._append(self.rows)
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def _arrays(self, rows: List[Sequence]) -> List[np.ndarray]:
+        return [_column_array([r[k] for r in rows], self.types[k] if self.types else None)
+                for k in range(len(self.columns))]
+
+    def _append(self, rows: List[Sequence]):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class CsvEventSink(EventSink):
+    ext = ".csv"
+
+    def __init__(self, stem: str, columns: Sequence[str], flush_rows: int = EVENT_FLUSH_ROWS):
+        super().__init__(stem, columns, flush_rows)
+        new = not os.path.exists(self.path)
+        self.f = open(self.path, "a", newline="", encoding="utf-8")
+        self.w = csv.writer(self.f)
+        if new: self.w.writerow(self.columns); self.f.flush()
+
+    def _append(self, rows):
+        self.w.writerows(rows)
+        self.f.flush()
+
+    def _close(self):
+        self.f.close()
+
+
+class NpzEventSink(EventSink):
+    """Chunked NumPy zip: readable with read_table(), or np.load() per "<column>/<chunk>" array."""
+    ext = ".npz"
+
+    def __init__(self, stem: str, columns: Sequence[str], flush_rows: int = EVENT_FLUSH_ROWS):
+        super().__init__(stem, columns, flush_rows)
+        if os.path.exists(self.path): os.remove(self.path)
+        self.zf = zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_DEFLATED)
+        self.chunks = 0
+        self._put("columns", np.array(self.columns))
+
+    def _put(self, name: str, arr: np.ndarray):
+        with self.zf.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, arr, allow_pickle=False)
+
+    def _append(self, rows):
+        for col, arr in zip(self.columns, self._arrays(rows)):
+            self._put(f"{col}/{self.chunks:06d}", arr)
+        self.chunks += 1
+
+    def _close(self):
+        self.zf.close()
+
+
+class ParquetEventSink(EventSink):
+    ext = ".parquet"
+
+    def __init__(self, stem: str, columns: Sequence[str], flush_rows: int = EVENT_FLUSH_ROWS):
+        import pyarrow as pa   # ImportError -> open_event_sink falls back to npz
+        super().__init__(stem, columns, flush_rows)
+        self.schema = None   # without a schema: inferred from the first chunk
+        if self.types:
+            kinds = {"int": pa.int64(), "float": pa.float64(), "str": pa.string()}
+            self.schema = pa.schema([(c, kinds[t]) for c, t in zip(self.columns, self.types)])
+        self.pw = None
+
+    def _append(self, rows):
+        import pyarrow as pa, pyarrow.parquet as pq
+        table = pa.table(dict(zip(self.columns, self._arrays(rows))), schema=self.schema)
+        if self.pw is None:
+            self.pw = pq.ParquetWriter(self.path, table.schema, compression="zstd")
+        self.pw.write_table(table.cast(self.pw.schema))
+
+    def _close(self):
+        if self.pw is None:   # no rows: still leave a readable, empty table
+            import pyarrow as pa, pyarrow.parquet as pq
+            pq.write_table(self.schema.empty_table() if self.schema is not None else
+                           pa.table({col: pa.array([], pa.string()) for col in self.columns}), self.path)
+        else:
+            self.pw.close()
+
+
+class TeeEventSink(EventSink):
+    """Same rows to several sinks (e.g. a file table and the session result store)."""
+    def __init__(self, *sinks: EventSink):
+        self.sinks = list(sinks)
+        self.path, self.columns = self.sinks[0].path, self.sinks[0].columns
+        self.written = 0
+
+    def write(self, row: Sequence):
+        for s in self.sinks: s.write(row)
+        self.written += 1
+
+    def flush(self):
+        for s in self.sinks: s.flush()
+
+    def close(self):
+        for s in self.sinks: s.close()
+
+
+def _column_array(values: list, kind: Optional[str] = None) -> np.ndarray:
+    """Values as `kind` ("int" / "float" / "str"); without one: ints -> int64, numbers -> float64, else unicode."""
+    if kind is not None: return np.asarray(values, dtype=COLUMN_TYPES[kind])
+    arr = np.asarray(values)
+    if arr.dtype.kind in "iu": return arr.astype(np.int64, copy=False)
+    if arr.dtype.kind == "f": return arr.astype(np.float64, copy=False)
+    return arr if arr.dtype.kind == "U" else arr.astype(str)
+
+
+def open_event_sink(stem: str, columns: Sequence[str], fmt: str = "csv",
+                    flush_rows: int = EVENT_FLUSH_ROWS) -> EventSink:
+    """Sink for `<stem>.<fmt>` (parquet falls back to npz without pyarrow)."""
+    if fmt == "parquet":
+        try:
+            return ParquetEventSink(stem, columns, flush_rows)
+        except ImportError:
+            print("[Events] pyarrow not installed, writing npz instead of parquet")
+            fmt = "npz"
+    if fmt == "npz":
+        return NpzEventSink(stem, columns, flush_rows)
+    if fmt != "csv":
+        raise ValueError(f"unknown event format: {fmt} (expected one of {EVENT_FORMATS})")
+    return CsvEventSink(stem, columns, flush_rows)
+
+
+def find_table(path: str) -> Optional[str]:
+    """Existing file of a table given its stem or any of its file names (parquet > npz > csv)."""
+    stem, ext = os.path.splitext(path)
+    if ext.lstrip(".") not in EVENT_FORMATS: stem = path
+    for fmt in ("parquet", "npz", "csv"):
+        if os.path.exists(f"{stem}.{fmt}"): return f"{stem}.{fmt}"
+    return None
+
+
+def read_table(path: str, columns: Optional[Sequence[str]] = None) -> Dict[str, list]:
+    """
+    Columns of an event table as {column: list of values}; only `columns` are loaded
+    (all if None). With a {name: "int" | "float" | "str"} schema every format returns those
+    types (CSV strings are converted); with names only, CSV values stay strings.
+    A column the table lacks reads as None per row, whatever the format. Missing table -> {}.
+    """
+    found = find_table(path)
+    if found is None: return {}
+    if found.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(found)
+        have = set(pf.schema_arrow.names)
+        want = list(columns) if columns else pf.schema_arrow.names
+        out = pf.read(columns=[c for c in want if c in have]).to_pydict()
+        n = pf.metadata.num_rows
+    elif found.endswith(".npz"):
+        with np.load(found, allow_pickle=False) as z:
+            names = [str(c) for c in z["columns"]]
+            chunks = sorted(k for k in z.files if "/" in k)
+            want = list(columns) if columns else names
+            out = {}
+            for col in (c for c in want if c in names):
+                parts = [z[k] for k in chunks if k.split("/", 1)[0] == col]
+                out[col] = np.concatenate(parts).tolist() if parts else []
+            n = 0
+            if names and len(out) < len(want):
+                n = sum(len(z[k]) for k in chunks if k.split("/", 1)[0] == names[0])
+    else:
+        with open(found, "r", newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            want = list(columns) if columns else header
+            keep = [(c, header.index(c)) for c in want if c in header]
+            out = {c: [] for c, _ in keep}
+            n = 0
+            for row in reader:
+                n += 1
+                for c, k in keep: out[c].append(row[k])
+    types = columns if isinstance(columns, dict) else {}
+    return {c: (_column_array(out[c], types[c]).tolist() if c in types else out[c])
+            if c in out else [None] * n for c in want}
+
+
+def read_rows(path: str, columns: Optional[Sequence[str]] = None) -> List[Dict]:
+    """Same as read_table (names or schema), as one dict per row."""
+    table = read_table(path, columns)
+    names = list(table)
+    return [dict(zip(names, vals)) for vals in zip(*(table[c] for c in names))]
+
+
+def concat_tables(srcs: Sequence[str], stem: str, fmt: str = "csv", flush_rows: int = EVENT_FLUSH_ROWS,
+                  columns: Optional[Dict[str, str]] = None) -> str:
+    """
+    Append the tables `srcs` (in order, same columns) into `<stem>.<fmt>`; returns its path.
+    `columns`: the tables' schema (read_table converts CSV sources with it); else the first table's names.
+    """
+    found = [p for p in (find_table(s) for s in srcs) if p is not None]
+    if fmt == "csv" and all(p.endswith(".csv") for p in found):
+        with open(stem + ".csv", "w", newline="", encoding="utf-8") as out:
+            for k, p in enumerate(found):
+                with open(p, "r", newline="", encoding="utf-8") as f:
+                    header = f.readline()
+                    if k == 0: out.write(header)
+                    for line in f: out.write(line)
+        return stem + ".csv"
+    sink = None
+    for p in found:
+        table = read_table(p, columns)
+        if sink is None: sink = open_event_sink(stem, columns or list(table), fmt, flush_rows)
+        sink.writerows(zip(*table.values()))
+    if sink is None: return ""
+    sink.close()
+    return sink.path
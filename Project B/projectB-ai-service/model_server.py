@@ -0,0 +1,234 @@
+"""
+Persistent model server for the Video Processing API.
+
+Each worker is a long-lived process that imports torch / ultralytics, loads the YOLO
+detectors, MTCNN + InceptionResnetV1, the appearance encoder and the StudentGallery ONCE
+(classroom_attendance_activelearning.load_models) and then runs jobs sent over a local
+multiprocessing Pipe. The pool pings idle workers for health and respawns any worker
+whose process died (crash during a job, OOM kill, ...) or whose job ran past the job
+timeout. start() raises RuntimeError when a worker cannot load its models.
+
+Usage:
+    pool = ModelWorkerPool(dict(students_dir=..., person_model_path=..., ...), workers=1)
+    pool.start()
+    result = pool.submit("video.mp4", {"save_video": "session_42", "output_dir": "outputs"})
+    # -> {"ok": True, "run_dir": "outputs/session_42_2025...", "elapsed": 81.2, "pid": 1234}
+"""
+
+import os
+import time
+import logging
+import threading
+import traceback
+import multiprocessing as mp
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+READY_TIMEOUT_SEC = 900     # first start may download weights / export models
+PING_TIMEOUT_SEC = 10
+JOB_TIMEOUT_SEC = 4 * 3600  # a job still running after this is treated as hung
+HEALTH_INTERVAL_SEC = 15
+
+
+def _worker_main(conn, pipeline_kwargs: Dict):
+    """Worker process: load models + gallery once, then serve jobs until 'stop' / EOF."""
+    import classroom_attendance_activelearning as cam
+    from dataclasses import replace
+
+    try:
+        base_cfg = cam.PipelineConfig(**pipeline_kwargs)
+        models = cam.load_models(base_cfg)
+    except Exception:
+        conn.send({"type": "failed", "error": traceback.format_exc(), "pid": os.getpid()})
+        return
+    conn.send({"type": "ready", "pid": os.getpid()})
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        kind = msg.get("type")
+        if kind == "stop":
+            break
+        if kind == "ping":
+            conn.send({"type": "pong", "pid": os.getpid()})
+            continue
+        if kind == "job":
+            t0 = time.time()
+            try:
+                # per-run settings only (output folder, save_video, ...); models stay as loaded
+                cfg = replace(base_cfg, **msg.get("overrides", {}))
+                pipe = cam.MergedPipeline(cfg, models=models)
+                pipe.run(msg["source"])
+                conn.send({"type": "done", "ok": True, "run_dir": pipe.run_dir,
+                           "elapsed": time.time() - t0, "pid": os.getpid()})
+            except Exception:
+                conn.send({"type": "done", "ok": False, "error": traceback.format_exc(),
+                           "elapsed": time.time() - t0, "pid": os.getpid()})
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.proc: Optional[mp.Process] = None
+        self.conn = None
+        self.lock = threading.Lock()   # held while a job / ping / restart uses the pipe
+        self.started_at = 0.0
+        self.last_ok = 0.0
+        self.jobs_done = 0
+        self.restarts = 0
+        self.busy = False
+
+
+class ModelWorkerPool:
+    """
+    Fixed-size pool of model-server processes (spawn start method: safe with CUDA).
+    submit() blocks the calling thread until a worker is free and the job is done, or
+    `job_timeout` seconds have passed (the worker is then restarted).
+    """
+    def __init__(self, pipeline_kwargs: Dict, workers: int = 1,
+                 health_interval: float = HEALTH_INTERVAL_SEC, job_timeout: float = JOB_TIMEOUT_SEC):
+        self.pipeline_kwargs = dict(pipeline_kwargs)
+        self.job_timeout = job_timeout
+        self.ctx = mp.get_context("spawn")
+        self.workers = [_Worker(i) for i in range(max(1, int(workers)))]
+        self.health_interval = health_interval
+        self._slots = threading.Semaphore(len(self.workers))
+        self._stop = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    # ----------------------------------------------------------------- lifecycle
+
+    def start(self):
+        try:
+            for w in self.workers:
+                with w.lock:
+                    self._spawn(w)
+        except Exception:
+            self.stop()   # don't leave the workers that did start running
+            raise
+        self._monitor = threading.Thread(target=self._health_loop, daemon=True)
+        self._monitor.start()
+        logger.info(f"🧠 Model server: {len(self.workers)} worker(s) ready")
+
+    def stop(self):
+        self._stop.set()
+        for w in self.workers:
+            with w.lock:
+                try:
+                    if w.conn is not None: w.conn.send({"type": "stop"})
+                except Exception:
+                    pass
+                if w.proc is not None:
+                    w.proc.join(timeout=10)
+                    if w.proc.is_alive(): w.proc.terminate()
+
+    def _spawn(self, w: _Worker):
+        """(Re)start one worker and wait until its models are loaded. Caller holds w.lock."""
+        if w.proc is not None and w.proc.is_alive():
+            w.proc.terminate(); w.proc.join(timeout=10)
+        parent, child = self.ctx.Pipe()
+        w.proc = self.ctx.Process(target=_worker_main, args=(child, self.pipeline_kwargs),
+                                  name=f"model-worker-{w.index}", daemon=True)
+        w.proc.start()
+        child.close()   # parent recv() raises EOFError once the worker dies
+        w.conn = parent
+        w.started_at = time.time()
+        try:
+            if not parent.poll(READY_TIMEOUT_SEC):
+                raise RuntimeError(f"model worker {w.index} did not become ready in {READY_TIMEOUT_SEC}s")
+            msg = parent.recv()
+        except (EOFError, OSError) as e:   # died while loading (import error, OOM kill, ...)
+            w.proc.join(timeout=10)
+            raise RuntimeError(f"model worker {w.index} exited while loading models "
+                               f"(exit code {w.proc.exitcode})") from e
+        if msg.get("type") != "ready":
+            w.proc.join(timeout=10)
+            raise RuntimeError(f"model worker {w.index} failed to load models:\n{msg.get('error', msg)}")
+        w.last_ok = time.time()
+        logger.info(f"✅ Model worker {w.index} ready (pid {msg.get('pid')})")
+
+    def _restart(self, w: _Worker, reason: str) -> bool:
+        w.restarts += 1
+        logger.warning(f"♻️ Restarting model worker {w.index}: {reason}")
+        try:
+            self._spawn(w)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Model worker {w.index} restart failed: {e}")
+            return False
+
+    # ----------------------------------------------------------------- jobs
+
+    def submit(self, source: str, overrides: Optional[Dict] = None, timeout: Optional[float] = None) -> Dict:
+        """
+        Run one video on a free worker. Returns {"ok", "run_dir" | "error", "elapsed", "pid"}.
+        `timeout` (default: the pool's job_timeout) bounds the job; a worker past it is restarted.
+        """
+        timeout = self.job_timeout if timeout is None else timeout
+        with self._slots:
+            w = None
+            while w is None:   # a slot is free; the health check may hold its lock briefly
+                w = next((w for w in self.workers if w.lock.acquire(blocking=False)), None)
+                if w is None: time.sleep(0.05)
+            try:
+                w.busy = True
+                if (w.proc is None or not w.proc.is_alive()) and not self._restart(w, "not running"):
+                    return {"ok": False, "error": f"model worker {w.index} is down and could not be restarted"}
+                t0 = time.time()
+                try:
+                    w.conn.send({"type": "job", "source": str(source), "overrides": dict(overrides or {})})
+                    if not w.conn.poll(timeout):
+                        elapsed = time.time() - t0
+                        self._restart(w, f"job timed out after {timeout:.0f}s")
+                        return {"ok": False, "error": f"job timed out after {timeout:.0f}s (worker restarted)",
+                                "elapsed": elapsed}
+                    reply = w.conn.recv()
+                except (EOFError, OSError, BrokenPipeError) as e:
+                    code = w.proc.exitcode if w.proc is not None else None
+                    self._restart(w, f"crashed during job (exit code {code})")
+                    return {"ok": False, "error": f"model worker crashed (exit code {code}): {e}"}
+                w.jobs_done += 1
+                w.last_ok = time.time()
+                return reply
+            finally:
+                w.busy = False
+                w.lock.release()
+
+    # ----------------------------------------------------------------- health
+
+    def _ping(self, w: _Worker) -> bool:
+        try:
+            w.conn.send({"type": "ping"})
+            if w.conn.poll(PING_TIMEOUT_SEC) and w.conn.recv().get("type") == "pong":
+                w.last_ok = time.time()
+                return True
+        except (EOFError, OSError, BrokenPipeError):
+            pass
+        return False
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_interval):
+            for w in self.workers:
+                if not w.lock.acquire(blocking=False):
+                    continue   # busy: a dead process surfaces as EOFError in submit()
+                try:
+                    if w.proc is None or not w.proc.is_alive():
+                        self._restart(w, "process exited")
+                    elif not self._ping(w):
+                        self._restart(w, "no answer to ping")
+                finally:
+                    w.lock.release()
+
+    def health(self) -> List[Dict]:
+        return [{
+            "worker": w.index,
+            "pid": w.proc.pid if w.proc is not None else None,
+            "alive": bool(w.proc is not None and w.proc.is_alive()),
+            "busy": w.busy,
+            "jobs_done": w.jobs_done,
+            "restarts": w.restarts,
+            "uptime_sec": round(time.time() - w.started_at, 1) if w.started_at else 0.0,
+            "last_ok_sec_ago": round(time.time() - w.last_ok, 1) if w.last_ok else None,
+        } for w in self.workers]
@@ -0,0 +1,144 @@
+"""
+Per-session SQLite result store: one `results.sqlite` per run folder, next to the CSV / JSON files.
+
+The pipeline streams behavior intervals into it during the run (one transaction per buffered
+chunk) and writes attendance, ALS, tracks, identities and violations when the run ends. The API
+queries it through indexes on student_id and time instead of re-parsing files per request:
+    store = open_result_store(run_dir)          # None for runs without a store
+    store.students()                            # attendance + ALS per student ID
+    store.student("104221559")
+    store.timeline("104221559")                 # behavior intervals by start time
+Only stdlib sqlite3 (no torch / cv2), like event_sink.
+"""
+
+import os
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from event_sink import EVENT_FLUSH_ROWS, EventSink
+
+RESULT_STORE_NAME = "results.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tracks (track_id INTEGER PRIMARY KEY, student_id TEXT,
+                                   frames_seen INTEGER, frames_identified INTEGER);
+CREATE TABLE IF NOT EXISTS identities (track_id INTEGER, student_id TEXT, votes INTEGER);
+CREATE TABLE IF NOT EXISTS attendance (student_id TEXT, enter_sec REAL, exit_sec REAL,
+                                       enter_iso TEXT, exit_iso TEXT, duration_sec REAL);
+CREATE TABLE IF NOT EXISTS behavior_intervals (track_id INTEGER, student_id TEXT, label TEXT,
+                                               start_frame INTEGER, end_frame INTEGER,
+                                               start_sec REAL, end_sec REAL);
+CREATE TABLE IF NOT EXISTS violations (student_id TEXT, label TEXT, start_frame INTEGER, end_frame INTEGER,
+                                       start_sec REAL, end_sec REAL, video_file TEXT);
+CREATE TABLE IF NOT EXISTS als (student_id TEXT PRIMARY KEY, als REAL, labelled_sec REAL);
+CREATE TABLE IF NOT EXISTS als_seconds (student_id TEXT, label TEXT, seconds REAL, proportion REAL);
+CREATE INDEX IF NOT EXISTS idx_tracks_student ON tracks (student_id);
+CREATE INDEX IF NOT EXISTS idx_identities_track ON identities (track_id);
+CREATE INDEX IF NOT EXISTS idx_identities_student ON identities (student_id);
+CREATE INDEX IF NOT EXISTS idx_attendance_student ON attendance (student_id, enter_sec);
+CREATE INDEX IF NOT EXISTS idx_intervals_student ON behavior_intervals (student_id, start_sec);
+CREATE INDEX IF NOT EXISTS idx_intervals_time ON behavior_intervals (start_sec);
+CREATE INDEX IF NOT EXISTS idx_violations_student ON violations (student_id, start_sec);
+CREATE INDEX IF NOT EXISTS idx_als_seconds_student ON als_seconds (student_id);
+"""
+
+
+class ResultStore:
+    """
+    One SQLite file per session, in WAL mode while the run writes it; batched writes (one
+    transaction per insert() call). close() checkpoints and leaves a single self-contained file.
+    """
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            if os.path.exists(path): os.remove(path)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+        self.conn.row_factory = sqlite3.Row
+
+    def insert(self, table: str, columns: Sequence[str], rows: Iterable[Sequence]):
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        with self.conn:
+            self.conn.executemany(sql, rows)
+
+    def set_meta(self, **values):
+        self.insert("meta", ["key", "value"], [(k, json.dumps(v)) for k, v in values.items()])
+
+    def sink(self, table: str, columns: Sequence[str], flush_rows: int = EVENT_FLUSH_ROWS) -> EventSink:
+        return StoreEventSink(self, table, columns, flush_rows)
+
+    def close(self):
+        if not self.readonly:
+            self.conn.execute("PRAGMA journal_mode=DELETE")   # readers open it read-only, without -wal/-shm
+        self.conn.close()
+
+    # ----------------------------------------------------------------- queries
+
+    def meta(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def students(self, student_id: Optional[str] = None) -> List[Dict]:
+        """Attendance totals + ALS per student ID (attendance_summary.csv + als_per_student.json)."""
+        where, args = ("WHERE a.student_id = ?", (student_id,)) if student_id is not None else ("", ())
+        rows = self.conn.execute(
+            "SELECT a.student_id, ROUND(SUM(MAX(0, a.exit_sec - a.enter_sec)), 2) AS total_duration_sec, "
+            "COUNT(*) AS intervals, s.als AS als, s.labelled_sec AS labelled_sec "
+            f"FROM attendance a LEFT JOIN als s ON s.student_id = a.student_id {where} "
+            "GROUP BY a.student_id ORDER BY MIN(a.rowid)", args).fetchall()
+        return [self._with_seconds(dict(r)) for r in rows]
+
+    def student(self, student_id: str) -> Optional[Dict]:
+        rows = self.students(str(student_id))
+        return rows[0] if rows else None
+
+    def als_students(self) -> List[Dict]:
+        """Every student ID with ALS (as in als_per_student.json), with seconds and proportions."""
+        rows = self.conn.execute("SELECT student_id, als, labelled_sec FROM als ORDER BY rowid").fetchall()
+        return [self._with_seconds(dict(r)) for r in rows]
+
+    def _with_seconds(self, d: Dict) -> Dict:
+        d["seconds"], d["proportions"] = {}, {}
+        for lbl, secs, prop in self.conn.execute(
+                "SELECT label, seconds, proportion FROM als_seconds WHERE student_id = ? ORDER BY rowid",
+                (d["student_id"],)):
+            d["seconds"][lbl] = secs; d["proportions"][lbl] = prop
+        return d
+
+    def timeline(self, student_id: Optional[str] = None, start_sec: float = 0.0,
+                 end_sec: Optional[float] = None) -> List[Dict]:
+        """Behavior intervals overlapping [start_sec, end_sec], by start time."""
+        sql = "SELECT * FROM behavior_intervals WHERE end_sec >= ?"
+        args: list = [start_sec]
+        if end_sec is not None: sql += " AND start_sec <= ?"; args.append(end_sec)
+        if student_id is not None: sql += " AND student_id = ?"; args.append(str(student_id))
+        return [dict(r) for r in self.conn.execute(sql + " ORDER BY start_sec, student_id, label", args)]
+
+    def violations(self, student_id: Optional[str] = None) -> List[Dict]:
+        sql, args = "SELECT * FROM violations", ()
+        if student_id is not None: sql, args = sql + " WHERE student_id = ?", (str(student_id),)
+        return [dict(r) for r in self.conn.execute(sql + " ORDER BY start_sec", args)]
+
+
+class StoreEventSink(EventSink):
+    """EventSink into a store table: each buffered chunk is one transaction."""
+    def __init__(self, store: ResultStore, table: str, columns: Sequence[str], flush_rows: int = EVENT_FLUSH_ROWS):
+        super().__init__(store.path, columns, flush_rows)
+        self.path = f"{store.path}#{table}"
+        self.store, self.table = store, table
+
+    def _append(self, rows):
+        self.store.insert(self.table, self.columns, rows)
+
+
+def open_result_store(run_dir: str) -> Optional[ResultStore]:
+    """Read-only store of a finished run, None if the run has no results.sqlite."""
+    path = os.path.join(str(run_dir), RESULT_STORE_NAME)
+    return ResultStore(path, readonly=True) if os.path.exists(path) else None
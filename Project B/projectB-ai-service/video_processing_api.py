@@ -13,7 +13,6 @@ from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
 import json
-import subprocess
 from pathlib import Path
 from datetime import datetime
 import threading
@@ -29,6 +28,9 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from model_server import ModelWorkerPool
+from event_sink import read_rows
+from result_store import open_result_store
 
 # Setup logging with UTF-8 encoding for Windows
 logging.basicConfig(
@@ -75,6 +77,22 @@ PROCESSING_FOLDER.mkdir(exist_ok=True)
 # Allowed video extensions
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm'}
 
+# AI pipeline settings (PipelineConfig fields) used by the persistent model server
+AI_PIPELINE_KWARGS = {
+    'students_dir': str(GALLERY_FOLDER),
+    'person_model_path': str(MODEL_FOLDER / 'yolov8n.pt'),
+    'behavior_model_path': str(MODEL_FOLDER / 'student_behaviour_best.pt'),
+    'output_dir': str(OUTPUT_FOLDER),
+    'device': 'auto',
+    'half': True,
+    'frame_stride': 2,
+    'show_window': False,
+    'appearance': True,
+}
+MODEL_WORKERS = int(os.environ.get('MODEL_WORKERS', '1'))  # each worker holds its own copy of the models
+AI_JOB_TIMEOUT_SEC = float(os.environ.get('AI_JOB_TIMEOUT_SEC', str(4 * 3600)))  # hung job -> worker restarted
+MODEL_POOL_RETRY_SEC = 60  # after a failed start, jobs fail fast for this long before the next attempt
+
 # Store processing status for async operations
 processing_status = {}
 
@@ -84,11 +102,67 @@ current_processing = None
 processing_queue = []
 auto_processor_enabled = False
 
+# Persistent model server (models + gallery loaded once per worker process)
+model_pool = None
+model_pool_lock = threading.Lock()
+model_pool_error = None  # (time, message) of the last failed start
+
 
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
+def get_model_pool():
+    """
+    Start the model server on first use (workers load models + gallery once).
+    Raises RuntimeError if the workers cannot load; retried at most every MODEL_POOL_RETRY_SEC.
+    """
+    global model_pool, model_pool_error
+    with model_pool_lock:
+        if model_pool is None:
+            if model_pool_error and time.time() - model_pool_error[0] < MODEL_POOL_RETRY_SEC:
+                raise RuntimeError(f"Model server unavailable: {model_pool_error[1]}")
+            pool = ModelWorkerPool(AI_PIPELINE_KWARGS, workers=MODEL_WORKERS, job_timeout=AI_JOB_TIMEOUT_SEC)
+            try:
+                pool.start()
+            except Exception as e:
+                model_pool_error = (time.time(), str(e))
+                logger.error(f"❌ Model server failed to start: {e}")
+                raise RuntimeError(f"Model server failed to start: {e}") from e
+            model_pool, model_pool_error = pool, None
+        return model_pool
+
+
+def submit_ai_job(video_path, overrides):
+    """Run one job on the model server; start failures come back as {'ok': False, 'error': ...}"""
+    try:
+        pool = get_model_pool()
+    except RuntimeError as e:
+        return {'ok': False, 'error': str(e)}
+    return pool.submit(str(video_path), overrides)
+
+
+def run_ai_job(video_path, session_name, unit_id=None, session_id=None):
+    """
+    Run the AI pipeline on the model server. Returns (success, output_dir, error).
+    With a unit, faces are matched only against the students enrolled in it.
+    With a session, attendance events are stamped in class time from the session's start.
+    """
+    overrides = {'save_video': session_name}
+    session_start = get_session_start(session_id) if session_id not in (None, '', 'unknown') else None
+    if session_start:
+        overrides['session_start'] = session_start
+    enrolled = get_enrolled_students(unit_id) if unit_id not in (None, '', 'unknown') else None
+    if enrolled:
+        overrides['allowed_students'] = enrolled
+    else:
+        logger.warning(f"⚠️ No enrolment list for unit {unit_id}, matching against the whole gallery")
+    result = submit_ai_job(video_path, overrides)
+    if not result.get('ok'):
+        return False, None, result.get('error', 'Unknown model server error')
+    return True, Path(result['run_dir']), None
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -168,11 +242,43 @@ def add_to_queue(video_path):
 # DATABASE UPDATE FUNCTIONS
 # ============================================================================
 
+def read_ai_results_store(store):
+    """Same result as read_ai_results, from the run's results.sqlite (one indexed query per table)"""
+    students = []
+    for row in store.students():
+        student_id = row['student_id']
+        if student_id.startswith('Track#'):
+            continue
+        duration_sec = float(row['total_duration_sec'])
+        student_data = {
+            'id': student_id,
+            'ALS': round(min(100, (duration_sec / 60) * 100), 2),
+            'behavior_breakdown': {
+                'duration_sec': duration_sec,
+                'intervals': int(row['intervals'])
+            }
+        }
+        if row['als'] is not None:
+            student_data['ALS'] = row['als']
+            student_data['behavior_breakdown']['als_data'] = {
+                'ALS': row['als'], 'proportions': row['proportions'], 'seconds': row['seconds']}
+        students.append(student_data)
+    logger.info(f"📊 Read {len(students)} students from result store")
+    return students
+
+
 def read_ai_results(output_dir):
     """Read AI results from output directory - prioritizes CSV for attendance, enriches with JSON for ALS"""
     try:
         output_path = Path(output_dir)
         
+        store = open_result_store(output_path)
+        if store is not None:
+            try:
+                return read_ai_results_store(store)
+            finally:
+                store.close()
+        
         # ALWAYS read CSV first for complete attendance list
         csv_file = output_path / 'attendance_summary.csv'
         if not csv_file.exists():
@@ -268,6 +374,60 @@ def get_unit_id_from_session(session_id):
         return None
 
 
+def get_session_start(session_id):
+    """ISO start time (Date + Start) of a session, None if unknown or on DB error"""
+    try:
+        import pymysql
+        connection = pymysql.connect(
+            host='localhost',
+            user='root',
+            password='',
+            database='projectb',
+            charset='utf8mb4'
+        )
+        
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT Date, Start FROM session WHERE SessionID = %s", (session_id,))
+            result = cursor.fetchone()
+            connection.close()
+        
+        if not result or result[0] is None or result[1] is None:
+            return None
+        day, start = result   # pymysql: DATE -> date, TIME -> timedelta since midnight
+        return (datetime.combine(day, datetime.min.time()) + start).isoformat()
+    except Exception as e:
+        logger.error(f"❌ Error querying session start: {e}")
+        return None
+
+
+def get_enrolled_students(unit_id):
+    """Gallery IDs (students.RegistrationID) of the students enrolled in a unit, None on DB error"""
+    try:
+        import pymysql
+        connection = pymysql.connect(
+            host='localhost',
+            user='root',
+            password='',
+            database='projectb',
+            charset='utf8mb4'
+        )
+        
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT s.RegistrationID FROM studentunitmap m "
+                "JOIN students s ON s.StudentID = m.StudentID "
+                "WHERE m.UnitID = %s AND s.RegistrationID IS NOT NULL", (unit_id,))
+            rows = cursor.fetchall()
+            connection.close()
+        
+        enrolled = sorted({str(r[0]).strip() for r in rows if str(r[0]).strip()})
+        logger.info(f"📋 Unit {unit_id}: {len(enrolled)} enrolled students")
+        return enrolled
+    except Exception as e:
+        logger.error(f"❌ Error querying enrolment: {e}")
+        return None
+
+
 def get_students_from_db(unit_id, session_id):
     """Get student list from database"""
     try:
@@ -318,11 +478,24 @@ def generate_evidence_pdf_internal(student_row, session_id, output_dir):
         pdf_filename = f"{student_id}.pdf"
         pdf_path = REPORTS_FOLDER / pdf_filename
         
-        # Read ALS data - try JSON first, fallback to CSV
+        # Read ALS data - result store first, then JSON, fallback to CSV
         student_als_data = None
         als_file = Path(output_dir) / 'als_per_student.json'
-        
-        if als_file.exists():
+        store = open_result_store(output_dir)
+        
+        if store is not None:
+            try:
+                row = store.student(str(student_id))
+            finally:
+                store.close()
+            if row and row['als'] is not None:
+                student_als_data = {'ALS': row['als'], 'proportions': row['proportions'], 'seconds': row['seconds']}
+            elif row:
+                student_als_data = {
+                    'ALS': min(100, (float(row['total_duration_sec']) / 60) * 100),
+                    'behavior_breakdown': {'Active': int(row['intervals']), 'Observed': 1}
+                }
+        elif als_file.exists():
             with open(als_file, 'r', encoding='utf-8') as f:
                 als_data = json.load(f)
                 student_als_data = als_data.get(str(student_id))
@@ -580,54 +753,20 @@ def process_video_auto(video_path):
         video_path.rename(processing_path)
         logger.info(f"🔄 Moved to processing folder: {processing_path}")
         
-        # Prepare AI command
-        cmd = [
-            'python',
-            str(Path(__file__).parent / 'classroom_attendance_activelearning.py'),
-            '--source', str(processing_path),
-            '--outdir', str(OUTPUT_FOLDER),
-            '--students_dir', str(GALLERY_FOLDER),
-            '--person', str(MODEL_FOLDER / 'yolov8n.pt'),
-            '--behavior', str(MODEL_FOLDER / 'student_behaviour_best.pt'),
-            '--device', 'auto',
-            '--half',
-            '--frame_stride', '2',
-            '--save_video', session_name,
-            '--no_show',
-            '--appearance'
-        ]
-        
-        logger.info(f"🚀 Running AI: {' '.join(cmd)}")
+        logger.info(f"🚀 Running AI on model server: {processing_path.name}")
         
         start_time = time.time()
-        
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=str(Path(__file__).parent)
-        )
-        
-        stdout, stderr = process.communicate()  # No timeout - unlimited processing time
+        success, latest_output, error = run_ai_job(processing_path, session_name, unit_id, session_id)  # No timeout
         elapsed_time = time.time() - start_time
         
-        if process.returncode == 0:
+        if success:
             logger.info("="*80)
             logger.info("✅ AI PROCESSING SUCCESS!")
             logger.info(f"⏱️ Time: {elapsed_time:.1f}s ({elapsed_time/60:.1f}min)")
-            logger.info(f"📁 Results: outputs/{session_name}/")
+            logger.info(f"📁 Results: outputs/{latest_output.name}/")
             logger.info("="*80)
             
-            # Find output directory
-            output_folders = sorted(
-                [f for f in OUTPUT_FOLDER.iterdir() if f.is_dir() and session_name in f.name],
-                key=lambda x: x.stat().st_ctime,
-                reverse=True
-            )
-            
-            if output_folders:
-                latest_output = output_folders[0]
+            if latest_output.is_dir():
                 logger.info(f"📂 Output: {latest_output}")
                 
                 # Update database
@@ -647,7 +786,7 @@ def process_video_auto(video_path):
             logger.error("="*80)
             logger.error("❌ AI PROCESSING FAILED!")
             logger.error(f"⏱️ Time: {elapsed_time:.1f}s")
-            logger.error(f"🔴 Error: {stderr[:500]}")
+            logger.error(f"🔴 Error: {error[:500]}")
             logger.error("="*80)
             
             # Move back to uploads
@@ -783,6 +922,11 @@ def health_check():
             'enabled': auto_processor_enabled,
             'queue_size': queue_size,
             'current_processing': os.path.basename(current) if current else None
+        },
+        'model_server': {
+            'started': model_pool is not None,
+            'workers': model_pool.health() if model_pool is not None else [],
+            'last_start_error': model_pool_error[1] if model_pool_error else None
         }
     })
 
@@ -801,42 +945,11 @@ def process_video_async(video_path, job_id, unit_id, session_id):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         session_name = f'session_{session_id}_{timestamp}'
         
-        cmd = [
-            'python',
-            str(Path(__file__).parent / 'classroom_attendance_activelearning.py'),
-            '--source', video_path,
-            '--outdir', str(OUTPUT_FOLDER),
-            '--students_dir', str(GALLERY_FOLDER),
-            '--person', str(MODEL_FOLDER / 'yolov8n.pt'),
-            '--behavior', str(MODEL_FOLDER / 'student_behaviour_best.pt'),
-            '--device', 'auto',
-            '--half',
-            '--frame_stride', '2',
-            '--save_video', session_name,
-            '--no_show',
-            '--appearance'
-        ]
-        
-        print(f"[{job_id}] Running: {' '.join(cmd)}")
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=str(Path(__file__).parent)
-        )
-        
-        stdout, stderr = process.communicate()  # No timeout - unlimited processing time
+        print(f"[{job_id}] Running on model server: {video_path}")
+        success, latest_output, error = run_ai_job(video_path, session_name, unit_id, session_id)  # No timeout
         
-        if process.returncode == 0:
-            output_folders = sorted(
-                [f for f in OUTPUT_FOLDER.iterdir() if f.is_dir()],
-                key=lambda x: x.stat().st_ctime,
-                reverse=True
-            )
-            
-            if output_folders:
-                latest_output = output_folders[0]
+        if success:
+            if latest_output.is_dir():
                 print(f"[{job_id}] Output folder: {latest_output}")
                 
                 attendance_data = read_attendance_results(latest_output)
@@ -863,8 +976,8 @@ def process_video_async(video_path, job_id, unit_id, session_id):
         else:
             processing_status[job_id] = {
                 'status': 'error',
-                'message': f'Processing failed: {stderr[:500]}',
-                'error_details': stderr
+                'message': f'Processing failed: {error[:500]}',
+                'error_details': error
             }
             
     except Exception as e:
@@ -941,43 +1054,15 @@ def process_with_ai_model(video_path, unit_id, session_id):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         session_name = f'session_{session_id}_{timestamp}'
         
-        cmd = [
-            'python',
-            str(Path(__file__).parent / 'classroom_attendance_activelearning.py'),
-            '--source', video_path,
-            '--outdir', str(OUTPUT_FOLDER),
-            '--students_dir', str(GALLERY_FOLDER),
-            '--person', str(MODEL_FOLDER / 'yolov8n.pt'),
-            '--behavior', str(MODEL_FOLDER / 'student_behaviour_best.pt'),
-            '--device', 'auto',
-            '--half',
-            '--frame_stride', '2',
-            '--save_video', session_name,
-            '--no_show',
-            '--appearance'
-        ]
+        print(f"Running on model server: {video_path}")
+        success, latest_output, error = run_ai_job(video_path, session_name, unit_id, session_id)
         
-        print(f"Running: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            cwd=str(Path(__file__).parent)
-        )
-        
-        if result.returncode != 0:
-            return {'success': False, 'error': f'AI processing failed: {result.stderr}'}
-        
-        output_folders = sorted(
-            [f for f in OUTPUT_FOLDER.iterdir() if f.is_dir()],
-            key=lambda x: x.stat().st_ctime,
-            reverse=True
-        )
+        if not success:
+            return {'success': False, 'error': f'AI processing failed: {error}'}
         
-        if not output_folders:
+        if not latest_output.is_dir():
             return {'success': False, 'error': 'No output folder created'}
         
-        latest_output = output_folders[0]
         print(f"Output folder: {latest_output}")
         
         attendance_data = read_attendance_results(latest_output)
@@ -1032,8 +1117,21 @@ def read_attendance_results(output_dir):
         result = {"students": []}
 
         als_student_json = output_path / "als_per_student.json"
-
-        if als_student_json.exists():
+        store = open_result_store(output_path)
+
+        if store is not None:
+            try:
+                for row in store.als_students():
+                    result["students"].append({
+                        "id": row["student_id"],
+                        "ALS": row["als"],
+                        "seconds": row["seconds"],
+                        "proportions": row["proportions"],
+                        "total_labeled_seconds": row["labelled_sec"],
+                    })
+            finally:
+                store.close()
+        elif als_student_json.exists():
             with open(als_student_json, "r", encoding="utf-8") as f:
                 per_student = json.load(f)
 
@@ -1145,6 +1243,55 @@ def get_results(session_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def read_behavior_timeline(output_dir, student_id=None):
+    """Stable behavior intervals of a run (result store, else behavior_intervals table), optionally for one student"""
+    store = open_result_store(output_dir)
+    if store is not None:
+        try:
+            rows = store.timeline(student_id)
+        finally:
+            store.close()
+        return [{'studentId': r['student_id'], 'behavior': r['label'], 'start': r['start_sec'], 'end': r['end_sec'],
+                 'startFrame': r['start_frame'], 'endFrame': r['end_frame']} for r in rows]
+    timeline = []
+    schema = {'student_id': 'str', 'label': 'str', 'start_sec': 'float', 'end_sec': 'float',
+              'start_frame': 'int', 'end_frame': 'int'}
+    for row in read_rows(str(Path(output_dir) / 'behavior_intervals'), schema):
+        if student_id is not None and row['student_id'] != student_id:
+            continue
+        timeline.append({
+            'studentId': row['student_id'],
+            'behavior': row['label'],
+            'start': row['start_sec'],
+            'end': row['end_sec'],
+            'startFrame': row['start_frame'],
+            'endFrame': row['end_frame']
+        })
+    timeline.sort(key=lambda r: (r['start'], r['studentId'], r['behavior']))
+    return timeline
+
+
+@app.route('/api/get-timeline/<session_id>', methods=['GET'])
+def get_timeline(session_id):
+    """Behavior timeline of a session (?student_id=... for one student)"""
+    try:
+        output_dirs = list(OUTPUT_FOLDER.glob(f"session_{session_id}_*"))
+        
+        if not output_dirs:
+            return jsonify({'success': False, 'error': 'No results found'}), 404
+        
+        latest_dir = max(output_dirs, key=os.path.getctime)
+        timeline = read_behavior_timeline(latest_dir, request.args.get('student_id'))
+        
+        return jsonify({
+            'success': True,
+            'data': timeline,
+            'output_dir': str(latest_dir.name)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/generate-report', methods=['POST'])
 def generate_report():
     """Generate PDF evidence report"""
@@ -1365,6 +1512,13 @@ if __name__ == '__main__':
     print("ℹ️  Auto Processor: DISABLED (Web UI mode)")
     observer = None
     
+    # Load models + gallery once, before the first upload arrives
+    print(f"🧠 Model server: starting {MODEL_WORKERS} worker(s)...")
+    try:
+        get_model_pool()
+    except RuntimeError as e:
+        print(f"⚠️  {e} (retried on the next job)")
+    
     print("="*80)
     print("🌐 Server: http://localhost:5001")
     print("📡 Health: http://localhost:5001/health")
@@ -1389,4 +1543,6 @@ if __name__ == '__main__':
         if observer:
             observer.stop()
             observer.join()
+        if model_pool is not None:
+            model_pool.stop()
         print("✅ Stopped")